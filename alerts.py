@@ -0,0 +1,197 @@
+"""
+Alert Dispatcher
+----------------
+
+Queues notifications for CHARACTERISTIC_CUSTOM_ALERT (New Alert, 0x2a46) and
+sends them at a pace the band can display:
+
+    <category> <count> <title> 0x0a 0x0a 0x0a <message>
+
+with the category from ALERT_TYPES (MESSAGE is an SMS, 0x05, PHONE an incoming
+call, 0x03). notify() never waits: an alert whose key (by default its type and
+title) is still queued is merged into the queued one, the count going up and
+the message replaced by the newest; the same alert again within
+`coalesce_window` of being shown is dropped. A token bucket lets `burst`
+alerts through at once and then one per `interval` seconds, calls jump the
+queue, and when `max_pending` alerts wait the oldest message is dropped.
+
+    dispatcher = AlertDispatcher(lambda payload: char.write(payload, response=True))
+    dispatcher.start()
+    dispatcher.notify(ALERT_TYPES.MESSAGE, "build", "master is red")
+
+"""
+
+import asyncio
+import logging
+import time
+
+from collections import OrderedDict, deque
+
+from constants import ALERT_TYPES
+from metrics import DURATION_BUCKETS, REGISTRY
+
+logger = logging.getLogger(__name__)
+
+ALERTS_QUEUED = REGISTRY.counter("miband_alerts_queued_total", "alerts handed to the dispatcher")
+ALERTS_SENT = REGISTRY.counter("miband_alerts_sent_total", "alerts written to the band")
+ALERTS_COALESCED = REGISTRY.counter("miband_alerts_coalesced_total", "alerts merged into a queued one")
+ALERTS_DROPPED = REGISTRY.counter("miband_alerts_dropped_total", "alerts dropped as duplicates or overflow")
+ALERT_SECONDS = REGISTRY.histogram("miband_alert_latency_seconds", "alert enqueue to delivery", DURATION_BUCKETS)
+
+ALERT_CATEGORIES = {
+    ALERT_TYPES.NONE: 0x00,
+    ALERT_TYPES.MESSAGE: 0x05,
+    ALERT_TYPES.PHONE: 0x03,
+}
+SEPARATOR = '\x0a\x0a\x0a'
+MAX_ALERT_BYTES = 230
+ALERT_INTERVAL = 3.0
+ALERT_BURST = 2
+COALESCE_WINDOW = 10.0
+MAX_PENDING = 32
+LATENCY_SAMPLES = 1000
+
+
+def encode(kind, title="", message="", count=1):
+    """New Alert payload, text cut to MAX_ALERT_BYTES on a character boundary."""
+    text = (title + SEPARATOR + message).encode('utf-8')[:MAX_ALERT_BYTES]
+    return bytes((ALERT_CATEGORIES[kind], min(count, 0xff))) + text.decode('utf-8', 'ignore').encode('utf-8')
+
+
+class Alert:
+    __slots__ = ("kind", "title", "message", "key", "count", "enqueued")
+
+    def __init__(self, kind, title, message, key) -> None:
+        self.kind = kind
+        self.title = title
+        self.message = message
+        self.key = key
+        self.count = 1
+        self.enqueued = time.monotonic()
+
+    def payload(self):
+        return encode(self.kind, self.title, self.message, self.count)
+
+
+class AlertDispatcher:
+    def __init__(self, write, interval=ALERT_INTERVAL, burst=ALERT_BURST,
+                 coalesce_window=COALESCE_WINDOW, max_pending=MAX_PENDING) -> None:
+        self.write = write
+        self.interval = interval
+        self.burst = burst
+        self.coalesce_window = coalesce_window
+        self.max_pending = max_pending
+        self.pending = OrderedDict()
+        self.shown = {}
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def notify(self, kind, title="", message="", key=None):
+        """Queue an alert, returns "queued", "coalesced" or "dropped"."""
+        if kind not in ALERT_CATEGORIES:
+            raise ValueError(f"unknown alert type {kind!r}")
+        ALERTS_QUEUED.inc()
+        key = key if key is not None else (kind, title)
+        now = time.monotonic()
+        queued = self.pending.get(key)
+        if queued is not None:
+            queued.count += 1
+            queued.message = message
+            self.coalesced += 1
+            ALERTS_COALESCED.inc()
+            return "coalesced"
+        last = self.shown.get(key)
+        if last is not None and last[0] == message and now - last[1] < self.coalesce_window:
+            self.dropped += 1
+            ALERTS_DROPPED.inc()
+            return "dropped"
+        if len(self.pending) >= self.max_pending:
+            oldest = next((k for k, a in self.pending.items() if a.kind != ALERT_TYPES.PHONE), None)
+            if oldest is None:
+                self.dropped += 1
+                ALERTS_DROPPED.inc()
+                return "dropped"
+            del self.pending[oldest]
+            self.dropped += 1
+            ALERTS_DROPPED.inc()
+        self.pending[key] = Alert(kind, title, message, key)
+        self._wakeup.set()
+        return "queued"
+
+    def _next(self):
+        for key, alert in self.pending.items():
+            if alert.kind == ALERT_TYPES.PHONE:
+                return self.pending.pop(key)
+        return self.pending.popitem(last=False)[1]
+
+    async def _take_token(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) / self.interval)
+            self._refilled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            # bursts keep coalescing into the queue while we wait here
+            await asyncio.sleep((1 - self._tokens) * self.interval)
+
+    async def run(self):
+        while True:
+            if not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            await self._take_token()
+            if not self.pending:
+                continue
+            alert = self._next()
+            try:
+                await self.write(alert.payload())
+            except Exception as e:
+                self.failed += 1
+                logger.warning("alert %r not delivered: %r", alert.title, e)
+                continue
+            latency = time.monotonic() - alert.enqueued
+            self.sent += 1
+            self.latencies.append(latency)
+            ALERTS_SENT.inc()
+            ALERT_SECONDS.observe(latency)
+            self.shown[alert.key] = (alert.message, time.monotonic())
+            if len(self.shown) > 4 * self.max_pending:
+                self._forget_shown()
+
+    def _forget_shown(self):
+        horizon = time.monotonic() - self.coalesce_window
+        self.shown = {key: last for key, last in self.shown.items() if last[1] >= horizon}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        ordered = sorted(self.latencies)
+        return {
+            "pending": len(self.pending),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "p50_ms": ordered[len(ordered) // 2] * 1000 if ordered else None,
+            "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000 if ordered else None,
+        }
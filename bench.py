@@ -0,0 +1,871 @@
+"""
+Benchmarks
+----------
+
+Micro-benchmarks for the hot paths in main.py. Every benchmark prints one line
+per measured variant so runs can be diffed against each other.
+
+    python bench.py activity --packets 20000
+    python bench.py sync --minutes 10080 --latency 0.002
+    python bench.py startup --runs 20
+    python bench.py chunked --size 4096 --mtu 247 --latency 0.0075
+    python bench.py sensor --packets 100000 --band-rate 50
+    python bench.py reconnect --drop-every 200 --unreachable 2
+    python bench.py export --minutes 525600 --row-group-size 65536
+    python bench.py rollup --minutes 525600 --queries 200
+    python bench.py segments --days 365
+    python bench.py alerts --alerts 2000 --keys 20 --latency 0.002
+    python bench.py dfu --size 262144 --mtu 247 --latency 0.0075
+    python bench.py codec --iterations 200000
+    python bench.py status --bands 20 --polls 500 --latency 0.0075
+    python bench.py replay --minutes 43200 [--capture sync.mbr]
+    python bench.py offload --minutes 129600 --latency 0.0005
+
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import struct
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _report(name, count, elapsed, unit="samples"):
+    rate = count / elapsed if elapsed > 0 else float("inf")
+    print(f"{name:<28} {count:>10} {unit} in {elapsed:8.4f}s  {rate:14,.0f} {unit}/s")
+
+
+def _activity_packets(packets, samples_per_packet):
+    body = os.urandom(packets * samples_per_packet * 4)
+    size = samples_per_packet * 4
+    return [bytes([i & 0xff]) + body[i * size:(i + 1) * size] for i in range(packets)]
+
+
+def _legacy_activity_decode(packets, start):
+    # per-sample decode as ActivityChar._callback used to do it, minus the print
+    from datetime import timedelta
+    rows = []
+    timestamp = start
+    for data in packets:
+        i = 1
+        while i < len(data):
+            timestamp = timestamp + timedelta(minutes=1)
+            category = struct.unpack("<B", data[i:i + 1])[0]
+            intensity = struct.unpack("B", data[i + 1:i + 2])[0]
+            steps = struct.unpack("B", data[i + 2:i + 3])[0]
+            heart_rate = struct.unpack("B", data[i + 3:i + 4])[0]
+            rows.append((timestamp, category, intensity, steps, heart_rate))
+            i += 4
+    return rows
+
+
+def bench_activity(args):
+    from datetime import datetime
+    from main import ActivityBatch, to_minute
+
+    packets = _activity_packets(args.packets, args.samples_per_packet)
+    samples = args.packets * args.samples_per_packet
+    start = datetime(2023, 5, 22)
+
+    t0 = time.perf_counter()
+    _legacy_activity_decode(packets, start)
+    _report("activity legacy", samples, time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    minute = to_minute(start)
+    batches = []
+    for data in packets:
+        batch = ActivityBatch.decode(minute, data)
+        batches.append(batch)
+        minute = batch.end_minute
+    session = ActivityBatch.concat(batches)
+    _report("activity batch", len(session), time.perf_counter() - t0)
+
+
+async def _sync_run(args):
+    from fake_band import FakeBleakClient
+    from main import Wac
+
+    key = bytes(range(16))
+    client = FakeBleakClient(key, minutes=args.minutes, window_minutes=args.window_minutes,
+                             latency=args.latency, jitter=args.jitter, loss=args.loss)
+    wac = Wac("fake", auth_key=key.hex(), client=client)
+    await wac.connect()
+
+    t0 = time.perf_counter()
+    for _ in range(args.auth_rounds):
+        await wac.authenticate()
+    auth = (time.perf_counter() - t0) / args.auth_rounds
+
+    t0, c0 = time.perf_counter(), time.process_time()
+    session = await wac.sync(start=client.start, end=client.end)
+    elapsed, cpu = time.perf_counter() - t0, time.process_time() - c0
+    await wac.client.disconnect()
+    return auth, len(session), elapsed, cpu, client.dropped
+
+
+def bench_sync(args):
+    auth, samples, elapsed, cpu, dropped = asyncio.run(_sync_run(args))
+    print(f"{'auth latency':<28} {auth * 1000:10.3f} ms")
+    _report("fetch throughput", samples, elapsed)
+    print(f"{'cpu per sample':<28} {cpu / max(samples, 1) * 1e6:10.3f} us  ({dropped} notifications dropped)")
+
+
+async def _reconnect_run(args):
+    from fake_band import FakeBleakClient
+    from main import Wac
+    from supervisor import Backoff, Supervisor
+
+    key = bytes(range(16))
+    client = FakeBleakClient(key, minutes=args.minutes, latency=args.latency,
+                             drop_every=args.drop_every, unreachable=args.unreachable)
+
+    def wac_factory(address, auth_key, disconnected_callback):
+        # the same fake band comes back in range, as a real one would
+        client.disconnected_callback = disconnected_callback
+        return Wac(address, auth_key=auth_key, client=client)
+
+    supervisor = Supervisor("fake", key.hex(), wac_factory, Backoff(args.backoff, seed=0))
+    t0 = time.perf_counter()
+    session = await supervisor.sync(start=client.start, end=client.end)
+    elapsed = time.perf_counter() - t0
+    await supervisor.close()
+    return supervisor.report(), len(session), len(set(session.minutes)), elapsed
+
+
+def bench_reconnect(args):
+    # every drop and refused attempt logs a warning, keep the report readable
+    logging.getLogger("supervisor").setLevel(logging.ERROR)
+    report, samples, unique, elapsed = asyncio.run(_reconnect_run(args))
+    _report("fetch across drops", samples, elapsed)
+    print(f"{'link drops':<28} {report['drops']:>10}  ({report['attempts']} connect attempts)")
+    print(f"{'recovery time':<28} {report['recovery_mean'] * 1000:10.3f} ms mean "
+          f"{report['recovery_max'] * 1000:10.3f} ms max")
+    print(f"{'samples kept':<28} {unique:>10} of {args.minutes}")
+    if unique != args.minutes or samples != unique:
+        sys.exit(1)
+
+
+def bench_export(args):
+    import tempfile
+    from export import export_range
+    from main import ActivityBatch
+    from store import ActivityStore
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = ActivityStore(os.path.join(tmp, "activity.db"))
+        day = 1440
+        for start in range(0, args.minutes, day):
+            n = min(day, args.minutes - start)
+            store.commit([ActivityBatch(27_000_000 + start, *(os.urandom(n) for _ in range(4)))])
+        formats = ["csv"]
+        try:
+            import pyarrow  # noqa: F401
+            formats += ["arrow", "parquet"]
+        except ImportError:
+            print("pyarrow not installed, skipping arrow and parquet")
+        for format in formats:
+            path = os.path.join(tmp, "activity." + format)
+            t0 = time.perf_counter()
+            rows, _ = export_range(store, path, format=format, row_group_size=args.row_group_size)
+            _report(f"export {format}", rows, time.perf_counter() - t0, "rows")
+            print(f"{'':<28} {os.path.getsize(path) / rows:10.2f} bytes/row")
+        store.close()
+
+
+def _synthetic_store(path, minutes, window, rollup):
+    from main import ActivityBatch
+    from store import ActivityStore
+
+    # the band only uses a handful of categories, random bytes would make 256
+    categories = bytes((1, 3, 80, 90, 96, 112, 122, 6) * 32)
+    store = ActivityStore(path, rollup=rollup)
+    t0 = time.perf_counter()
+    for start in range(0, minutes, window):
+        n = min(window, minutes - start)
+        category, intensity, steps, heart_rate = (os.urandom(n) for _ in range(4))
+        store.commit([ActivityBatch(27_000_000 + start, category.translate(categories),
+                                    intensity, steps, heart_rate)])
+    return store, time.perf_counter() - t0
+
+
+def bench_rollup(args):
+    import random
+    import tempfile
+    from main import from_minute
+    from rollups import _FROM_MINUTES, ActivityQuery
+
+    with tempfile.TemporaryDirectory() as tmp:
+        plain, elapsed = _synthetic_store(os.path.join(tmp, "plain.db"), args.minutes, args.window, False)
+        _report("commit without rollups", args.minutes, elapsed)
+        plain.close()
+        store, elapsed = _synthetic_store(os.path.join(tmp, "rollup.db"), args.minutes, args.window, True)
+        _report("commit with rollups", args.minutes, elapsed)
+        query = ActivityQuery(store)
+        first, last = 27_000_000, 27_000_000 + args.minutes
+
+        t0 = time.perf_counter()
+        scan = store.conn.execute(
+            "SELECT minute / 1440, SUM(steps) FROM activity WHERE minute >= ? AND minute < ? GROUP BY 1",
+            (first, last)).fetchall()
+        _report("daily steps, minute scan", len(scan), time.perf_counter() - t0, "days")
+        t0 = time.perf_counter()
+        days = query.buckets("day", from_minute(first), from_minute(last))
+        _report("daily steps, rollups", len(days), time.perf_counter() - t0, "days")
+
+        rng = random.Random(0)
+        ranges = [sorted(rng.randrange(first, last) for _ in range(2)) for _ in range(args.queries)]
+        t0 = time.perf_counter()
+        for lo, hi in ranges:
+            expected = store.conn.execute(_FROM_MINUTES.format(bucket="NULL"), (lo, hi)).fetchone()
+        _report("range summary, minute scan", len(ranges), time.perf_counter() - t0, "queries")
+        t0 = time.perf_counter()
+        for lo, hi in ranges:
+            summary = query.summary(from_minute(lo), from_minute(hi))
+        _report("range summary, rollups", len(ranges), time.perf_counter() - t0, "queries")
+        if summary["steps"] != (expected[2] or 0):
+            sys.exit("rollup summary does not match the minute scan")
+
+        try:
+            t0 = time.perf_counter()
+            resampled = query.resample(from_minute(first), from_minute(last), 15)
+            _report("15 minute resample, numpy", len(resampled["start"]), time.perf_counter() - t0, "buckets")
+        except ImportError:
+            print("numpy not installed, skipping resample")
+        store.close()
+
+
+def _synthetic_day(rng):
+    import numpy as np
+    from constants import ACTIVITY_CATEGORIES as CAT
+
+    # asleep until ~7:00 with deep phases, a walk, a workout, a charge
+    category = rng.choice(np.array([1, 80, 90, 96], dtype=np.uint8), 1440)
+    wake = 420 + int(rng.integers(-30, 30))
+    category[:wake] = np.where(rng.random(wake) < 0.3, CAT.DEEP_SLEEP, CAT.LIGHT_SLEEP)
+    category[1380:] = CAT.LIGHT_SLEEP
+    category[780:840] = CAT.CHARGING
+    steps = rng.integers(0, 20, 1440, dtype=np.uint8)
+    steps[540:570] = rng.integers(70, 110, 30)
+    steps[1080:1120] = rng.integers(130, 170, 40)
+    heart_rate = rng.integers(55, 100, 1440, dtype=np.uint8)
+    heart_rate[1080:1120] += 50
+    intensity = rng.integers(0, 120, 1440, dtype=np.uint8)
+    return category.tobytes(), intensity.tobytes(), steps.tobytes(), heart_rate.tobytes()
+
+
+def bench_segments(args):
+    import tempfile
+    import numpy as np
+    from constants import ACTIVITY_CATEGORIES
+    from main import ActivityBatch, from_minute
+    from segments import SegmentIndex, segment
+    from store import DAY_MINUTES, ActivityStore
+
+    rng = np.random.default_rng(0)
+    first_day = 19000
+    with tempfile.TemporaryDirectory() as tmp:
+        store = ActivityStore(os.path.join(tmp, "activity.db"), rollup=False)
+        for day in range(first_day, first_day + args.days):
+            store.commit([ActivityBatch(day * DAY_MINUTES, *_synthetic_day(rng))])
+        index = SegmentIndex(store)
+
+        t0 = time.perf_counter()
+        columns = store.day_columns(first_day, first_day + args.days)
+        _report("load day columns", args.days * DAY_MINUTES, time.perf_counter() - t0, "minutes")
+        t0 = time.perf_counter()
+        found = segment(columns, first_day * DAY_MINUTES)
+        _report("segment, numpy", args.days * DAY_MINUTES, time.perf_counter() - t0, "minutes")
+        t0 = time.perf_counter()
+        days = index.refresh()
+        _report("cold refresh", days, time.perf_counter() - t0, "days")
+
+        last = first_day + args.days
+        store.commit([ActivityBatch(last * DAY_MINUTES, *(c[:720] for c in _synthetic_day(rng)))])
+        t0 = time.perf_counter()
+        days = index.refresh()
+        _report("refresh after one window", days, time.perf_counter() - t0, "days")
+
+        # three days off the wrist, synced half a day at a time: the not_worn
+        # segment starting on the first keeps growing after it was cached
+        not_worn = bytes([ACTIVITY_CATEGORIES.NOT_WORN]) * (3 * DAY_MINUTES)
+        start = last * DAY_MINUTES + 720
+        for lo in range(0, len(not_worn), 720):
+            store.commit([ActivityBatch(start + lo, not_worn[lo:lo + 720], bytes(720), bytes(720), bytes(720))])
+            index.refresh()
+        incremental = index.segments(from_minute(first_day * DAY_MINUTES), from_minute(start + len(not_worn)))
+        with store.conn:
+            store.conn.execute("DELETE FROM segment")
+            store.conn.execute("DELETE FROM segment_cache")
+        rebuilt = index.segments(from_minute(first_day * DAY_MINUTES), from_minute(start + len(not_worn)))
+        assert incremental == rebuilt, "incremental refresh differs from a rebuild"
+        print(f"{'incremental == rebuild':<28} {len(rebuilt):>10} segments")
+        sleeps = sum(1 for kind in found["kind"] if kind == "sleep")
+        print(f"{'segments':<28} {len(found['kind']):>10}  ({sleeps} sleep periods)")
+        store.close()
+
+
+async def _alerts_run(args, storm):
+    from alerts import AlertDispatcher
+    from constants import ALERT_TYPES, UUIDS
+    from fake_band import FakeBleakClient
+    from main import Wac
+
+    key = bytes(range(16))
+    client = FakeBleakClient(key, minutes=args.minutes, latency=args.latency)
+    wac = Wac("fake", auth_key=key.hex(), client=client)
+    await wac.connect()
+    await wac.authenticate()
+    char = await wac.createChar(UUIDS.CHARACTERISTIC_CUSTOM_ALERT)
+    dispatcher = AlertDispatcher(lambda payload: char.write(payload, response=True),
+                                 interval=args.interval, burst=args.burst)
+    dispatcher.start()
+
+    async def flood():
+        # the whole storm lands while the fetch runs
+        for i in range(args.alerts):
+            kind = ALERT_TYPES.PHONE if i % 97 == 0 else ALERT_TYPES.MESSAGE
+            dispatcher.notify(kind, f"source {i % args.keys}", f"event {i}")
+            if i % 50 == 0:
+                await asyncio.sleep(0)
+
+    t0 = time.perf_counter()
+    flooding = asyncio.ensure_future(flood()) if storm else None
+    session = await wac.sync(start=client.start, end=client.end)
+    elapsed = time.perf_counter() - t0
+    if flooding is not None:
+        await flooding
+        while dispatcher.pending:
+            await asyncio.sleep(args.interval)
+        await asyncio.sleep(args.interval)
+    await dispatcher.stop()
+    alerts = sum(1 for uuid, _ in client.writes if uuid == UUIDS.CHARACTERISTIC_CUSTOM_ALERT)
+    return len(session), elapsed, dispatcher.stats(), alerts
+
+
+def bench_alerts(args):
+    samples, elapsed, _, _ = asyncio.run(_alerts_run(args, storm=False))
+    _report("fetch, quiet", samples, elapsed)
+    samples, elapsed, stats, written = asyncio.run(_alerts_run(args, storm=True))
+    _report("fetch, alert storm", samples, elapsed)
+    print(f"{'alerts':<28} {args.alerts:>10} in, {written} written, {stats['coalesced']} coalesced, "
+          f"{stats['dropped']} dropped")
+    print(f"{'alert latency':<28} {stats['p50_ms']:10.1f} ms p50 {stats['p99_ms']:10.1f} ms p99")
+
+
+async def _dfu_run(args, path, window, sync_every):
+    from dfu import Uploader
+    from fake_band import FakeBleakClient
+    from main import Wac
+
+    client = FakeBleakClient(bytes(16), minutes=0, latency=args.latency, mtu_size=args.mtu)
+    wac = Wac("fake", auth_key=bytes(16).hex(), client=client)
+    await wac.connect()
+    result = await Uploader(client, path, registry=wac.registry, window=window, sync_every=sync_every).upload()
+    with open(path, "rb") as f:
+        if bytes(client.firmware) != f.read() or not client.rebooted:
+            raise SystemExit("dfu: the fake band got a different image")
+    return result
+
+
+async def _dfu_link_lost(args, path, at=50):
+    from dfu import Uploader
+    from fake_band import FakeBleakClient
+    from main import Wac
+
+    client = FakeBleakClient(bytes(16), minutes=0, latency=args.latency, mtu_size=args.mtu)
+    wac = Wac("fake", auth_key=bytes(16).hex(), client=client)
+    await wac.connect()
+    write, writes = client.write_gatt_char, 0
+
+    async def dropping(char_specifier, data, response=False):
+        nonlocal writes
+        writes += 1
+        if writes == at:
+            raise ConnectionError("link lost")
+        return await write(char_specifier, data, response=response)
+    client.write_gatt_char = dropping
+    try:
+        await Uploader(client, path, registry=wac.registry, window=args.window, sync_every=args.sync_every).upload()
+    except ConnectionError:
+        # the link error itself, not a BufferError from unmapping the image
+        return
+    raise SystemExit("dfu: a lost link went unnoticed")
+
+
+def bench_dfu(args):
+    import tempfile
+    with tempfile.NamedTemporaryFile(suffix=".fw") as image:
+        image.write(os.urandom(args.size))
+        image.flush()
+        for name, window, sync_every in (("dfu stop and wait", 1, 1),
+                                         (f"dfu window {args.window}", args.window, args.sync_every)):
+            result = asyncio.run(_dfu_run(args, image.name, window, sync_every))
+            _report(name, result["bytes"], result["seconds"], "bytes")
+        asyncio.run(_dfu_link_lost(args, image.name))
+
+
+def _legacy_steps(a):
+    # StepChar.read before codec.STEPS
+    return (struct.unpack('h', a[1:3])[0], struct.unpack('h', a[5:7])[0],
+            struct.unpack('h', a[2:4])[0], struct.unpack('b', a[9:10])[0])
+
+
+def _legacy_fetch_ack(data):
+    # FetchChar.fetch_window before codec.FETCH_ACK
+    from datetime import datetime
+    year = struct.unpack("<H", data[7:9])[0]
+    month = struct.unpack("b", data[9:10])[0]
+    day = struct.unpack("b", data[10:11])[0]
+    hour = struct.unpack("b", data[11:12])[0]
+    minute = struct.unpack("b", data[12:13])[0]
+    return datetime(year, month, day, hour, minute)
+
+
+def _legacy_fetch_start(timestamp, utc_offset):
+    # FetchChar._pack_timestamp
+    return (b'\x01\x01' + struct.pack("<H", timestamp.year) + struct.pack("b", timestamp.month)
+            + struct.pack("b", timestamp.day) + struct.pack("b", timestamp.hour)
+            + struct.pack("b", timestamp.minute) + utc_offset)
+
+
+def bench_codec(args):
+    from datetime import datetime
+    import codec
+    from fake_band import load_specs
+
+    _, values = load_specs()
+    for uuid, data in values.items():
+        message = codec.SPEC_MESSAGES.get(uuid.lower())
+        if message is not None and message.encode(*message.decode(data)) != bytes(data):
+            raise SystemExit(f"codec: {message.name} does not round trip the specs.txt payload")
+
+    n = args.iterations
+    since = datetime(2023, 5, 22, 5, 24)
+    steps = codec.STEPS.encode(steps=4321, meters=3100, calories=180)
+    ack = codec.FETCH_ACK.encode(0x10, 0x01, 0x01, 720, 2023, 5, 22, 5, 24, 0, 0x1c)
+    battery = bytes(values[codec.UUIDS.CHARACTERISTIC_BATTERY])
+    current_time = bytes(values[codec.UUIDS.CHARACTERISTIC_CURRENT_TIME.lower()])
+    activity = _activity_packets(1, args.samples_per_packet)[0]
+    cases = (
+        ("steps legacy", lambda: _legacy_steps(steps)),
+        ("steps decode", lambda: codec.STEPS.decode(steps)),
+        ("steps encode", lambda: codec.STEPS.encode(0x0c, 4321, 3100, 180)),
+        ("battery decode", lambda: codec.BATTERY.decode(battery)),
+        ("current time legacy", lambda: current_time[9:11]),
+        ("current time decode", lambda: codec.CURRENT_TIME.decode(current_time)),
+        ("fetch ack legacy", lambda: _legacy_fetch_ack(ack)),
+        ("fetch ack decode", lambda: codec.timestamp(codec.FETCH_ACK.decode(ack))),
+        ("fetch start legacy", lambda: _legacy_fetch_start(since, b'\x00\x1c')),
+        ("fetch start encode", lambda: codec.fetch_start(since, 0x1c)),
+        ("activity legacy", lambda: _legacy_activity_decode([activity], since)),
+        ("activity iter_unpack", lambda: list(codec.activity_samples(activity))),
+    )
+    for name, case in cases:
+        t0 = time.perf_counter()
+        for _ in range(n):
+            case()
+        _report(name, n, time.perf_counter() - t0, "messages")
+
+
+async def _status_run(args, cached):
+    from constants import UUIDS
+    from fake_band import FakeBleakClient
+    from main import Wac
+    from status import DeviceStatus
+
+    bands = []
+    for _ in range(args.bands):
+        client = FakeBleakClient(bytes(16), minutes=0, latency=args.latency)
+        wac = Wac("fake", auth_key=bytes(16).hex(), client=client)
+        await wac.connect()
+        if cached:
+            read = (await DeviceStatus(wac, ttl=args.ttl).start()).get
+        else:
+            steps = await wac.createChar(UUIDS.CHARACTERISTIC_STEPS, "STEP")
+            battery = await wac.createChar(UUIDS.CHARACTERISTIC_BATTERY, "BATTERY")
+            read = (lambda chars: lambda name: chars[name].read())({"steps": steps, "battery": battery})
+        bands.append((client, read))
+    t0 = time.perf_counter()
+    for _ in range(args.polls):
+        # a dashboard refresh: every band, both values
+        await asyncio.gather(*(read(name) for _, read in bands for name in ("steps", "battery")))
+    elapsed = time.perf_counter() - t0
+    reads = sum(client.reads for client, _ in bands)
+    return args.polls * args.bands * 2, elapsed, reads
+
+
+def bench_status(args):
+    for name, cached in (("status direct reads", False), ("status snapshot", True)):
+        polls, elapsed, reads = asyncio.run(_status_run(args, cached))
+        _report(name, polls, elapsed, "polls")
+        print(f"{'':<28} {reads:>10} GATT reads")
+
+
+async def _record(args, path):
+    from fake_band import FakeBleakClient
+    from main import Wac
+
+    key = bytes(range(16))
+    client = FakeBleakClient(key, minutes=args.minutes, latency=args.latency)
+    wac = Wac("fake", auth_key=key.hex(), client=client, record=path)
+    await wac.connect()
+    await wac.authenticate()
+    await wac.sync(start=client.start, end=client.end)
+    await wac.client.disconnect()
+    wac.client.close()
+
+
+async def _replay_sync(path):
+    from main import Wac
+    from recorder import ReplayClient
+
+    client = ReplayClient(path)
+    wac = Wac("replay", auth_key=bytes(16).hex(), client=client)
+    await wac.connect()
+    await wac.authenticate()
+    start, end = client.fetch_range()
+    t0 = time.perf_counter()
+    session = await wac.sync(start=start, end=end)
+    return len(session), time.perf_counter() - t0
+
+
+def _replay_feed(path):
+    from codec import FETCH_ACK, timestamp
+    from constants import UUIDS
+    from main import ActivityGetter
+    from recorder import Replayer
+
+    getter = ActivityGetter(0, None)
+
+    def window(_, data):
+        # what FetchChar.fetch_window does with the band's answer
+        if data[:3] == b'\x10\x01\x01':
+            getter.next_timestamp = timestamp(FETCH_ACK.decode(data))
+            getter.pkg = 0
+
+    replayer = Replayer(path)
+    t0 = time.perf_counter()
+    replayer.feed({UUIDS.CHARACTERISTIC_FETCH: window,
+                   UUIDS.CHARACTERISTIC_ACTIVITY_DATA: getter.activity_char._callback})
+    elapsed = time.perf_counter() - t0
+    replayer.close()
+    return sum(len(batch) for batch in getter.batches), elapsed
+
+
+def bench_replay(args):
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.capture
+        if path is None:
+            path = os.path.join(tmp, "sync.mbr")
+            t0 = time.perf_counter()
+            asyncio.run(_record(args, path))
+            print(f"{'recorded sync':<28} {os.path.getsize(path):>10} bytes in {time.perf_counter() - t0:8.4f}s")
+        _report("replay through Wac.sync", *asyncio.run(_replay_sync(path)))
+        _report("replay into ActivityChar", *_replay_feed(path))
+
+
+async def _legacy_chunked_write(client, char_specifier, data_type, data):
+    # Chunked.write before the rewrite: 17 byte chunks, one write request each
+    remaining, count, length = len(data), 0, 17
+    while remaining > 0:
+        copybytes = min(remaining, length)
+        flag = 0
+        if remaining <= length:
+            flag |= 0x80
+            if count == 0:
+                flag |= 0x40
+        elif count > 0:
+            flag |= 0x40
+        chunk = b'\x00' + bytes([flag | data_type]) + bytes([count & 0xff])
+        chunk += data[count * length:count * length + copybytes]
+        count += 1
+        await client.write_gatt_char(char_specifier, chunk, response=True)
+        remaining -= copybytes
+
+
+def _p99(values):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * 0.99))] if values else 0.0
+
+
+async def _offload_run(args, path, offload):
+    from fake_band import FakeBleakClient
+    from main import ActivityGetter, Wac
+    from store import ActivityStore
+
+    key = bytes(range(16))
+    client = FakeBleakClient(key, minutes=args.minutes, window_minutes=args.window_minutes, latency=args.latency)
+    wac = Wac("fake", auth_key=key.hex(), client=client)
+    await wac.connect()
+    store = ActivityStore(path)
+    getter = ActivityGetter(await wac.utc_offset(), client, store=store, start=client.start, end=client.end,
+                            registry=wac.registry, offload=offload)
+    callback, durations = getter.activity_char._callback, []
+
+    def timed(sender, data):
+        t0 = time.perf_counter()
+        callback(sender, data)
+        durations.append(time.perf_counter() - t0)
+    getter.activity_char._callback = timed
+
+    lags, running = [], True
+
+    async def ticker():
+        # how late the loop wakes up: what every other band and alert waits
+        while running:
+            t0 = time.perf_counter()
+            await asyncio.sleep(args.tick)
+            lags.append(time.perf_counter() - t0 - args.tick)
+
+    ticking = asyncio.ensure_future(ticker())
+    t0 = time.perf_counter()
+    session = await getter.fetch()
+    elapsed = time.perf_counter() - t0
+    running = False
+    await ticking
+    stored = store.conn.execute("SELECT COUNT(*) FROM activity").fetchone()[0]
+    store.close()
+    await client.disconnect()
+    return len(session), stored, elapsed, durations, lags
+
+
+def bench_offload(args):
+    import tempfile
+    from main import cipher
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, offload in (("backfill inline", False), ("backfill offload", True)):
+            samples, stored, elapsed, durations, lags = asyncio.run(
+                _offload_run(args, os.path.join(tmp, f"{name.split()[-1]}.db"), offload))
+            assert stored == samples
+            _report(name, samples, elapsed)
+            print(f"{'  callback':<28} {_p99(durations) * 1e6:10.1f} us p99 {max(durations) * 1e6:10.1f} us max")
+            print(f"{'  loop lag':<28} {_p99(lags) * 1000:10.2f} ms p99 {max(lags) * 1000:10.2f} ms max")
+
+    from Crypto.Cipher import AES
+    key, block = bytes(range(16)), os.urandom(16)
+    t0 = time.perf_counter()
+    for _ in range(args.auth_rounds):
+        AES.new(key, AES.MODE_ECB).encrypt(block)
+    _report("aes new cipher per auth", args.auth_rounds, time.perf_counter() - t0, "blocks")
+    t0 = time.perf_counter()
+    for _ in range(args.auth_rounds):
+        cipher(key).encrypt(block)
+    _report("aes cached cipher", args.auth_rounds, time.perf_counter() - t0, "blocks")
+
+
+async def _chunked_run(args):
+    from constants import UUIDS
+    from fake_band import FakeBleakClient
+    from main import Chunked
+
+    data = os.urandom(args.size)
+    results = []
+    for name, mtu, legacy in (("chunked legacy", 23, True),
+                              ("chunked mtu 23", 23, False),
+                              (f"chunked mtu {args.mtu}", args.mtu, False)):
+        client = FakeBleakClient(bytes(16), minutes=0, latency=args.latency, mtu_size=mtu)
+        await client.connect()
+        t0 = time.perf_counter()
+        if legacy:
+            await _legacy_chunked_write(client, UUIDS.CHARACTERISTIC_CHUNKED_TRANSFER, 3, data)
+        else:
+            await Chunked(UUIDS.CHARACTERISTIC_CHUNKED_TRANSFER, client, window=args.window).write(3, data)
+        elapsed = time.perf_counter() - t0
+        assert client.received[3] == data
+        results.append((name, elapsed))
+    return results
+
+
+def bench_chunked(args):
+    for name, elapsed in asyncio.run(_chunked_run(args)):
+        _report(name, args.size, elapsed, unit="bytes")
+
+
+def bench_sensor(args):
+    import tempfile
+    from sensor import AccelCapture, open_capture
+
+    body = os.urandom(args.packets * 18)
+    packets = [b'\x01' + bytes([i & 0xff]) + body[i * 18:(i + 1) * 18] for i in range(args.packets)]
+    samples = args.packets * 3
+
+    t0 = time.perf_counter()
+    legacy = []
+    for data in packets:
+        for i in range((len(data) - 2) // 6):
+            legacy.append(struct.unpack('hhh', data[2 + 6 * i:8 + 6 * i]))
+    elapsed = time.perf_counter() - t0
+    _report("accel struct per sample", args.packets, elapsed, unit="packets")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        spill = os.path.join(tmp, "accel.i16")
+        capture = AccelCapture(spill_path=spill)
+        t0 = time.perf_counter()
+        for data in packets:
+            capture.write(data)
+        elapsed = time.perf_counter() - t0
+        capture.close()
+        assert capture.lost == 0 and len(open_capture(spill)) == samples
+        assert tuple(open_capture(spill)[-1]) == legacy[-1]
+    _report("accel ring + spill", args.packets, elapsed, unit="packets")
+    per_packet = elapsed / args.packets
+    print(f"{'per packet':<28} {per_packet * 1e6:10.3f} us, "
+          f"{args.band_rate * per_packet * 100:.4f}% of one core at {args.band_rate} packets/s")
+
+
+def _cold_start(argv, runs):
+    best = float("inf")
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable] + argv, cwd=HERE, check=True, stdout=subprocess.DEVNULL)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def bench_startup(args):
+    baseline = _cold_start(["-c", "pass"], args.runs)
+    print(f"{'python -c pass':<28} {baseline * 1000:10.1f} ms")
+    for name, argv in (("cli.py --help", ["cli.py", "--help"]),
+                       ("import main", ["-c", "import main"])):
+        elapsed = _cold_start(argv, args.runs)
+        print(f"{name:<28} {elapsed * 1000:10.1f} ms  (+{(elapsed - baseline) * 1000:.1f} ms)")
+    heavy = subprocess.run(
+        [sys.executable, "-c", "import sys, cli, main, fleet; "
+         "print(' '.join(m for m in ('bleak', 'Crypto', 'sqlite3', 'numpy') if m in sys.modules))"],
+        cwd=HERE, check=True, capture_output=True, text=True).stdout.strip()
+    print(f"{'heavy modules at import':<28} {heavy or 'none'}")
+    if heavy or (args.budget_ms and (elapsed - baseline) * 1000 > args.budget_ms):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    activity = subparsers.add_parser(
+        "activity", help="decode activity notifications")
+    activity.add_argument("--packets", type=int, default=20000)
+    activity.add_argument(
+        "--samples-per-packet", type=int, default=4,
+        help="4 minute samples fill a 17 byte notification")
+    activity.set_defaults(func=bench_activity)
+
+    sync = subparsers.add_parser(
+        "sync", help="auth + fetch end to end against fake_band.FakeBleakClient")
+    sync.add_argument("--minutes", type=int, default=1440 * 7)
+    sync.add_argument("--window-minutes", type=int, default=720)
+    sync.add_argument("--auth-rounds", type=int, default=20)
+    sync.add_argument("--latency", type=float, default=0.0)
+    sync.add_argument("--jitter", type=float, default=0.0)
+    sync.add_argument("--loss", type=float, default=0.0)
+    sync.set_defaults(func=bench_sync)
+
+    chunked = subparsers.add_parser(
+        "chunked", help="chunked transfer against fake_band.FakeBleakClient")
+    chunked.add_argument("--size", type=int, default=4096)
+    chunked.add_argument("--mtu", type=int, default=247)
+    chunked.add_argument("--window", type=int, default=8)
+    chunked.add_argument("--latency", type=float, default=0.0075,
+                         help="one way link latency, a write request waits twice this")
+    chunked.set_defaults(func=bench_chunked)
+
+    sensor = subparsers.add_parser(
+        "sensor", help="raw accelerometer decode into the ring buffer")
+    sensor.add_argument("--packets", type=int, default=100000)
+    sensor.add_argument("--band-rate", type=float, default=50,
+                        help="raw packets per second the band sends, for the headroom figure")
+    sensor.set_defaults(func=bench_sensor)
+
+    reconnect = subparsers.add_parser(
+        "reconnect", help="sync through link drops with supervisor.Supervisor")
+    reconnect.add_argument("--minutes", type=int, default=1440)
+    reconnect.add_argument("--drop-every", type=int, default=200,
+                           help="notifications between link drops")
+    reconnect.add_argument("--unreachable", type=int, default=2,
+                           help="failed connect attempts after every drop")
+    reconnect.add_argument("--backoff", type=float, default=0.01,
+                           help="first retry delay, doubled every failed attempt")
+    reconnect.add_argument("--latency", type=float, default=0.0)
+    reconnect.set_defaults(func=bench_reconnect)
+
+    export = subparsers.add_parser(
+        "export", help="bulk export a synthetic store to csv, arrow and parquet")
+    export.add_argument("--minutes", type=int, default=1440 * 365)
+    export.add_argument("--row-group-size", type=int, default=64 * 1024)
+    export.set_defaults(func=bench_export)
+
+    rollup = subparsers.add_parser(
+        "rollup", help="rollup maintenance and range queries over a synthetic store")
+    rollup.add_argument("--minutes", type=int, default=1440 * 365)
+    rollup.add_argument("--window", type=int, default=720, help="minutes per commit, one fetch window")
+    rollup.add_argument("--queries", type=int, default=200)
+    rollup.set_defaults(func=bench_rollup)
+
+    segments = subparsers.add_parser(
+        "segments", help="sleep/walk/workout segmentation over a synthetic history")
+    segments.add_argument("--days", type=int, default=365)
+    segments.set_defaults(func=bench_segments)
+
+    alerts = subparsers.add_parser(
+        "alerts", help="alert storm during a fetch against fake_band.FakeBleakClient")
+    alerts.add_argument("--alerts", type=int, default=2000)
+    alerts.add_argument("--keys", type=int, default=20, help="distinct alert sources")
+    alerts.add_argument("--minutes", type=int, default=1440 * 7)
+    alerts.add_argument("--interval", type=float, default=0.05,
+                        help="seconds per alert once the burst is used up")
+    alerts.add_argument("--burst", type=int, default=2)
+    alerts.add_argument("--latency", type=float, default=0.002)
+    alerts.set_defaults(func=bench_alerts)
+
+    codec = subparsers.add_parser("codec", help="per message decode/encode, legacy parsing vs codec.py")
+    codec.add_argument("--iterations", type=int, default=200000)
+    codec.add_argument("--samples-per-packet", type=int, default=4)
+    codec.set_defaults(func=bench_codec)
+
+    offload = subparsers.add_parser(
+        "offload", help="backfill into a store, decode/commit on the loop vs pipeline.py's worker")
+    offload.add_argument("--minutes", type=int, default=1440 * 90)
+    offload.add_argument("--window-minutes", type=int, default=1440)
+    offload.add_argument("--latency", type=float, default=0.0005)
+    offload.add_argument("--tick", type=float, default=0.001, help="loop lag probe interval")
+    offload.add_argument("--auth-rounds", type=int, default=20000)
+    offload.set_defaults(func=bench_offload)
+
+    status = subparsers.add_parser("status", help="dashboard polling many fake bands, reads vs status.py")
+    status.add_argument("--bands", type=int, default=20)
+    status.add_argument("--polls", type=int, default=500)
+    status.add_argument("--latency", type=float, default=0.0075)
+    status.add_argument("--ttl", type=float, default=60.0)
+    status.set_defaults(func=bench_status)
+
+    replay = subparsers.add_parser("replay", help="decoder throughput from a recorder.py capture")
+    replay.add_argument("--capture", metavar="<path>", help="replay this instead of recording a fake sync")
+    replay.add_argument("--minutes", type=int, default=1440 * 30)
+    replay.add_argument("--latency", type=float, default=0.0)
+    replay.set_defaults(func=bench_replay)
+
+    dfu = subparsers.add_parser("dfu", help="firmware upload to fake_band.FakeBleakClient")
+    dfu.add_argument("--size", type=int, default=256 * 1024)
+    dfu.add_argument("--mtu", type=int, default=247)
+    dfu.add_argument("--latency", type=float, default=0.0075)
+    dfu.add_argument("--window", type=int, default=16, help="writes in flight")
+    dfu.add_argument("--sync-every", type=int, default=100, help="packets per sync")
+    dfu.set_defaults(func=bench_dfu)
+
+    startup = subparsers.add_parser(
+        "startup", help="cold start of the cli, fails if heavy modules load eagerly")
+    startup.add_argument("--runs", type=int, default=10)
+    startup.add_argument("--budget-ms", type=float, default=0,
+                         help="also fail when 'import main' costs more than this over bare python")
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    args.func(args)
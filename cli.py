@@ -0,0 +1,305 @@
+"""
+Command Line
+------------
+
+    python cli.py sync [--store activity.db] [--start 2023-05-01] [--end 2023-05-02] [--offload]
+    python cli.py --record sync.mbr sync
+    python cli.py replay sync.mbr [--speed 1]
+    python cli.py steps
+    python cli.py battery
+    python cli.py alert <title> <message>
+    python cli.py music --artist <artist> --album <album> --track <track>
+    python cli.py music --now-playing now_playing.json
+    python cli.py explore --address <address>
+    python cli.py heart [--seconds 60]
+    python cli.py accel [--seconds 60] [--out accel.i16] [--overwrite]
+    python cli.py export activity.parquet [--start 2023-05-01] [--end 2023-06-01]
+    python cli.py dfu Mili_cinco.fw [--type watchface] [--no-reboot]
+
+The band is taken from --address/--key, falling back to secret.txt.
+--log-level sets logging verbosity and --metrics <path> writes metrics.REGISTRY
+on exit (JSON for a .json path, Prometheus text otherwise). Nothing
+heavier than argparse is imported, and no config is read, until a command runs:
+bleak and pycryptodome are only loaded by the commands that talk to a band.
+
+"""
+
+import argparse
+
+
+def _device(args):
+    if args.address and args.key:
+        return args.address, args.key
+    from main import load_secret
+    address, auth_key = load_secret(args.secret)
+    return args.address or address, args.key or auth_key
+
+
+async def _connect(args):
+    from main import Wac
+    address, auth_key = _device(args)
+    wac = Wac(address, auth_key=auth_key, record=args.record, gatt_cache_dir=args.gatt_cache_dir or None)
+    await wac.connect()
+    await wac.authenticate()
+    return wac
+
+
+async def cmd_sync(args):
+    from datetime import datetime
+    from store import ActivityStore
+
+    start = datetime.fromisoformat(args.start) if args.start else None
+    end = datetime.fromisoformat(args.end) if args.end else None
+    store = ActivityStore(args.store)
+    wac = await _connect(args)
+    try:
+        session = await wac.sync(store, start=start, end=end, offload=args.offload)
+        print(f"synced {len(session)} minutes, store ends at {store.last_minute()}")
+    finally:
+        await wac.client.disconnect()
+        store.close()
+
+
+async def cmd_steps(args):
+    from constants import UUIDS
+    wac = await _connect(args)
+    try:
+        step = await wac.createChar(UUIDS.CHARACTERISTIC_STEPS, "STEP")
+        print(await step.read())
+    finally:
+        await wac.client.disconnect()
+
+
+async def cmd_battery(args):
+    from constants import UUIDS
+    wac = await _connect(args)
+    try:
+        battery = await wac.createChar(UUIDS.CHARACTERISTIC_BATTERY)
+        print(await battery.read())
+    finally:
+        await wac.client.disconnect()
+
+
+async def cmd_alert(args):
+    from alerts import encode
+    from constants import ALERT_TYPES, UUIDS
+    wac = await _connect(args)
+    try:
+        custom_alert = await wac.createChar(UUIDS.CHARACTERISTIC_CUSTOM_ALERT)
+        kind = ALERT_TYPES.PHONE if args.phone else ALERT_TYPES.MESSAGE
+        await custom_alert.write(encode(kind, args.title, args.message), True)
+    finally:
+        await wac.client.disconnect()
+
+
+async def cmd_music(args):
+    import asyncio
+    from main import Music
+    wac = await _connect(args)
+    try:
+        music = Music(wac.client, args.artist, args.album, args.track, registry=wac.registry)
+        if args.now_playing:
+            from now_playing import FileSource, MusicSync
+            sync = MusicSync(music, FileSource(args.now_playing))
+            await sync.start()
+            # follow the file until interrupted
+            await asyncio.Event().wait()
+        else:
+            await music.init_handler()
+            await music.set_music()
+    finally:
+        await wac.client.disconnect()
+
+
+async def cmd_heart(args):
+    import asyncio
+    from heart_rate import HeartRateMonitor
+    wac = await _connect(args)
+    monitor = HeartRateMonitor(wac.client, registry=wac.registry)
+    try:
+        await monitor.start()
+        for _ in range(int(args.seconds // args.every)):
+            await asyncio.sleep(args.every)
+            print(monitor.buffer.stats())
+        await monitor.stop()
+    finally:
+        await wac.client.disconnect()
+
+
+async def cmd_accel(args):
+    import asyncio
+    from sensor import AccelCapture, SensorStream
+    # an existing --out fails here, before connecting
+    capture = AccelCapture(spill_path=args.out, overwrite=args.overwrite)
+    wac = await _connect(args)
+    stream = SensorStream(wac.client, capture, registry=wac.registry)
+    try:
+        await stream.start()
+        await asyncio.sleep(args.seconds)
+        await stream.stop()
+        capture = stream.capture
+        print(f"captured {capture.count} samples in {capture.packets} packets, {capture.lost} lost")
+    finally:
+        await wac.client.disconnect()
+
+
+async def cmd_export(args):
+    from datetime import datetime
+    from export import export_range
+    from store import ActivityStore
+
+    store = ActivityStore(args.store)
+    try:
+        rows, rate = export_range(
+            store, args.out,
+            datetime.fromisoformat(args.start) if args.start else None,
+            datetime.fromisoformat(args.end) if args.end else None,
+            args.format, args.row_group_size)
+    finally:
+        store.close()
+    print(f"exported {rows} rows to {args.out}, {rate:,.0f} rows/s")
+
+
+async def cmd_dfu(args):
+    from dfu import Uploader
+    wac = await _connect(args)
+    try:
+        uploader = Uploader(wac.client, args.image, registry=wac.registry, image_type=args.type,
+                            window=args.window, sync_every=args.sync_every)
+        result = await uploader.upload(
+            progress=lambda sent, total: print(f"\r{sent}/{total} bytes", end="", flush=True),
+            reboot=False if args.no_reboot else None)
+        print(f"\nuploaded {result['bytes']} bytes (crc {result['crc']:#06x}) "
+              f"at {result['bytes_per_second']:,.0f} B/s")
+    finally:
+        await wac.client.disconnect()
+
+
+async def cmd_replay(args):
+    import time
+    from datetime import datetime
+    from main import Wac, from_minute
+    from recorder import ReplayClient
+    client = ReplayClient(args.capture, speed=args.speed, strict=not args.loose)
+    wac = Wac(args.capture, auth_key=bytes(16).hex(), client=client)
+    await wac.connect()
+    # the band's answers are recorded, any key gets through the auth replay
+    await wac.authenticate()
+    t0 = time.perf_counter()
+    start, end = client.fetch_range()
+    session = await wac.sync(start=datetime.fromisoformat(args.start) if args.start else start, end=end)
+    elapsed = time.perf_counter() - t0
+    print(f"replayed {len(session)} minutes from {from_minute(session.start_minute)} "
+          f"({client.delivered} notifications) in {elapsed:.3f}s")
+
+
+async def cmd_explore(args):
+    import service_explorer
+    if not (args.address or args.name):
+        args.address = _device(args)[0]
+    await service_explorer.main(args)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Mi Band 4 tools")
+    parser.add_argument("--address", metavar="<address>", help="band address, default from secret file")
+    parser.add_argument("--key", metavar="<hex>", help="auth key, default from secret file")
+    parser.add_argument("--secret", metavar="<path>", default="secret.txt",
+                        help="file with the address and auth key on two lines")
+    parser.add_argument("--log-level", default="WARNING",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--metrics", metavar="<path>", help="write metrics here on exit")
+    parser.add_argument("--record", metavar="<path>", help="capture all GATT traffic here, see recorder.py")
+    parser.add_argument("--gatt-cache-dir", metavar="<dir>", default="gatt_cache",
+                        help="reuse cached GATT tables on connect, empty to always discover")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sync = subparsers.add_parser("sync", help="fetch activity into the local store")
+    sync.add_argument("--store", metavar="<path>", default="activity.db")
+    sync.add_argument("--start", metavar="<iso date>", help="backfill from here instead of resuming")
+    sync.add_argument("--end", metavar="<iso date>")
+    sync.add_argument("--offload", action="store_true", help="decode and store on a worker thread, for long backfills")
+    sync.set_defaults(func=cmd_sync)
+
+    steps = subparsers.add_parser("steps", help="read today's steps")
+    steps.set_defaults(func=cmd_steps)
+
+    battery = subparsers.add_parser("battery", help="read the battery level")
+    battery.set_defaults(func=cmd_battery)
+
+    alert = subparsers.add_parser("alert", help="show a custom alert")
+    alert.add_argument("title")
+    alert.add_argument("message")
+    alert.add_argument("--phone", action="store_true", help="show it as an incoming call")
+    alert.set_defaults(func=cmd_alert)
+
+    music = subparsers.add_parser("music", help="push now playing metadata")
+    music.add_argument("--artist", default="")
+    music.add_argument("--album", default="")
+    music.add_argument("--track", default="")
+    music.add_argument("--now-playing", help="JSON file to follow, see now_playing.py")
+    music.set_defaults(func=cmd_music)
+
+    heart = subparsers.add_parser("heart", help="monitor heart rate continuously")
+    heart.add_argument("--seconds", type=float, default=60)
+    heart.add_argument("--every", type=float, default=5, help="print rolling stats this often")
+    heart.set_defaults(func=cmd_heart)
+
+    accel = subparsers.add_parser("accel", help="capture raw accelerometer data")
+    accel.add_argument("--seconds", type=float, default=60)
+    accel.add_argument("--out", metavar="<path>", default="accel.i16",
+                       help="int16 x/y/z spill file, read back with sensor.open_capture")
+    accel.add_argument("--overwrite", action="store_true", help="replace an existing --out file")
+    accel.set_defaults(func=cmd_accel)
+
+    export = subparsers.add_parser("export", help="write stored activity to csv, arrow or parquet")
+    export.add_argument("out", metavar="<path>", help="the format follows the suffix unless --format is given")
+    export.add_argument("--store", metavar="<path>", default="activity.db")
+    export.add_argument("--start", metavar="<iso date>")
+    export.add_argument("--end", metavar="<iso date>")
+    export.add_argument("--format", choices=["csv", "arrow", "parquet"])
+    export.add_argument("--row-group-size", type=int, default=64 * 1024)
+    export.set_defaults(func=cmd_export)
+
+    dfu = subparsers.add_parser("dfu", help="upload firmware, resources or a watchface, see dfu.py")
+    dfu.add_argument("image", metavar="<path>")
+    dfu.add_argument("--type", default="firmware", choices=["firmware", "font", "resources", "gps", "watchface"])
+    dfu.add_argument("--no-reboot", action="store_true", help="firmware reboots the band unless this is given")
+    dfu.add_argument("--window", type=int, default=16, help="writes in flight")
+    dfu.add_argument("--sync-every", type=int, default=100, help="packets per sync")
+    dfu.set_defaults(func=cmd_dfu)
+
+    replay = subparsers.add_parser("replay", help="rerun a sync from a --record capture")
+    replay.add_argument("capture", metavar="<path>")
+    replay.add_argument("--start", metavar="<iso date>", help="default what the recorded sync asked for")
+    replay.add_argument("--speed", type=float, help="1 is the recorded pace, default as fast as possible")
+    replay.add_argument("--loose", action="store_true", help="skip recorded requests the replay does not make")
+    replay.set_defaults(func=cmd_replay)
+
+    explore = subparsers.add_parser("explore", help="dump the GATT table, see service_explorer.py")
+    explore.add_argument("--name", metavar="<name>")
+    explore.add_argument("--macos-use-bdaddr", action="store_true")
+    explore.add_argument("--services", nargs="+", metavar="<uuid>")
+    explore.add_argument("--limit", type=int, default=8, help="reads in flight at once")
+    explore.add_argument("--specs", metavar="<path>", default="specs.txt")
+    explore.add_argument("--cache-dir", metavar="<dir>", default="gatt_cache",
+                         help="GATT tables cached per band and firmware revision")
+    explore.set_defaults(func=cmd_explore)
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+
+    import asyncio
+    import logging
+    logging.basicConfig(
+        level=args.log_level,
+        format="%(asctime)-15s %(name)-8s %(levelname)s: %(message)s",
+    )
+    try:
+        asyncio.run(args.func(args))
+    finally:
+        if args.metrics:
+            from metrics import REGISTRY
+            REGISTRY.write(args.metrics)
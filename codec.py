@@ -0,0 +1,118 @@
+"""
+Payload Codec
+-------------
+
+Byte layouts of the characteristic payloads main.py reads and writes, one
+precompiled struct.Struct each. decode() is an unpack_from on whatever buffer
+bleak handed over (bytes, bytearray or a memoryview into it), nothing is
+sliced first, and returns a namedtuple; encode() packs the fields back,
+keyword or positional, with constant fields (command bytes) filled in.
+
++ STEPS: 0x0c, steps, meters, calories, all uint32
++ BATTERY: 0x0f, level %, charging, when it was last unplugged and last
+  charged (year .. second, timezone), the level it was charged to
++ CURRENT_TIME: year .. second, weekday, 1/256 s, adjust reason, timezone
++ FETCH_START: 0x01 0x01 <since> on CHARACTERISTIC_FETCH, FETCH_ACK the band's
+  0x10 0x01 0x01 <count> <actual start>
++ ACTIVITY: the packet counter, ACTIVITY_SAMPLE the 4 bytes per minute after
+  it (ActivityBatch.decode reads those column-wise)
+
+Timezones are signed quarter hours. Payloads recorded in specs.txt are listed
+in SPEC_MESSAGES and decode() picks the layout from the characteristic:
+
+    CURRENT_TIME.decode(b'\\xe7\\x07\\x05\\x16\\x05\\x18+\\x01\\x00\\x00\\x1c').tz  # 28, UTC+7
+    FETCH_START.encode(year=2023, month=5, day=22, hour=0, minute=0, tz=28)
+
+"""
+
+import struct
+
+from collections import namedtuple
+from datetime import datetime
+
+from constants import UUIDS
+
+
+class Message:
+    """
+    + a struct format and a name per field, little endian throughout
+    + constants are fields with a fixed value, encode() fills them in and
+      decode() checks them
+    + defaults are only filled in by encode()
+    """
+
+    def __init__(self, name, fmt, fields, constants=None, defaults=None) -> None:
+        self.name = name
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+        self.fields = tuple(fields)
+        self.type = namedtuple(name, self.fields)
+        self.constants = dict(constants or {})
+        self.defaults = {**(defaults or {}), **self.constants}
+        self._checks = tuple((self.fields.index(field), value) for field, value in self.constants.items())
+
+    def decode(self, data, offset=0):
+        try:
+            values = self.struct.unpack_from(data, offset)
+        except struct.error:
+            raise ValueError(f"{self.name} needs {self.size} bytes, got {len(data) - offset}") from None
+        for index, value in self._checks:
+            if values[index] != value:
+                raise ValueError(f"{self.name}: {self.fields[index]} is {values[index]:#04x}, expected {value:#04x}")
+        return self.type._make(values)
+
+    def encode(self, *values, **fields):
+        if values:
+            return self.struct.pack(*values)
+        fields = {**self.defaults, **fields}
+        return self.struct.pack(*(fields[field] for field in self.fields))
+
+    def encode_into(self, buffer, offset, *values):
+        self.struct.pack_into(buffer, offset, *values)
+
+
+_DATETIME = ("year", "month", "day", "hour", "minute", "second")
+
+STEPS = Message("Steps", "<BIII", ("flags", "steps", "meters", "calories"), {"flags": 0x0c})
+BATTERY = Message(
+    "Battery", "<BBBHBBBBBbHBBBBBbB",
+    ("flags", "level", "charging")
+    + tuple("off_" + field for field in _DATETIME) + ("off_tz",)
+    + tuple("charged_" + field for field in _DATETIME) + ("charged_tz", "charged_level"),
+    {"flags": 0x0f})
+CURRENT_TIME = Message(
+    "CurrentTime", "<HBBBBBBBBb", _DATETIME + ("weekday", "fractions", "adjust_reason", "tz"))
+FETCH_START = Message(
+    "FetchStart", "<BBHBBBBBb", ("command", "type", "year", "month", "day", "hour", "minute", "dst", "tz"),
+    {"command": 0x01, "type": 0x01}, {"dst": 0})
+FETCH_ACK = Message(
+    "FetchAck", "<BBBIHBBBBBb",
+    ("response", "command", "status", "count", "year", "month", "day", "hour", "minute", "second", "tz"),
+    {"response": 0x10, "command": 0x01})
+ACTIVITY = Message("Activity", "<B", ("counter",))
+ACTIVITY_SAMPLE = Message("ActivitySample", "<BBBB", ("category", "intensity", "steps", "heart_rate"))
+
+SPEC_MESSAGES = {
+    UUIDS.CHARACTERISTIC_STEPS: STEPS,
+    UUIDS.CHARACTERISTIC_BATTERY: BATTERY,
+    UUIDS.CHARACTERISTIC_CURRENT_TIME.lower(): CURRENT_TIME,
+}
+
+
+def decode(char_uuid, data):
+    """Decode a payload read from char_uuid with its layout from SPEC_MESSAGES."""
+    return SPEC_MESSAGES[char_uuid.lower()].decode(data)
+
+
+def timestamp(message, prefix=""):
+    """The datetime in a decoded message, prefix picks one of BATTERY's two."""
+    return datetime(*(getattr(message, prefix + field, 0) for field in _DATETIME))
+
+
+def fetch_start(since: datetime, tz):
+    return FETCH_START.struct.pack(0x01, 0x01, since.year, since.month, since.day, since.hour, since.minute, 0, tz)
+
+
+def activity_samples(data):
+    """(category, intensity, steps, heart_rate) per minute of an activity packet."""
+    return ACTIVITY_SAMPLE.struct.iter_unpack(memoryview(data)[ACTIVITY.size:])
@@ -61,6 +61,8 @@ class AUTH_STATES(object):
 
     __metaclass__ = Immutable
 
+    REQUESTING_RN = "Requesting random number"
+    SENDING_ENCRYPTED_KEY = "Sending encrypted random number"
     AUTH_OK = "Auth ok"
     AUTH_FAILED = "Auth failed"
     ENCRYPTION_KEY_FAILED = "Encryption key auth fail, sending new key"
@@ -68,6 +70,30 @@ class AUTH_STATES(object):
     REQUEST_RN_ERROR = "Something went wrong when requesting the random number"
 
 
+class FETCH_STATES(object):
+
+    __metaclass__ = Immutable
+
+    IDLE = "Idle"
+    REQUESTED = "Fetch requested"
+    TRANSFERRING = "Transferring activity data"
+    WINDOW_DONE = "Fetch window done"
+    NO_DATA = "No more activity data"
+
+
+class SYNC_STATES(object):
+
+    __metaclass__ = Immutable
+
+    IDLE = "Idle"
+    WAITING = "Waiting for adapter"
+    CONNECTING = "Connecting"
+    AUTHENTICATING = "Authenticating"
+    SYNCING = "Syncing"
+    DONE = "Synced"
+    FAILED = "Sync failed"
+
+
 class ALERT_TYPES(object):
 
     __metaclass__ = Immutable
@@ -83,6 +109,18 @@ class MUSIC_STATE(object):
 
     PLAYED = 0
     PAUSED = 1
+    # device event 0xfe <command> is a music command from the band
+    CONTROL = 0xfe
+
+
+class ACTIVITY_CATEGORIES(object):
+
+    __metaclass__ = Immutable
+
+    NOT_WORN = 3
+    CHARGING = 6
+    LIGHT_SLEEP = 112
+    DEEP_SLEEP = 122
 
 
 class QUEUE_TYPES(object):
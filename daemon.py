@@ -0,0 +1,337 @@
+"""
+Band Daemon
+-----------
+
+Keeps one authenticated connection per band open and serves commands over a
+unix socket, one JSON object per line in each direction, so a command costs a
+GATT round trip instead of a scan, connect and auth handshake.
+
+    python daemon.py serve devices.txt
+    python daemon.py send steps --device kitchen
+    python daemon.py send alert --device kitchen --title hi --message there
+
+Requests look like {"cmd": "steps", "device": "kitchen"}; every reply carries
+"ok" and the server side "latency_ms". Alerts go through a per band
+alerts.AlertDispatcher, the reply says whether one was queued, coalesced or
+dropped. Steps and battery come from a per band status.DeviceStatus fed by
+notifications, "status" returns all of it without touching the band.
+"stats" returns latency percentiles per
+command, "metrics" the metrics.REGISTRY snapshot.
+
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import time
+
+from collections import defaultdict, deque
+
+from alerts import AlertDispatcher
+from constants import ALERT_TYPES, UUIDS
+from fleet import Device, default_store, load_registry
+from main import RECONNECTS, Music, Wac, load_secret
+from metrics import REGISTRY
+from now_playing import normalize
+from status import DeviceStatus
+
+logger = logging.getLogger(__name__)
+
+SOCKET_PATH = "/tmp/miband4.sock"
+KEEPALIVE_INTERVAL = 30.0
+LATENCY_SAMPLES = 1000
+
+
+class Band:
+    def __init__(self, device: Device, wac_factory=Wac, gatt_cache_dir=None) -> None:
+        if gatt_cache_dir is not None:
+            wac_factory = functools.partial(wac_factory, gatt_cache_dir=gatt_cache_dir)
+        self.device = device
+        self.wac_factory = wac_factory
+        self.wac = None
+        self.lock = asyncio.Lock()
+        self.chars = {}
+        self.music = None
+        self.status = None
+        self.reconnects = 0
+        self.was_connected = False
+        self.alerts = AlertDispatcher(self._write_alert)
+
+    @property
+    def connected(self):
+        # a Wac whose scan or connect failed has no client
+        return self.wac is not None and self.wac.client is not None and self.wac.client.is_connected
+
+    async def ensure_connected(self):
+        if self.connected:
+            return self.wac
+        self.chars.clear()
+        if self.music is not None:
+            self.music.cancel()
+        self.music = None
+        wac = self.wac_factory(self.device.address, auth_key=self.device.auth_key,
+                               disconnected_callback=self._on_disconnect)
+        try:
+            await wac.connect()
+            await wac.authenticate()
+            status = await DeviceStatus(wac).start()
+        except Exception:
+            # half set up is not connected, the next command starts over
+            if wac.client is not None and wac.client.is_connected:
+                await wac.client.disconnect()
+            raise
+        self.wac, self.status = wac, status
+        if self.was_connected:
+            # only a link that was up and came back counts, not failed attempts
+            self.reconnects += 1
+            RECONNECTS.inc()
+        self.was_connected = True
+        return self.wac
+
+    def _on_disconnect(self, _client):
+        # a debounced music update would only fail on the dead link
+        if self.music is not None:
+            self.music.cancel()
+
+    async def read_status(self, name):
+        # fresh values don't need the band, or its lock
+        if self.status is not None and self.connected and self.status.fresh(name):
+            return await self.status.get(name)
+        async with self.lock:
+            await self.ensure_connected()
+            return await self.status.get(name)
+
+    async def char(self, uuid, special_type=None):
+        if uuid not in self.chars:
+            self.chars[uuid] = await self.wac.createChar(uuid, special_type)
+        return self.chars[uuid]
+
+    async def _write_alert(self, payload):
+        # alerts queue behind a running sync instead of interleaving with it
+        async with self.lock:
+            await self.ensure_connected()
+            await (await self.char(UUIDS.CHARACTERISTIC_CUSTOM_ALERT)).write(payload, True)
+
+    async def _write_music(self, payload):
+        # debounced sends run on their own, they too wait for a running sync
+        async with self.lock:
+            if not self.connected or self.music is None:
+                raise ConnectionError(f"{self.device.name} is not connected")
+            await self.music.chunked.write(3, payload)
+
+    async def close(self):
+        await self.alerts.stop()
+        if self.music is not None:
+            self.music.cancel()
+        if self.connected:
+            await self.wac.client.disconnect()
+
+
+class Daemon:
+    def __init__(self, devices, path=SOCKET_PATH, keepalive=KEEPALIVE_INTERVAL,
+                 store_factory=default_store, wac_factory=Wac, gatt_cache_dir=None) -> None:
+        self.bands = {d.name: Band(d, wac_factory, gatt_cache_dir) for d in devices}
+        self.path = path
+        self.keepalive = keepalive
+        self.store_factory = store_factory
+        self.stores = {}
+        self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+        self.server = None
+        self.tasks = []
+
+    def band(self, name):
+        if name is None and len(self.bands) == 1:
+            return next(iter(self.bands.values()))
+        if name not in self.bands:
+            raise KeyError(f"unknown device {name!r}")
+        return self.bands[name]
+
+    async def start(self):
+        for band in self.bands.values():
+            try:
+                async with band.lock:
+                    await band.ensure_connected()
+            except Exception as e:
+                logger.warning("%s: %r, will retry on first command", band.device.name, e)
+            self.tasks.append(asyncio.ensure_future(self._keepalive(band)))
+            band.alerts.start()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._handle, path=self.path)
+        logger.info("listening on %s", self.path)
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for band in self.bands.values():
+            await band.close()
+        for store in self.stores.values():
+            store.close()
+
+    async def _keepalive(self, band: Band):
+        # a cheap read keeps the link from idling out and notices drops early
+        while True:
+            await asyncio.sleep(self.keepalive)
+            try:
+                async with band.lock:
+                    await band.ensure_connected()
+                    await band.status.refresh("battery")
+            except Exception as e:
+                logger.warning("%s: keepalive failed %r", band.device.name, e)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    reply = await self.execute(json.loads(line))
+                except json.JSONDecodeError as e:
+                    reply = {"ok": False, "error": f"bad request: {e}"}
+                # battery timestamps are datetimes
+                writer.write(json.dumps(reply, default=str).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def execute(self, request):
+        cmd = request.get("cmd")
+        handler = getattr(self, f"cmd_{cmd}", None)
+        t0 = time.perf_counter()
+        try:
+            if handler is None:
+                raise KeyError(f"unknown command {cmd!r}")
+            reply = {"ok": True, "result": await handler(request)}
+        except Exception as e:
+            reply = {"ok": False, "error": repr(e)}
+        latency = time.perf_counter() - t0
+        self.latencies[cmd].append(latency)
+        reply["latency_ms"] = latency * 1000
+        return reply
+
+    async def _on_band(self, request, operation):
+        band = self.band(request.get("device"))
+        async with band.lock:
+            await band.ensure_connected()
+            return await operation(band)
+
+    async def cmd_ping(self, request):
+        return {name: band.connected for name, band in self.bands.items()}
+
+    async def cmd_steps(self, request):
+        return await self.band(request.get("device")).read_status("steps")
+
+    async def cmd_battery(self, request):
+        return await self.band(request.get("device")).read_status("battery")
+
+    async def cmd_status(self, request):
+        band = self.band(request.get("device"))
+        return band.status.snapshot() if band.status is not None else None
+
+    async def cmd_alert(self, request):
+        # queued, a storm of alerts can't hold the band lock
+        kind = ALERT_TYPES.PHONE if request.get("kind") == "phone" else ALERT_TYPES.MESSAGE
+        band = self.band(request.get("device"))
+        return band.alerts.notify(kind, request.get("title", ""), request.get("message", ""), request.get("key"))
+
+    async def cmd_music(self, request):
+        async def push(band):
+            if band.music is None:
+                # the music characteristic is the device event one status listens to
+                band.music = Music(band.wac.client, registry=band.wac.registry, hub=band.status.hub,
+                                   write=band._write_music)
+                await band.music.init_handler()
+            # debounced, repeated or position only updates cost nothing
+            band.music.update(**normalize(request))
+            return {"sends": band.music.sends, "skipped": band.music.skipped}
+        return await self._on_band(request, push)
+
+    async def cmd_sync(self, request):
+        async def sync(band):
+            if band.device.address not in self.stores:
+                self.stores[band.device.address] = self.store_factory(band.device)
+            session = await band.wac.sync(self.stores[band.device.address])
+            return {"minutes": len(session)}
+        return await self._on_band(request, sync)
+
+    async def cmd_stats(self, request):
+        stats = {}
+        for cmd, samples in self.latencies.items():
+            ordered = sorted(samples)
+            stats[cmd] = {
+                "count": len(ordered),
+                "mean_ms": sum(ordered) / len(ordered) * 1000,
+                "p50_ms": ordered[len(ordered) // 2] * 1000,
+                "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+            }
+        stats["reconnects"] = {name: band.reconnects for name, band in self.bands.items()}
+        stats["alerts"] = {name: band.alerts.stats() for name, band in self.bands.items()}
+        return stats
+
+    async def cmd_metrics(self, request):
+        return REGISTRY.snapshot()
+
+
+async def send(request, path=SOCKET_PATH):
+    reader, writer = await asyncio.open_unix_connection(path)
+    try:
+        writer.write(json.dumps(request).encode() + b"\n")
+        await writer.drain()
+        return json.loads(await reader.readline())
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def serve(args: argparse.Namespace):
+    if args.registry:
+        devices = load_registry(args.registry)
+    else:
+        devices = [Device(*load_secret())]
+    daemon = Daemon(devices, path=args.socket, keepalive=args.keepalive,
+                    gatt_cache_dir=args.gatt_cache_dir or None)
+    await daemon.start()
+    try:
+        await daemon.server.serve_forever()
+    finally:
+        await daemon.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", metavar="<path>", default=SOCKET_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="run the daemon")
+    serve_parser.add_argument("registry", nargs="?", metavar="<registry>",
+                              help="fleet.py registry, default is the band in secret.txt")
+    serve_parser.add_argument("--keepalive", type=float, default=KEEPALIVE_INTERVAL)
+    serve_parser.add_argument("--gatt-cache-dir", metavar="<dir>", default="gatt_cache",
+                              help="reuse cached GATT tables on connect, empty to always discover")
+
+    send_parser = subparsers.add_parser("send", help="send one command to a running daemon")
+    send_parser.add_argument("cmd", choices=["ping", "steps", "battery", "status", "alert", "music", "sync", "stats",
+                                             "metrics"])
+    send_parser.add_argument("--device", metavar="<name>")
+    for field in ("title", "message", "key", "artist", "album", "track"):
+        send_parser.add_argument(f"--{field}")
+    send_parser.add_argument("--kind", choices=["message", "phone"], help="alert type, default message")
+
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)-15s %(name)-8s %(levelname)s: %(message)s",
+    )
+    if args.command == "serve":
+        asyncio.run(serve(args))
+    else:
+        request = {k: v for k, v in vars(args).items()
+                   if v is not None and k not in ("socket", "command")}
+        print(json.dumps(asyncio.run(send(request, args.socket)), indent=2))
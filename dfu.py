@@ -0,0 +1,196 @@
+"""
+Firmware Upload
+---------------
+
+Uploads a firmware, resource or watchface image over the DFU service
+(SERVICE_DFU_FIRMWARE). Commands go to CHARACTERISTIC_DFU_FIRMWARE and are
+answered there with 0x10 <command> <status>, the image itself is written
+without response to CHARACTERISTIC_DFU_FIRMWARE_WRITE:
+
++ 0x01 <size, 3 bytes> [<type>]: announce the image, the type byte only for
+  anything but firmware (IMAGE_TYPES)
++ 0x03: start of data, then the image in MTU sized packets
++ 0x00: sync, sent every `sync_every` packets and after the last one
++ 0x04 <crc16>: CRC-16/CCITT-FALSE of the whole image, the band checks it
++ 0x05: reboot into the new firmware
+
+The image is memory-mapped and packets are slices of a memoryview over it, so
+nothing is copied before bleak gets it. The CRC is updated from the same
+slices as they go out. At most `window` writes are in flight, and the next
+sync segment streams while the band still has to acknowledge the previous
+one, so a round trip is paid once per upload rather than once per sync.
+
+    uploader = Uploader(wac.client, "Mili_cinco.fw", registry=wac.registry)
+    result = await uploader.upload(progress=lambda sent, total: print(sent, total))
+
+"""
+
+import asyncio
+import binascii
+import logging
+import mmap
+import struct
+import time
+
+from collections import deque
+from constants import UUIDS
+from main import DEFAULT_TIMEOUT, SUCCESS, Characteristic, ProtocolError, resolve
+from metrics import DURATION_BUCKETS, REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DFU_BYTES = REGISTRY.counter("miband_dfu_bytes_total", "image bytes written over DFU")
+DFU_SECONDS = REGISTRY.histogram("miband_dfu_upload_seconds", "DFU upload duration", DURATION_BUCKETS)
+
+COMMAND_SYNC = 0x00
+COMMAND_INIT = 0x01
+COMMAND_START = 0x03
+COMMAND_CHECKSUM = 0x04
+COMMAND_REBOOT = 0x05
+IMAGE_TYPES = {"firmware": 0x00, "font": 0x01, "resources": 0x02, "gps": 0x03, "watchface": 0x08}
+# size goes out in 3 bytes
+MAX_IMAGE_SIZE = 0xffffff
+SYNC_EVERY = 100
+DFU_WINDOW = 16
+# ATT write header
+ATT_HEADER = 3
+CRC_INIT = 0xffff
+
+
+def crc16(data, crc=CRC_INIT):
+    """CRC-16/CCITT-FALSE, pass the previous result as crc to continue it."""
+    return binascii.crc_hqx(data, crc)
+
+
+class DfuControl(Characteristic):
+    async def write(self, value, response=True):
+        # the control point is write-with-response only
+        await super().write(value, response=response)
+
+    def _callback(self, _, data):
+        super()._callback(_, data)
+        if not self._resolve(data):
+            logger.warning("unexpected data on DFU control %r", bytes(data))
+
+    async def command(self, payload, timeout=DEFAULT_TIMEOUT * 4):
+        data = await self.request(payload, payload[0], timeout, retries=0)
+        if data[2] != SUCCESS:
+            raise ProtocolError(f"DFU command {payload[0]:#04x} failed with status {data[2]:#04x}")
+        return data
+
+
+class Uploader:
+    """
+    + upload() runs init, start, the data and the checksum, reboot=True ends
+      with a reboot (leave it off for watchfaces and resources)
+    + progress(sent, total) is called after every sync segment
+    + sent, crc and bytes_per_second describe the last upload
+    """
+
+    def __init__(self, client, path, registry=None, image_type="firmware",
+                 window=DFU_WINDOW, sync_every=SYNC_EVERY) -> None:
+        if image_type not in IMAGE_TYPES:
+            raise ValueError(f"unknown image type {image_type!r}")
+        self.client = client
+        self.path = path
+        self.image_type = image_type
+        self.window = window
+        self.sync_every = sync_every
+        self.control = DfuControl(resolve(registry, UUIDS.CHARACTERISTIC_DFU_FIRMWARE), client)
+        self.data_char = resolve(registry, UUIDS.CHARACTERISTIC_DFU_FIRMWARE_WRITE)
+        self.sent = 0
+        self.crc = CRC_INIT
+        self.bytes_per_second = None
+
+    def packet_length(self):
+        mtu = getattr(self.client, "mtu_size", None) or 23
+        return mtu - ATT_HEADER
+
+    def _init_payload(self, size):
+        payload = bytes((COMMAND_INIT,)) + struct.pack("<I", size)[:3]
+        if self.image_type != "firmware":
+            payload += bytes((IMAGE_TYPES[self.image_type],))
+        return payload
+
+    async def upload(self, progress=None, reboot=None):
+        if reboot is None:
+            reboot = self.image_type == "firmware"
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as image:
+            size = len(image)
+            if size > MAX_IMAGE_SIZE:
+                raise ValueError(f"{self.path} is {size} bytes, at most {MAX_IMAGE_SIZE} fit the init command")
+            await self.control.init_handler()
+            t0 = time.perf_counter()
+            await self.control.command(self._init_payload(size))
+            await self.control.command(bytes((COMMAND_START,)))
+            with memoryview(image) as view:
+                await self._stream(view, progress)
+        await self.control.command(bytes((COMMAND_CHECKSUM,)) + struct.pack("<H", self.crc))
+        elapsed = time.perf_counter() - t0
+        self.bytes_per_second = size / elapsed if elapsed > 0 else float("inf")
+        DFU_SECONDS.observe(elapsed)
+        logger.info("uploaded %s (%d bytes, crc %#06x) at %.0f B/s", self.path, size, self.crc, self.bytes_per_second)
+        if reboot:
+            await self.control.command(bytes((COMMAND_REBOOT,)))
+        return {"bytes": size, "crc": self.crc, "seconds": elapsed, "bytes_per_second": self.bytes_per_second}
+
+    async def _stream(self, view, progress):
+        total = len(view)
+        length = self.packet_length()
+        # (write, packet): a packet is released once its write is done, the
+        # image can't be unmapped while any slice of it is still around
+        in_flight = deque()
+        synced = None
+        reported = 0
+        self.sent = 0
+        self.crc = CRC_INIT
+        try:
+            for count, offset in enumerate(range(0, total, length), 1):
+                packet = view[offset:offset + length]
+                in_flight.append((asyncio.ensure_future(
+                    self.client.write_gatt_char(self.data_char, packet, response=False)), packet))
+                self.crc = crc16(packet, self.crc)
+                self.sent = offset + len(packet)
+                del packet
+                if len(in_flight) >= self.window:
+                    await self._written(in_flight)
+                if count % self.sync_every and self.sent < total:
+                    continue
+                while in_flight:
+                    await self._written(in_flight)
+                # the previous segment's ack has had this whole segment to arrive
+                if synced is not None:
+                    await self._synced(synced)
+                synced = self.control._expect(COMMAND_SYNC)
+                await self.control.write(bytes((COMMAND_SYNC,)))
+                DFU_BYTES.inc(self.sent - reported)
+                reported = self.sent
+                if progress is not None:
+                    progress(self.sent, total)
+            if synced is not None:
+                await self._synced(synced)
+        finally:
+            # a failed write leaves the others in flight, holding their packets
+            for write, _ in in_flight:
+                write.cancel()
+            await asyncio.gather(*(write for write, _ in in_flight), return_exceptions=True)
+            for _, packet in in_flight:
+                packet.release()
+            in_flight.clear()
+            self.control._pending.pop(COMMAND_SYNC, None)
+
+    @staticmethod
+    async def _written(in_flight):
+        write, packet = in_flight[0]
+        await write
+        in_flight.popleft()
+        packet.release()
+
+    async def _synced(self, future, timeout=DEFAULT_TIMEOUT * 4):
+        try:
+            data = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.control._pending.pop(COMMAND_SYNC, None)
+            raise ProtocolError(f"DFU sync not acknowledged after {self.sent} bytes")
+        if data[2] != SUCCESS:
+            raise ProtocolError(f"DFU sync failed after {self.sent} bytes with status {data[2]:#04x}")
@@ -0,0 +1,187 @@
+"""
+Activity Export
+---------------
+
+Streams decoded activity to CSV, Arrow IPC or Parquet, one row per minute:
+
+    timestamp, category, intensity, steps, heart_rate
+
+Writers take ActivityBatch objects as they come (from a sync, a stream() or
+the store) and flush every `row_group_size` rows, so memory stays bounded by
+one row group whatever the length of the history. Arrow and Parquet need
+pyarrow, which is only imported when such a writer is opened; their columns
+are built straight from the batch buffers, without a Python object per value.
+
+    with open_writer("activity.parquet") as writer:
+        for batch in store.batches(start, end, size=ROW_GROUP_SIZE):
+            writer.write(batch)
+
+    python cli.py export activity.parquet --start 2024-01-01
+
+"""
+
+import csv
+import time
+
+from array import array
+from datetime import datetime
+
+from main import ActivityBatch, from_minute, to_minute
+
+ROW_GROUP_SIZE = 64 * 1024
+COLUMNS = ("timestamp", "category", "intensity", "steps", "heart_rate")
+FORMATS = {".csv": "csv", ".arrow": "arrow", ".ipc": "arrow", ".feather": "arrow", ".parquet": "parquet"}
+
+
+class Writer:
+    def __init__(self, path, row_group_size=ROW_GROUP_SIZE) -> None:
+        self.path = path
+        self.row_group_size = row_group_size
+        self.rows = 0
+        self.row_groups = 0
+        self._pending = []
+        self._pending_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def write(self, batch: ActivityBatch):
+        while len(batch):
+            take = min(len(batch), self.row_group_size - self._pending_rows)
+            if take < len(batch):
+                head, batch = _split(batch, take)
+            else:
+                head, batch = batch, ActivityBatch(batch.end_minute)
+            self._pending.append(head)
+            self._pending_rows += take
+            if self._pending_rows == self.row_group_size:
+                self.flush()
+
+    def flush(self):
+        if self._pending_rows:
+            self._write_group(self._pending)
+            self.rows += self._pending_rows
+            self.row_groups += 1
+        self._pending = []
+        self._pending_rows = 0
+
+    def _write_group(self, batches):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+
+def _split(batch: ActivityBatch, n):
+    return (ActivityBatch(batch.start_minute, batch.category[:n], batch.intensity[:n],
+                          batch.steps[:n], batch.heart_rate[:n]),
+            ActivityBatch(batch.start_minute + n, batch.category[n:], batch.intensity[n:],
+                          batch.steps[n:], batch.heart_rate[n:]))
+
+
+class CsvWriter(Writer):
+    def __init__(self, path, row_group_size=ROW_GROUP_SIZE) -> None:
+        super().__init__(path, row_group_size)
+        self.file = open(path, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(COLUMNS)
+
+    def _write_group(self, batches):
+        rows = []
+        current = day = None
+        for batch in batches:
+            for minute, *values in batch.rows():
+                # epoch minutes start at midnight, only a new day needs a datetime
+                days, m = divmod(minute, 1440)
+                if days != current:
+                    current, day = days, from_minute(days * 1440).strftime("%Y-%m-%d")
+                rows.append([f"{day}T{m // 60:02d}:{m % 60:02d}:00"] + values)
+        self.writer.writerows(rows)
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+
+class ArrowWriter(Writer):
+    """Arrow IPC file (format="arrow") or Parquet (format="parquet"), one row group per flush."""
+
+    def __init__(self, path, row_group_size=ROW_GROUP_SIZE, format="parquet", compression="zstd") -> None:
+        super().__init__(path, row_group_size)
+        import pyarrow as pa
+        self.pa = pa
+        self.schema = pa.schema([
+            ("timestamp", pa.timestamp("s")),
+            ("category", pa.uint8()),
+            ("intensity", pa.uint8()),
+            ("steps", pa.uint8()),
+            ("heart_rate", pa.uint8()),
+        ])
+        if format == "parquet":
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(path, self.schema, compression=compression)
+        else:
+            self.writer = pa.ipc.new_file(path, self.schema)
+
+    def _column(self, type, length, buffer):
+        return self.pa.Array.from_buffers(type, length, [None, self.pa.py_buffer(buffer)])
+
+    def _write_group(self, batches):
+        seconds = array("q")
+        for batch in batches:
+            seconds.extend(range(batch.start_minute * 60, batch.end_minute * 60, 60))
+        merged = [b"".join(getattr(b, name) for b in batches) for name in COLUMNS[1:]]
+        n = len(seconds)
+        arrays = [self._column(self.schema.field(0).type, n, seconds)]
+        arrays += [self._column(self.pa.uint8(), n, column) for column in merged]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        super().close()
+        self.writer.close()
+
+
+def open_writer(path, format=None, row_group_size=ROW_GROUP_SIZE) -> Writer:
+    """A writer for path, the format comes from the suffix unless given."""
+    if format is None:
+        suffix = path[path.rfind("."):].lower() if "." in path else ""
+        if suffix not in FORMATS:
+            raise ValueError(f"can't tell the export format of {path!r}, pass format=")
+        format = FORMATS[suffix]
+    if format == "csv":
+        return CsvWriter(path, row_group_size)
+    if format in ("arrow", "parquet"):
+        return ArrowWriter(path, row_group_size, format)
+    raise ValueError(f"unknown export format {format!r}")
+
+
+def export_batches(batches, writer: Writer) -> int:
+    """Write every batch and close the writer, returns the rows written."""
+    with writer:
+        for batch in batches:
+            writer.write(batch)
+    return writer.rows
+
+
+async def export_stream(stream, writer: Writer) -> int:
+    """export_batches for ActivityGetter.stream(), rows hit the file while the fetch runs."""
+    with writer:
+        async for batch in stream:
+            writer.write(batch)
+    return writer.rows
+
+
+def export_range(store, path, start: datetime = None, end: datetime = None, format=None,
+                 row_group_size=ROW_GROUP_SIZE):
+    """Bulk export [start, end) from an ActivityStore, returns (rows, rows per second)."""
+    start_minute = to_minute(start) if start else 0
+    end_minute = to_minute(end) if end else (store.last_minute() or 0) + 1
+    t0 = time.perf_counter()
+    rows = export_batches(store.batches(start_minute, end_minute, size=row_group_size),
+                          open_writer(path, format, row_group_size))
+    elapsed = time.perf_counter() - t0
+    return rows, rows / elapsed if elapsed > 0 else float("inf")
@@ -0,0 +1,385 @@
+"""
+Fake Band
+---------
+
+In-process stand-in for a BleakClient connected to a Mi Band 4. It exposes the
+GATT table recorded in specs.txt and answers the protocols main.py speaks:
+
++ auth challenge on CHARACTERISTIC_AUTH (AES-128-ECB with the given key)
++ 0x01 0x01 <since> / 0x02 fetch on CHARACTERISTIC_FETCH, streaming
+  synthetic minute samples on CHARACTERISTIC_ACTIVITY_DATA
++ chunked transfer reassembly on CHARACTERISTIC_CHUNKED_TRANSFER
++ firmware upload on the DFU service (see dfu.py), the image collects in
+  `firmware` and a wrong size or CRC fails the checksum command
+
+Notifications are delivered from the event loop after latency + jitter, in
+order, and each one is dropped with probability `loss`; reads and write
+requests wait a round trip of 2 * latency. With `drop_every` the link itself
+goes down after every that many notifications, and the next `unreachable`
+connect attempts fail.
+
+    client = FakeBleakClient(auth_key, minutes=1440 * 7)
+    wac = Wac("fake", auth_key=auth_key.hex(), client=client)
+
+"""
+
+import ast
+import asyncio
+import binascii
+import os
+import random
+import re
+
+from collections import deque
+from datetime import datetime, timedelta
+
+from codec import CURRENT_TIME, FETCH_ACK, FETCH_START, STEPS
+from constants import UUIDS
+
+SPECS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "specs.txt")
+_LINE = re.compile(
+    r"^(?P<indent>\s*)\[(?P<kind>Service|Characteristic|Descriptor)\] (?P<uuid>[0-9a-f-]{36}) "
+    r"\(Handle: (?P<handle>\d+)\): (?P<description>.*?)(?: \((?P<properties>[a-z0-9,-]+)\))?"
+    r"(?:, (?P<result>Value|Error): (?P<value>.*))?$")
+# one line of specs.txt has a uuid pasted into its property list
+_STRAY_UUID = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+class FakeDescriptor:
+    def __init__(self, uuid, handle, description) -> None:
+        self.uuid = uuid
+        self.handle = handle
+        self.description = description
+
+    def __str__(self):
+        return f"{self.uuid} (Handle: {self.handle}): {self.description}"
+
+
+class FakeCharacteristic:
+    def __init__(self, service, uuid, handle, description, properties) -> None:
+        self.service_uuid = service.uuid
+        self.service_handle = service.handle
+        self.uuid = uuid
+        self.handle = handle
+        self.description = description
+        self.properties = properties
+        self.descriptors = []
+
+    def get_descriptor(self, specifier):
+        for descriptor in self.descriptors:
+            if specifier in (descriptor.uuid, descriptor.handle):
+                return descriptor
+        return None
+
+    def __str__(self):
+        return f"{self.uuid} (Handle: {self.handle}): {self.description}"
+
+
+class FakeService:
+    def __init__(self, uuid, handle, description) -> None:
+        self.uuid = uuid
+        self.handle = handle
+        self.description = description
+        self.characteristics = []
+
+    def get_characteristic(self, uuid):
+        for char in self.characteristics:
+            if char.uuid == uuid:
+                return char
+        return None
+
+    def __str__(self):
+        return f"{self.uuid} (Handle: {self.handle}): {self.description}"
+
+
+class FakeServiceCollection:
+    def __init__(self, services) -> None:
+        self.services = {s.handle: s for s in services}
+        self.characteristics = {c.handle: c for s in services for c in s.characteristics}
+        self.descriptors = {d.handle: d for c in self.characteristics.values() for d in c.descriptors}
+
+    def __iter__(self):
+        return iter(self.services.values())
+
+    def get_service(self, specifier):
+        for service in self.services.values():
+            if specifier in (service.uuid, service.handle):
+                return service
+        return None
+
+    def get_characteristic(self, specifier):
+        if isinstance(specifier, int):
+            return self.characteristics.get(specifier)
+        for char in self.characteristics.values():
+            if char.uuid == str(specifier).lower():
+                return char
+        return None
+
+    def get_descriptor(self, handle):
+        return self.descriptors.get(handle)
+
+
+def load_specs(path=SPECS):
+    """Parse specs.txt into services and the values that were read from the band."""
+    services, values = [], {}
+    service = char = None
+    with open(path, "r") as f:
+        for line in f:
+            m = _LINE.match(line.rstrip("\n"))
+            if m is None:
+                continue
+            uuid, handle = m["uuid"], int(m["handle"])
+            if m["kind"] == "Service":
+                service = FakeService(uuid, handle, m["description"])
+                services.append(service)
+            elif m["kind"] == "Characteristic":
+                properties = _STRAY_UUID.sub("", m["properties"] or "").split(",")
+                char = FakeCharacteristic(service, uuid, handle, m["description"], properties)
+                service.characteristics.append(char)
+                if m["result"] == "Value" and m["value"].startswith("bytearray("):
+                    values[uuid] = ast.literal_eval(m["value"][len("bytearray("):-1])
+            else:
+                char.descriptors.append(FakeDescriptor(uuid, handle, m["description"]))
+    return FakeServiceCollection(services), values
+
+
+def services_from_table(table):
+    """A service collection from a gatt_cache.table_from_services table."""
+    services = []
+    for entry in table["services"]:
+        service = FakeService(entry["uuid"], entry["handle"], "")
+        for c in entry["characteristics"]:
+            char = FakeCharacteristic(service, c["uuid"], c["handle"], "", c["properties"])
+            char.descriptors = [FakeDescriptor(d["uuid"], d["handle"], "") for d in c["descriptors"]]
+            service.characteristics.append(char)
+        services.append(service)
+    return FakeServiceCollection(services)
+
+
+class FakeBleakClient:
+    def __init__(self, auth_key: bytes, minutes=1440, end: datetime = None, window_minutes=720,
+                 samples_per_packet=4, latency=0.0, jitter=0.0, loss=0.0, mtu_size=23, seed=0,
+                 drop_every=None, unreachable=0, disconnected_callback=None) -> None:
+        self.auth_key = auth_key
+        self.end = (end or datetime.now()).replace(second=0, microsecond=0)
+        self.start = self.end - timedelta(minutes=minutes)
+        self.window_minutes = window_minutes
+        self.samples_per_packet = samples_per_packet
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.mtu_size = mtu_size
+        self.drop_every = drop_every
+        self.unreachable = unreachable
+        self.disconnected_callback = disconnected_callback
+        self.random = random.Random(seed)
+        self.activity = self._synthetic_activity(minutes)
+        self.services, self.values = load_specs()
+        self.is_connected = False
+        self.callbacks = {}
+        self.chunks = {}
+        self.received = {}
+        self.writes = []
+        self.reads = 0
+        self.notifications = 0
+        self.dropped = 0
+        self.drops = 0
+        self._refused = 0
+        self.cursor = None
+        self.challenge = None
+        self.authenticated = False
+        self.firmware = bytearray()
+        self.firmware_size = None
+        self.rebooted = 0
+        self._clock = 0.0
+        self._outbox = deque()
+        self._pump = None
+
+    def _synthetic_activity(self, minutes):
+        rng = self.random
+        samples = bytearray()
+        for _ in range(minutes):
+            steps = rng.choice((0, 0, 0, rng.randrange(1, 120)))
+            samples += bytes((rng.choice((1, 3, 80, 90, 112, 122)), rng.randrange(0, 120),
+                              steps, rng.randrange(50, 150)))
+        return bytes(samples)
+
+    async def connect(self, **kwargs):
+        if self.drops and self._refused < self.unreachable:
+            # out of range for a while after each drop
+            self._refused += 1
+            raise ConnectionError("band not found")
+        self._refused = 0
+        self.is_connected = True
+        return True
+
+    async def disconnect(self):
+        self.is_connected = False
+        self.callbacks.clear()
+        return True
+
+    def drop(self):
+        """Lose the link: pending notifications vanish and the disconnected callback fires."""
+        self.drops += 1
+        self.is_connected = False
+        self.callbacks.clear()
+        self._outbox.clear()
+        if self._pump is not None:
+            self._pump.cancel()
+            self._pump = None
+        self.cursor = None
+        self.authenticated = False
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+    def _uuid(self, char_specifier):
+        uuid = getattr(char_specifier, "uuid", char_specifier)
+        if isinstance(uuid, int):
+            return self.services.get_characteristic(uuid).uuid
+        return uuid.lower()
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        self.callbacks[self._uuid(char_specifier)] = callback
+
+    async def stop_notify(self, char_specifier):
+        self.callbacks.pop(self._uuid(char_specifier), None)
+
+    async def read_gatt_char(self, char_specifier, **kwargs):
+        uuid = self._uuid(char_specifier)
+        self.reads += 1
+        if self.latency:
+            await asyncio.sleep(2 * self.latency)
+        if uuid == UUIDS.CHARACTERISTIC_CURRENT_TIME.lower():
+            now = datetime.now()
+            return bytearray(CURRENT_TIME.encode(now.year, now.month, now.day, now.hour, now.minute,
+                                                 now.second, now.isoweekday(), 0, 0, 0x1c))
+        if uuid == UUIDS.CHARACTERISTIC_STEPS:
+            return bytearray(STEPS.encode(steps=4321, meters=3100, calories=180))
+        return bytearray(self.values.get(uuid, b""))
+
+    async def read_gatt_descriptor(self, handle, **kwargs):
+        return bytearray(b"")
+
+    async def write_gatt_descriptor(self, handle, data):
+        self.writes.append((handle, bytes(data)))
+
+    async def write_gatt_char(self, char_specifier, data, response=False):
+        if not self.is_connected:
+            raise ConnectionError("not connected")
+        uuid = self._uuid(char_specifier)
+        data = bytes(data)
+        if response and self.latency:
+            # a write request waits a full round trip for its write response
+            await asyncio.sleep(2 * self.latency)
+        self.writes.append((uuid, data))
+        if uuid == UUIDS.CHARACTERISTIC_AUTH:
+            self._auth(uuid, data)
+        elif uuid == UUIDS.CHARACTERISTIC_FETCH:
+            self._fetch(uuid, data)
+        elif uuid == UUIDS.CHARACTERISTIC_CHUNKED_TRANSFER:
+            self._chunk(data)
+        elif uuid == UUIDS.CHARACTERISTIC_DFU_FIRMWARE:
+            self._dfu(uuid, data)
+        elif uuid == UUIDS.CHARACTERISTIC_DFU_FIRMWARE_WRITE:
+            self.firmware += data
+
+    def notify(self, uuid, data):
+        """Deliver data to the subscriber of uuid, in order, after latency/jitter."""
+        if self.loss and self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        loop = asyncio.get_running_loop()
+        delay = self.latency + (self.random.random() * self.jitter if self.jitter else 0.0)
+        # the link never reorders, jitter only delays everything queued behind
+        self._clock = max(self._clock, loop.time() + delay)
+        self._outbox.append((self._clock, uuid, bytearray(data)))
+        if self._pump is None:
+            self._pump = loop.call_at(self._clock, self._deliver)
+
+    def _deliver(self):
+        loop = asyncio.get_running_loop()
+        while self._outbox and self._outbox[0][0] <= loop.time():
+            _, uuid, data = self._outbox.popleft()
+            callback = self.callbacks.get(uuid)
+            if callback is None:
+                continue
+            self.notifications += 1
+            result = callback(uuid, data)
+            if asyncio.iscoroutine(result):
+                asyncio.ensure_future(result)
+            if self.drop_every and self.notifications % self.drop_every == 0:
+                self.drop()
+                return
+        self._pump = loop.call_at(self._outbox[0][0], self._deliver) if self._outbox else None
+
+    def _auth(self, uuid, data):
+        if data[:2] == b'\x02\x00':
+            self.challenge = self.random.randbytes(16)
+            self.notify(uuid, b'\x10\x02\x01' + self.challenge)
+        elif data[:2] == b'\x03\x00':
+            # not main.cipher: the fake checks the client, it mustn't share its code
+            from Crypto.Cipher import AES
+            expected = AES.new(self.auth_key, AES.MODE_ECB).encrypt(self.challenge or bytes(16))
+            self.authenticated = data[2:18] == expected
+            self.notify(uuid, b'\x10\x03' + (b'\x01' if self.authenticated else b'\x04'))
+        else:
+            self.notify(uuid, b'\x10' + data[:1] + b'\x04')
+
+    def _fetch(self, uuid, data):
+        if data[:2] == b'\x01\x01':
+            request = FETCH_START.decode(data)
+            since = max(datetime(request.year, request.month, request.day, request.hour, request.minute),
+                        self.start)
+            if since >= self.end:
+                self.cursor = None
+                self.notify(uuid, b'\x10\x01\x04')
+                return
+            self.cursor = since
+            count = min(self.window_minutes, (self.end - since) // timedelta(minutes=1))
+            self.notify(uuid, FETCH_ACK.encode(0x10, 0x01, 0x01, count, since.year, since.month, since.day,
+                                               since.hour, since.minute, 0, 0x1c))
+        elif data[:1] == b'\x02':
+            if self.cursor is None:
+                self.notify(uuid, b'\x10\x02\x04')
+                return
+            self._stream_window()
+            self.notify(uuid, b'\x10\x02\x01')
+        else:
+            self.notify(uuid, b'\x10' + data[:1] + b'\x04')
+
+    def _stream_window(self):
+        first = (self.cursor - self.start) // timedelta(minutes=1)
+        last = min(first + self.window_minutes, len(self.activity) // 4)
+        size = self.samples_per_packet * 4
+        body = self.activity[first * 4:last * 4]
+        for counter, offset in enumerate(range(0, len(body), size)):
+            self.notify(UUIDS.CHARACTERISTIC_ACTIVITY_DATA,
+                        bytes([counter & 0xff]) + body[offset:offset + size])
+        self.cursor = None
+
+    def _chunk(self, data):
+        flag, count = data[1], data[2]
+        data_type = flag & 0x3f
+        if count == 0:
+            self.chunks[data_type] = bytearray()
+        self.chunks.setdefault(data_type, bytearray()).extend(data[3:])
+        if flag & 0x80:
+            self.received[data_type] = bytes(self.chunks.pop(data_type))
+
+    def _dfu(self, uuid, data):
+        status = 0x01
+        if data[0] == 0x01:
+            self.firmware_size = int.from_bytes(data[1:4], "little")
+            self.firmware = bytearray()
+        elif data[0] == 0x00:
+            if self.firmware_size is None or len(self.firmware) > self.firmware_size:
+                status = 0x04
+        elif data[0] == 0x04:
+            crc = binascii.crc_hqx(self.firmware, 0xffff)
+            if len(self.firmware) != self.firmware_size or data[1:3] != crc.to_bytes(2, "little"):
+                status = 0x04
+        elif data[0] == 0x05:
+            self.rebooted += 1
+        elif data[0] != 0x03:
+            status = 0x04
+        self.notify(uuid, bytes((0x10, data[0], status)))
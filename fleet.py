@@ -0,0 +1,214 @@
+"""
+Fleet Sync
+----------
+
+Syncs many bands from one event loop. The registry is a text file with one band
+per line, in the same spirit as secret.txt:
+
+    <mac address> <auth key> [name] [interval seconds]
+
+Lines starting with # are ignored. Every band gets its own activity store and
+is synced again once its interval has passed, on its own schedule; at most
+`concurrency` bands hold the adapter (scan, connect, auth, fetch) at the same
+time.
+
+    python fleet.py devices.txt --concurrency 3 --once
+
+"""
+
+import argparse
+import asyncio
+import functools
+import logging
+import time
+
+from constants import SYNC_STATES
+from main import Wac
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 3600
+# connect + auth + sync of one band, a hung band gives its adapter slot back after this
+SYNC_TIMEOUT = 600.0
+DISCONNECT_TIMEOUT = 10.0
+
+
+class Device:
+    def __init__(self, address, auth_key, name=None, interval=DEFAULT_INTERVAL) -> None:
+        self.address = address
+        self.auth_key = auth_key
+        self.name = name or address
+        self.interval = interval
+        self.status = SYNC_STATES.IDLE
+        self.error = None
+        self.next_due = 0.0
+        self.last_sync = None
+        self.syncs = 0
+        self.failures = 0
+        self.minutes = 0
+
+    def __repr__(self):
+        return f"<Device {self.name} {self.status}>"
+
+
+def load_registry(path):
+    devices = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split()
+            address, auth_key = fields[:2]
+            name = fields[2] if len(fields) > 2 else None
+            interval = float(fields[3]) if len(fields) > 3 else DEFAULT_INTERVAL
+            devices.append(Device(address, auth_key, name, interval))
+    return devices
+
+
+def default_store(device: Device):
+    from store import ActivityStore
+    return ActivityStore(f"activity-{device.address.replace(':', '')}.db")
+
+
+class FleetManager:
+    def __init__(self, devices, concurrency=3, store_factory=default_store, wac_factory=Wac,
+                 timeout=SYNC_TIMEOUT, gatt_cache_dir=None) -> None:
+        if gatt_cache_dir is not None:
+            wac_factory = functools.partial(wac_factory, gatt_cache_dir=gatt_cache_dir)
+        self.devices = devices
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.adapter = asyncio.Semaphore(concurrency)
+        self.store_factory = store_factory
+        self.wac_factory = wac_factory
+        self.stores = {}
+        self.started = None
+        self.busy = 0.0
+
+    def store(self, device: Device):
+        if device.address not in self.stores:
+            self.stores[device.address] = self.store_factory(device)
+        return self.stores[device.address]
+
+    async def sync_device(self, device: Device):
+        device.status = SYNC_STATES.WAITING
+        async with self.adapter:
+            t0 = time.perf_counter()
+            wac = self.wac_factory(device.address, auth_key=device.auth_key)
+            try:
+                session = await asyncio.wait_for(self._attempt(device, wac), self.timeout)
+                device.minutes += len(session)
+                device.syncs += 1
+                device.last_sync = time.time()
+                device.error = None
+                device.status = SYNC_STATES.DONE
+            except Exception as e:
+                device.failures += 1
+                device.error = repr(e)
+                device.status = SYNC_STATES.FAILED
+                logger.error("%s: sync failed %s", device.name, device.error)
+            finally:
+                await self._disconnect(device, wac)
+                self.busy += time.perf_counter() - t0
+        device.next_due = time.monotonic() + device.interval
+
+    async def _attempt(self, device: Device, wac):
+        device.status = SYNC_STATES.CONNECTING
+        await wac.connect()
+        device.status = SYNC_STATES.AUTHENTICATING
+        await wac.authenticate()
+        device.status = SYNC_STATES.SYNCING
+        return await wac.sync(self.store(device))
+
+    async def _disconnect(self, device: Device, wac):
+        client = getattr(wac, "client", None)
+        try:
+            if client is not None and client.is_connected:
+                await asyncio.wait_for(client.disconnect(), DISCONNECT_TIMEOUT)
+        except Exception as e:
+            # the sync's own outcome is what gets reported
+            logger.warning("%s: disconnect failed %r", device.name, e)
+
+    async def run_once(self):
+        """Sync every band whose interval has passed, concurrently."""
+        if self.started is None:
+            self.started = time.perf_counter()
+        now = time.monotonic()
+        due = [d for d in self.devices if d.next_due <= now]
+        await asyncio.gather(*(self.sync_device(d) for d in due))
+        return due
+
+    async def run_forever(self):
+        """Keep every band on its own schedule, a slow or hung band only delays itself."""
+        if self.started is None:
+            self.started = time.perf_counter()
+        tasks = [asyncio.ensure_future(self._schedule(d)) for d in self.devices]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _schedule(self, device: Device):
+        while True:
+            await asyncio.sleep(max(0.0, device.next_due - time.monotonic()))
+            await self.sync_device(device)
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started if self.started else 0.0
+        syncs = sum(d.syncs for d in self.devices)
+        minutes = sum(d.minutes for d in self.devices)
+        return {
+            "devices": len(self.devices),
+            "syncs": syncs,
+            "failures": sum(d.failures for d in self.devices),
+            "elapsed": elapsed,
+            "devices_per_hour": syncs / elapsed * 3600 if elapsed else 0.0,
+            "minutes_per_second": minutes / elapsed if elapsed else 0.0,
+            "status": {d.name: d.status for d in self.devices},
+        }
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+
+
+async def main(args: argparse.Namespace):
+    fleet = FleetManager(load_registry(args.registry), concurrency=args.concurrency, timeout=args.timeout,
+                         gatt_cache_dir=args.gatt_cache_dir or None)
+    try:
+        if args.once:
+            await fleet.run_once()
+        else:
+            await fleet.run_forever()
+    finally:
+        report = fleet.report()
+        print(f"{report['syncs']} syncs, {report['failures']} failures in {report['elapsed']:.1f}s: "
+              f"{report['devices_per_hour']:.1f} devices/hour, "
+              f"{report['minutes_per_second']:.1f} minutes of data/sec")
+        for name, status in report["status"].items():
+            print(f"  {name}: {status}")
+        fleet.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("registry", metavar="<registry>",
+                        help="file with one '<address> <key> [name] [interval]' per line")
+    parser.add_argument("--concurrency", type=int, default=3,
+                        help="how many bands may use the adapter at once")
+    parser.add_argument("--timeout", type=float, default=SYNC_TIMEOUT,
+                        help="seconds one band may take to connect, authenticate and sync")
+    parser.add_argument("--gatt-cache-dir", metavar="<dir>", default="gatt_cache",
+                        help="reuse cached GATT tables on connect, empty to always discover")
+    parser.add_argument("--once", action="store_true",
+                        help="sync every band once and exit")
+    parser.add_argument("-d", "--debug", action="store_true", help="sets the log level to debug")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)-15s %(name)-8s %(levelname)s: %(message)s",
+    )
+    asyncio.run(main(args))
@@ -0,0 +1,82 @@
+"""
+GATT Cache
+----------
+
+Machine readable GATT tables (service -> characteristic -> descriptor, with
+handles and properties), cached per band and keyed by its Software Revision
+string, so the table is only rediscovered after a firmware update.
+
+    gatt_cache/<address>.json = {"latest": "V1.0.9.70", "tables": {"V1.0.9.70": {...}}}
+
+"""
+
+import json
+import os
+
+from constants import UUIDS
+
+CACHE_DIR = "gatt_cache"
+SOFTWARE_REVISION = UUIDS.BASE % "2a28"
+
+
+def table_from_services(services):
+    """Turn a bleak service collection into plain, JSON friendly dicts."""
+    return {
+        "services": [{
+            "uuid": service.uuid,
+            "handle": service.handle,
+            "characteristics": [{
+                "uuid": char.uuid,
+                "handle": char.handle,
+                "properties": list(char.properties),
+                "descriptors": [{"uuid": d.uuid, "handle": d.handle} for d in char.descriptors],
+            } for char in service.characteristics],
+        } for service in services],
+    }
+
+
+def _path(address, cache_dir):
+    return os.path.join(cache_dir, address.replace(":", "") + ".json")
+
+
+def load(address, revision=None, cache_dir=CACHE_DIR):
+    """Return (revision, table) for revision, or the latest one; None when not cached."""
+    try:
+        with open(_path(address, cache_dir), "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    revision = revision or cached.get("latest")
+    table = cached.get("tables", {}).get(revision)
+    return (revision, table) if table is not None else None
+
+
+def save(address, revision, table, cache_dir=CACHE_DIR):
+    path = _path(address, cache_dir)
+    try:
+        with open(path, "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {"tables": {}}
+    cached["latest"] = revision
+    cached["tables"][revision] = table
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(cached, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def forget(address, cache_dir=CACHE_DIR):
+    try:
+        os.unlink(_path(address, cache_dir))
+    except FileNotFoundError:
+        pass
+
+
+def used_services(table):
+    """Services holding a characteristic from constants.UUIDS, plus device info for the revision."""
+    wanted = {v.lower() for k, v in vars(UUIDS).items()
+              if k.startswith("CHARACTERISTIC_") and isinstance(v, str)}
+    wanted.add(SOFTWARE_REVISION)
+    return [service["uuid"] for service in table["services"]
+            if any(char["uuid"] in wanted for char in service["characteristics"])]
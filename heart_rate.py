@@ -0,0 +1,161 @@
+"""
+Heart Rate
+----------
+
+Continuous heart rate monitoring through the standard Heart Rate service:
+measurement is switched on with the control point (0x2a39), kept alive with a
+0x16 ping every 12 seconds, and every 0x2a37 notification lands in a fixed size
+ring buffer. Rolling statistics over the last `window` samples are maintained
+incrementally, so each sample costs O(1) (amortized for min/max):
+
++ mean and standard deviation from a running sum and sum of squares
++ min/max from monotonic deques
++ rmssd, the root mean square of successive bpm deltas (an HRV-style figure,
+  the band does not send RR intervals)
+
+    monitor = HeartRateMonitor(wac.client, registry=wac.registry)
+    await monitor.start()
+    ...
+    print(monitor.buffer.stats())
+
+"""
+
+import asyncio
+import math
+import time
+
+from array import array
+from collections import deque
+
+from constants import UUIDS
+from main import resolve
+
+HR_CAPACITY = 3600
+HR_WINDOW = 60
+PING_INTERVAL = 12.0
+
+STOP_MANUAL = b'\x15\x02\x00'
+STOP_CONTINUOUS = b'\x15\x01\x00'
+START_CONTINUOUS = b'\x15\x01\x01'
+PING = b'\x16'
+
+
+class HeartRateBuffer:
+    def __init__(self, capacity=HR_CAPACITY, window=HR_WINDOW) -> None:
+        if not 1 <= window <= capacity:
+            raise ValueError("window must be between 1 and capacity")
+        self.capacity = capacity
+        self.window = window
+        self.bpm = array('H', bytes(2 * capacity))
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.seq = 0
+        self._sum = 0
+        self._sumsq = 0
+        self._delta_sumsq = 0
+        self._min = deque()
+        self._max = deque()
+
+    def __len__(self):
+        return min(self.seq, self.capacity)
+
+    def _at(self, seq):
+        return self.bpm[seq % self.capacity]
+
+    def append(self, bpm: int, timestamp: float = None):
+        seq = self.seq
+        slot = seq % self.capacity
+        if seq >= self.window:
+            # the sample leaving the window, still in the ring as window <= capacity
+            old = self._at(seq - self.window)
+            self._sum -= old
+            self._sumsq -= old * old
+            self._delta_sumsq -= (self._at(seq - self.window + 1) - old) ** 2
+        if seq > 0:
+            self._delta_sumsq += (bpm - self._at(seq - 1)) ** 2
+        self.bpm[slot] = bpm
+        self.timestamps[slot] = time.time() if timestamp is None else timestamp
+        self._sum += bpm
+        self._sumsq += bpm * bpm
+
+        while self._min and self._min[-1][1] >= bpm:
+            self._min.pop()
+        self._min.append((seq, bpm))
+        while self._max and self._max[-1][1] <= bpm:
+            self._max.pop()
+        self._max.append((seq, bpm))
+        oldest = seq - self.window + 1
+        if self._min[0][0] < oldest:
+            self._min.popleft()
+        if self._max[0][0] < oldest:
+            self._max.popleft()
+        self.seq = seq + 1
+
+    def latest(self, n=None):
+        """Return up to n (timestamp, bpm) pairs, oldest first."""
+        n = len(self) if n is None else min(n, len(self))
+        return [(self.timestamps[s % self.capacity], self._at(s)) for s in range(self.seq - n, self.seq)]
+
+    def stats(self):
+        count = min(self.seq, self.window)
+        if count == 0:
+            return {"count": 0}
+        mean = self._sum / count
+        deltas = count - 1
+        return {
+            "count": count,
+            "bpm": self._at(self.seq - 1),
+            "mean": mean,
+            "stdev": math.sqrt(max(0.0, self._sumsq / count - mean * mean)),
+            "min": self._min[0][1],
+            "max": self._max[0][1],
+            "rmssd": math.sqrt(self._delta_sumsq / deltas) if deltas else 0.0,
+        }
+
+
+def decode_measurement(data):
+    """Heart Rate Measurement (0x2a37): flags bit 0 selects a uint8 or uint16 bpm."""
+    if data[0] & 0x01:
+        return data[1] | data[2] << 8
+    return data[1]
+
+
+class HeartRateMonitor:
+    def __init__(self, client, buffer: HeartRateBuffer = None, ping_interval=PING_INTERVAL, registry=None) -> None:
+        self.client = client
+        self.control_char = resolve(registry, UUIDS.CHARACTERISTIC_HEART_RATE_CONTROL)
+        self.measure_char = resolve(registry, UUIDS.CHARACTERISTIC_HEART_RATE_MEASURE)
+        self.buffer = buffer or HeartRateBuffer()
+        self.ping_interval = ping_interval
+        self.listeners = []
+        self._ping_task = None
+
+    def _callback(self, _, data):
+        if len(data) < 2:
+            return
+        bpm = decode_measurement(data)
+        self.buffer.append(bpm)
+        for listener in self.listeners:
+            listener(bpm, self.buffer)
+
+    async def _control(self, payload):
+        await self.client.write_gatt_char(self.control_char, payload, response=True)
+
+    async def start(self):
+        await self.client.start_notify(self.measure_char, self._callback)
+        await self._control(STOP_MANUAL)
+        await self._control(STOP_CONTINUOUS)
+        await self._control(START_CONTINUOUS)
+        self._ping_task = asyncio.ensure_future(self._ping())
+
+    async def _ping(self):
+        # the band stops measuring if it does not hear from us
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            await self._control(PING)
+
+    async def stop(self):
+        if self._ping_task is not None:
+            self._ping_task.cancel()
+            self._ping_task = None
+        await self._control(STOP_CONTINUOUS)
+        await self.client.stop_notify(self.measure_char)
@@ -1,37 +1,184 @@
-
+from __future__ import annotations
 
 import asyncio
+import logging
 import struct
+import time
 
-from bleak import BleakScanner, BleakClient
-from constants import AUTH_STATES, UUIDS
-from Crypto.Cipher import AES
+from codec import ACTIVITY_SAMPLE, BATTERY, CURRENT_TIME, FETCH_ACK, STEPS, fetch_start, timestamp
+from collections import deque
+from constants import AUTH_STATES, FETCH_STATES, MUSIC_STATE, UUIDS
 from datetime import datetime, timedelta
+from functools import lru_cache
+from metrics import DURATION_BUCKETS, REGISTRY
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # bleak and pycryptodome are imported where they are first needed
+    from bleak import BleakClient
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATIONS = REGISTRY.counter("miband_notifications_total", "notifications received")
+NOTIFICATION_BYTES = REGISTRY.counter("miband_notification_bytes_total", "notification payload bytes received")
+ACTIVITY_SAMPLES = REGISTRY.counter("miband_activity_samples_total", "minute samples decoded")
+ACTIVITY_LOST = REGISTRY.counter("miband_activity_lost_packets_total", "activity packets voided by a counter gap")
+DECODE_SECONDS = REGISTRY.histogram("miband_activity_decode_seconds", "decode time per activity packet")
+WRITE_SECONDS = REGISTRY.histogram("miband_gatt_write_seconds", "GATT write round trip")
+AUTH_SECONDS = REGISTRY.histogram("miband_auth_seconds", "auth handshake duration", DURATION_BUCKETS)
+FETCH_WINDOW_SECONDS = REGISTRY.histogram("miband_fetch_window_seconds", "fetch window duration", DURATION_BUCKETS)
+RECONNECTS = REGISTRY.counter("miband_reconnects_total", "connections re-established after a drop")
 
 RANDOM_BYTE = struct.pack('<2s', b'\x02\x00')
 DEFAULT_TIMEOUT = 0.5
-with open("secret.txt", "r") as f:
-    MAC_ADDRESS, AUTH_KEY = f.read().split("\n")
+DEFAULT_RETRIES = 3
+FETCH_IDLE_TIMEOUT = 5.0
+STREAM_QUEUE_SIZE = 64
+RESPONSE = 0x10
+SUCCESS = 0x01
+SECRET_FILE = "secret.txt"
 MAX_CHUNKLENGTH = 17
+CHUNK_WINDOW = 8
+ACTIVITY_SAMPLE_SIZE = ACTIVITY_SAMPLE.size
+EPOCH = datetime(1970, 1, 1)
+
+
+def load_secret(path=SECRET_FILE):
+    """Return (MAC_ADDRESS, AUTH_KEY) from a two line secret file."""
+    with open(path, "r") as f:
+        address, auth_key = f.read().split()[:2]
+    return address, auth_key
+
+
+def to_minute(timestamp: datetime) -> int:
+    return (timestamp - EPOCH) // timedelta(minutes=1)
+
+
+def from_minute(minute: int) -> datetime:
+    return EPOCH + timedelta(minutes=minute)
+
+
+class ActivityBatch:
+    """
+    + columnar block of consecutive minute samples
+    + every column is bytes, one uint8 per minute
+    + sample i belongs to epoch minute start_minute + i (band wall clock)
+    """
+
+    __slots__ = ("start_minute", "category", "intensity", "steps", "heart_rate")
+
+    def __init__(self, start_minute: int, category=b'', intensity=b'', steps=b'', heart_rate=b'') -> None:
+        self.start_minute = start_minute
+        self.category = category
+        self.intensity = intensity
+        self.steps = steps
+        self.heart_rate = heart_rate
+
+    def __len__(self):
+        return len(self.category)
+
+    @property
+    def end_minute(self):
+        return self.start_minute + len(self.category)
+
+    @property
+    def minutes(self):
+        return range(self.start_minute, self.end_minute)
+
+    @classmethod
+    def decode(cls, start_minute: int, data):
+        # data[0] is the packet counter, then category/intensity/steps/hr per minute
+        return cls(start_minute, bytes(data[1::4]), bytes(data[2::4]),
+                   bytes(data[3::4]), bytes(data[4::4]))
+
+    @classmethod
+    def concat(cls, batches):
+        batches = [b for b in batches if len(b)]
+        if not batches:
+            return cls(0)
+        for prev, cur in zip(batches, batches[1:]):
+            if prev.end_minute != cur.start_minute:
+                raise ValueError(
+                    f"batches are not contiguous: {prev.end_minute} != {cur.start_minute}")
+        return cls(batches[0].start_minute,
+                   b''.join(b.category for b in batches),
+                   b''.join(b.intensity for b in batches),
+                   b''.join(b.steps for b in batches),
+                   b''.join(b.heart_rate for b in batches))
+
+    def rows(self):
+        return zip(self.minutes, self.category, self.intensity, self.steps, self.heart_rate)
+
+    def as_numpy(self):
+        import numpy as np
+        return {
+            "minute": np.arange(self.start_minute, self.end_minute, dtype=np.int64),
+            "category": np.frombuffer(self.category, dtype=np.uint8),
+            "intensity": np.frombuffer(self.intensity, dtype=np.uint8),
+            "steps": np.frombuffer(self.steps, dtype=np.uint8),
+            "heart_rate": np.frombuffer(self.heart_rate, dtype=np.uint8),
+        }
+
+
+class ProtocolError(Exception):
+    pass
 
 
 class Characteristic:
     def __init__(self, char_specifier: str, client: BleakClient) -> None:
         self.char_specifier = char_specifier
         self.client = client
+        self.notifying = False
+        self._pending = {}
+
+    @classmethod
+    def create(cls, wac: Wac, char_specifier):
+        return cls(char_specifier, wac.client)
 
     async def write(self, value, response=False):
-        await self.client.write_gatt_char(self.char_specifier, value, response=False)
+        t0 = time.perf_counter()
+        await self.client.write_gatt_char(self.char_specifier, value, response=response)
+        WRITE_SECONDS.observe(time.perf_counter() - t0)
 
     async def read(self):
         return await self.client.read_gatt_char(self.char_specifier)
 
     def _callback(self, handler, data):
-        print(f"DEFAULT {handler} {data}")
-        pass
+        NOTIFICATIONS.inc()
+        NOTIFICATION_BYTES.inc(len(data))
+        logger.debug("notification on %s: %r", handler, data)
 
     async def init_handler(self):
-        await self.client.start_notify(self.char_specifier, self._callback)
+        if not self.notifying:
+            await self.client.start_notify(self.char_specifier, self._callback)
+            self.notifying = True
+
+    def _expect(self, command: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._pending[command] = future
+        return future
+
+    def _resolve(self, data) -> bool:
+        """Complete the future waiting on a b'\\x10' <command> <status> response."""
+        if len(data) < 3 or data[0] != RESPONSE:
+            return False
+        future = self._pending.pop(data[1], None)
+        if future is None or future.done():
+            return False
+        future.set_result(bytes(data))
+        return True
+
+    async def request(self, payload, command: int, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES):
+        """Write payload and wait for its response, resending after each timeout."""
+        for attempt in range(retries + 1):
+            future = self._expect(command)
+            await self.write(payload)
+            try:
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                self._pending.pop(command, None)
+                logger.warning("no response to %r (attempt %d/%d)", bytes(payload[:2]), attempt + 1, retries + 1)
+        raise ProtocolError(f"no response to command {command:#04x} from {self.char_specifier}")
 
 
 class Descriptor:
@@ -46,42 +193,248 @@ class Descriptor:
         return await self.client.read_gatt_descriptor(self.char_specifier)
 
 
+# properties the handlers rely on, as the band lists them in specs.txt
+CHARACTERISTIC_PROPERTIES = {
+    UUIDS.CHARACTERISTIC_AUTH: ("write-without-response", "notify"),
+    UUIDS.CHARACTERISTIC_FETCH: ("write-without-response", "notify"),
+    UUIDS.CHARACTERISTIC_ACTIVITY_DATA: ("notify",),
+    UUIDS.CHARACTERISTIC_CURRENT_TIME: ("read",),
+    UUIDS.CHARACTERISTIC_STEPS: ("read", "notify"),
+    UUIDS.CHARACTERISTIC_BATTERY: ("read", "notify"),
+    UUIDS.CHARACTERISTIC_CHUNKED_TRANSFER: ("write-without-response",),
+    UUIDS.CHARACTERISTIC_MUSIC_NOTIFICATION: ("notify",),
+    UUIDS.CHARACTERISTIC_CUSTOM_ALERT: ("write",),
+    UUIDS.CHARACTERISTIC_ALERT: ("write-without-response",),
+    UUIDS.CHARACTERISTIC_HEART_RATE_MEASURE: ("notify",),
+    UUIDS.CHARACTERISTIC_HEART_RATE_CONTROL: ("write",),
+    UUIDS.CHARACTERISTIC_SENSOR: ("write-without-response",),
+    UUIDS.CHARACTERISTIC_HZ: ("notify",),
+    UUIDS.CHARACTERISTIC_DFU_FIRMWARE: ("write", "notify"),
+    UUIDS.CHARACTERISTIC_DFU_FIRMWARE_WRITE: ("write-without-response",),
+}
+# without these a sync can't even start, connect() fails right away
+REQUIRED_CHARACTERISTICS = (
+    UUIDS.CHARACTERISTIC_AUTH,
+    UUIDS.CHARACTERISTIC_FETCH,
+    UUIDS.CHARACTERISTIC_ACTIVITY_DATA,
+    UUIDS.CHARACTERISTIC_CURRENT_TIME,
+)
+
+
+class StaleGattTable(ProtocolError):
+    pass
+
+
+class GattRegistry:
+    """
+    + built once per connection from the discovered services
+    + resolves every UUIDS.CHARACTERISTIC_* to its characteristic object, so
+      bleak skips the uuid lookup over all characteristics on each read/write
+    + with a cached gatt_cache table, characteristics are looked up by their
+      cached handle; a handle that is gone or now holds something else raises
+      StaleGattTable and Wac.connect rediscovers
+    + checks CHARACTERISTIC_PROPERTIES up front, a band missing something we
+      need fails at connect instead of halfway through a sync
+    """
+
+    def __init__(self, services, required=REQUIRED_CHARACTERISTICS, table=None) -> None:
+        self.chars = {}
+        properties = {uuid.lower(): needed for uuid, needed in CHARACTERISTIC_PROPERTIES.items()}
+        cached = None
+        if table is not None:
+            cached = {char["uuid"].lower(): char for service in table["services"]
+                      for char in service["characteristics"]}
+        for name, uuid in vars(UUIDS).items():
+            if not name.startswith("CHARACTERISTIC_") or not isinstance(uuid, str):
+                continue
+            uuid = uuid.lower()
+            if cached is None:
+                char = services.get_characteristic(uuid)
+            elif uuid in cached:
+                char = self._cached(services, cached[uuid])
+            else:
+                char = None
+            if char is None:
+                continue
+            lacking = set(properties.get(uuid, ())) - set(char.properties)
+            if lacking:
+                raise ProtocolError(f"{name} ({uuid}) does not support {', '.join(sorted(lacking))}")
+            self.chars[uuid] = char
+        missing = [uuid for uuid in required if uuid.lower() not in self.chars]
+        if missing:
+            raise ProtocolError(f"band is missing characteristics {', '.join(missing)}")
+
+    @staticmethod
+    def _cached(services, entry):
+        char = services.get_characteristic(entry["handle"])
+        if char is None or char.uuid.lower() != entry["uuid"].lower() \
+                or sorted(char.properties) != sorted(entry["properties"]):
+            raise StaleGattTable(f"cached handle {entry['handle']} no longer holds {entry['uuid']}")
+        return char
+
+    def __contains__(self, uuid):
+        return uuid.lower() in self.chars
+
+    def resolve(self, char_specifier):
+        """The characteristic object for a uuid, anything else is passed through."""
+        if isinstance(char_specifier, str):
+            return self.chars.get(char_specifier.lower(), char_specifier)
+        return char_specifier
+
+
+@lru_cache(maxsize=16)
+def cipher(key: bytes):
+    """AES-128-ECB for key, built once per key: ECB keeps no state between blocks."""
+    from Crypto.Cipher import AES
+    return AES.new(key, AES.MODE_ECB)
+
+
+def resolve(registry: GattRegistry, char_specifier):
+    return registry.resolve(char_specifier) if registry is not None else char_specifier
+
+
 class Wac:
-    def __init__(self, address, timeout=0.5) -> None:
+    def __init__(self, address, timeout=0.5, auth_key=None, client=None, gatt_cache_dir=None,
+                 disconnected_callback=None, record=None) -> None:
         self.address = address
+        self.auth_key = auth_key
         self.timeout = timeout
+        self.client = client
+        self.scan = client is None
+        self.gatt_cache_dir = gatt_cache_dir
+        self.disconnected_callback = disconnected_callback
+        self.record = record
+        self.recorder = None
+        self.revision = None
+        self.registry = None
         self.state = None
         self.status = None
 
     async def connect(self):
-        device = await BleakScanner.find_device_by_address(
-            self.address, cb=dict(use_bdaddr=True)
-        )
-        self.client = BleakClient(device)
+        """
+        Scan and connect, or connect the client handed to the constructor.
+        With gatt_cache_dir, discovery is limited to the services the cached
+        table says we use and characteristics are resolved from its handles.
+        After a firmware change or a table that no longer matches, everything
+        is rediscovered once and cached again.
+        With record, all GATT traffic is captured to that path (recorder.py).
+        """
+        import gatt_cache
+        cached = None
+        if self.gatt_cache_dir is not None:
+            cached = gatt_cache.load(self.address, cache_dir=self.gatt_cache_dir)
+        device = await self._open(None, gatt_cache.used_services(cached[1]) if cached else None)
+        if self.gatt_cache_dir is None:
+            self.registry = GattRegistry(self.client.services)
+            return device or self.address
+        self.revision = bytes(await self.client.read_gatt_char(gatt_cache.SOFTWARE_REVISION)).decode("utf-8", "replace")
+        if cached is not None and cached[0] == self.revision:
+            try:
+                self.registry = GattRegistry(self.client.services, table=cached[1])
+                return device or self.address
+            except StaleGattTable as e:
+                logger.info("%s: %s, rediscovering", self.address, e)
+        elif cached is not None:
+            logger.info("%s firmware %s -> %s, rediscovering", self.address, cached[0], self.revision)
+        if cached is not None and self.scan:
+            # discovery was trimmed to the cached services, look at everything once
+            await self.client.disconnect()
+            device = await self._open(device, None)
+        gatt_cache.save(self.address, self.revision, gatt_cache.table_from_services(self.client.services),
+                        cache_dir=self.gatt_cache_dir)
+        self.registry = GattRegistry(self.client.services)
+        return device or self.address
+
+    async def _open(self, device, services):
+        if self.client is None or self.scan:
+            from bleak import BleakClient, BleakScanner
+            if device is None:
+                device = await BleakScanner.find_device_by_address(
+                    self.address, cb=dict(use_bdaddr=True)
+                )
+            self.client = BleakClient(device, services=services, disconnected_callback=self.disconnected_callback)
+        if self.record is not None:
+            from recorder import Recorder
+            if self.recorder is None:
+                self.recorder = self.client if isinstance(self.client, Recorder) else Recorder(self.client, self.record)
+            elif self.client is not self.recorder:
+                # a rescan made a new client, the capture goes on in the same file
+                self.recorder.client = self.client
+            self.client = self.recorder
         await self.client.connect()
         return device
 
+    async def authenticate(self, retries=DEFAULT_RETRIES):
+        auth_char = await self.createChar(UUIDS.CHARACTERISTIC_AUTH, special_type="AUTH")
+        await auth_char.init_handler()
+        await auth_char.authenticate(retries)
+        return auth_char
+
+    async def utc_offset(self):
+        """The band's timezone in quarter hours."""
+        current_time = await self.createChar(UUIDS.CHARACTERISTIC_CURRENT_TIME)
+        return CURRENT_TIME.decode(await current_time.read()).tz
+
+    async def sync(self, store=None, start: datetime = None, end: datetime = None, offload=False):
+        """
+        Fetch activity since the store's last minute (or start) on an
+        authenticated client, with offload decoding and committing it on a
+        worker thread (pipeline.py).
+        """
+        activity_getter = ActivityGetter(await self.utc_offset(), self.client, store=store, start=start, end=end,
+                                         registry=self.registry, offload=offload)
+        return await activity_getter.fetch()
+
     async def createChar(self, char_specifier, special_type=None):
-        if special_type == "AUTH":
-            return AuthenticateChar(self, char_specifier, self.client)
-        elif special_type == "STEP":
-            return StepChar(char_specifier, self.client)
-        else:
-            return Characteristic(char_specifier, self.client)
+        """
+        A handler for char_specifier, resolved through the registry. The class
+        comes from special_type, or from the characteristic itself.
+        """
+        if special_type is None:
+            special_type = DEFAULT_TYPES.get(char_specifier)
+        handler = CHARACTERISTIC_TYPES.get(special_type, Characteristic)
+        return handler.create(self, resolve(self.registry, char_specifier))
 
 
-class StepChar(Characteristic):
+class PayloadChar(Characteristic):
+    """
+    + read() decodes the payload with parse(), a payload too short or with
+      the wrong leading byte raises ProtocolError
+    """
+
     async def read(self):
-        a = await super().read()
-        steps = struct.unpack('h', a[1:3])[0] if len(a) >= 3 else None
-        meters = struct.unpack('h', a[5:7])[0] if len(a) >= 7 else None
-        fat_burned = struct.unpack('h', a[2:4])[0] if len(a) >= 4 else None
-        calories = struct.unpack('b', a[9:10])[0] if len(a) >= 10 else None
+        data = await super().read()
+        try:
+            return self.parse(data)
+        except ValueError as e:
+            raise ProtocolError(f"bad payload {bytes(data)!r} from {self.char_specifier}: {e}") from e
+
+    @staticmethod
+    def parse(data):
+        raise NotImplementedError
+
+
+class StepChar(PayloadChar):
+    @staticmethod
+    def parse(data):
+        steps = STEPS.decode(data)
+        return {
+            "steps": steps.steps,
+            "meters": steps.meters,
+            "calories": steps.calories,
+        }
+
+
+class BatteryChar(PayloadChar):
+    @staticmethod
+    def parse(data):
+        battery = BATTERY.decode(data)
         return {
-            "steps": steps,
-            "meters": meters,
-            "fat_burned": fat_burned,
-            "calories": calories
+            "level": battery.level,
+            "charging": battery.charging == 1,
+            "last_off": timestamp(battery, "off_"),
+            "last_charged": timestamp(battery, "charged_"),
+            "last_charged_level": battery.charged_level,
         }
 
 
@@ -90,36 +443,195 @@ class ActivityGetter:
     + write to notification_decs
     + fetch_char handle initiating/ending device streaming data
     + activity_char handle parsing actual data
+    + with a store, resume from the last committed minute and commit every
+      finished fetch window; pass start/end to backfill a past range
+    + stream() hands batches to a consumer through a bounded queue
+    + with offload, notifications only queue the raw packets and a
+      pipeline.Pipeline thread decodes and commits them off the event loop
     """
 
-    def __init__(self, utc_offset: bytearray, client: BleakClient) -> None:
-        temp = datetime.now()
-        self.start = datetime(temp.year, temp.month, temp.day)
-        self.end = datetime.now()
-        self.next_timestamp = self.start
+    def __init__(self, utc_offset: int, client: BleakClient, store=None,
+                 start: datetime = None, end: datetime = None, registry: GattRegistry = None,
+                 offload=False) -> None:
+        self.store = store
+        if start is None:
+            start = self.resume_point()
+        self.start = start
+        self.end = end or datetime.now()
+        self.next_minute = to_minute(self.start)
         self.utc_offset = utc_offset
         self.client = client
         self.pkg = 0
+        self.lost = 0
+        self.batches = []
+        self.keep_session = True
+        self.window = []
+        self.queue = None
+        self.overflow = deque()
+        self.drained = asyncio.Event()
         self.lock = asyncio.Lock()
+        self.pipeline = None
+        if offload:
+            from pipeline import Pipeline
+            self.pipeline = Pipeline(store)
 
         self.fetch_char = FetchChar(
-            self, UUIDS.CHARACTERISTIC_FETCH, client)
+            self, resolve(registry, UUIDS.CHARACTERISTIC_FETCH), client)
 
         self.activity_char = ActivityChar(
-            self, UUIDS.CHARACTERISTIC_ACTIVITY_DATA, client)
+            self, resolve(registry, UUIDS.CHARACTERISTIC_ACTIVITY_DATA), client)
 
-    async def set_next_timestamp(self, new_value):
-        # async with self.lock:
-        self.next_timestamp = new_value
+    @property
+    def next_timestamp(self):
+        return from_minute(self.next_minute)
 
-    async def get_next_timestamp(self):
-        # async with self.lock:
-        return self.next_timestamp
+    @next_timestamp.setter
+    def next_timestamp(self, value: datetime):
+        self.next_minute = to_minute(value)
 
-    async def get(self):
+    def resume_point(self) -> datetime:
+        """First minute not yet in the store, midnight of today without one."""
+        last = self.store.last_minute() if self.store is not None else None
+        if last is not None:
+            return from_minute(last + 1)
+        temp = datetime.now()
+        return datetime(temp.year, temp.month, temp.day)
+
+    def add_batch(self, batch: ActivityBatch):
+        if self.keep_session:
+            self.batches.append(batch)
+        self.window.append(batch)
+        self.next_minute = batch.end_minute
+        if self.queue is not None:
+            self._publish(batch)
+
+    def add_packet(self, data):
+        """The offloaded add_batch: only the minute count is read here."""
+        start_minute = self.next_minute
+        self.next_minute += len(data) // ACTIVITY_SAMPLE_SIZE
+        self.pipeline.submit(start_minute, data)
+
+    def _publish(self, item):
+        # notification callbacks cannot wait, park what the queue can't take yet
+        if self.overflow or self.queue.full():
+            self.overflow.append(item)
+        else:
+            self.queue.put_nowait(item)
+
+    def _refill(self):
+        while self.overflow and not self.queue.full():
+            self.queue.put_nowait(self.overflow.popleft())
+        if not self.overflow:
+            self.drained.set()
+
+    async def _drain(self):
+        """Block until the consumer has taken everything parked by _publish."""
+        if self.pipeline is not None:
+            await self.pipeline.backpressure()
+        while self.queue is not None and self.overflow:
+            self.drained.clear()
+            await self.drained.wait()
+
+    def commit_window(self):
+        if self.pipeline is not None:
+            self.pipeline.commit()
+            return
+        window, self.window = self.window, []
+        if self.store is not None and window:
+            added = self.store.commit(window)
+            logger.info("committed %d new samples up to %s", added, self.next_timestamp)
+
+    def session(self) -> ActivityBatch:
+        return ActivityBatch.concat(self.batches)
+
+    async def fetch(self, start: datetime = None, end: datetime = None, retries=DEFAULT_RETRIES):
+        """Request windows until end is reached or the band runs out of data."""
+        if start is not None:
+            self.next_timestamp = start
+        if end is not None:
+            self.end = end
+        self.window = []
         await self.fetch_char.init_handler()
-        await self.fetch_char.send_fetch_payload(self.utc_offset)
         await self.activity_char.init_handler()
+        if self.pipeline is None:
+            await self._fetch(retries)
+        else:
+            self.pipeline.start()
+            try:
+                await self._fetch(retries)
+            finally:
+                self.commit_window()
+                await self.pipeline.close()
+                self.batches = self.pipeline.batches
+        logger.info("finished fetching up to %s", self.next_timestamp)
+        return self.session()
+
+    async def _fetch(self, retries):
+        failures = 0
+        while self.next_timestamp < self.end:
+            before = self.next_minute
+            try:
+                state = await self.fetch_char.fetch_window()
+            except ProtocolError:
+                # keep whatever arrived, the retry resumes after it
+                self.commit_window()
+                # only retries that got nowhere count against the limit
+                failures = failures + 1 if self.next_minute <= before else 0
+                if failures > retries:
+                    raise
+                continue
+            self.commit_window()
+            if self.lost:
+                logger.warning("lost %d packets, refetching from %s", self.lost, self.next_timestamp)
+                failures = failures + 1 if self.next_minute <= before else 0
+                if failures > retries:
+                    raise ProtocolError(f"too many lost packets at {self.next_timestamp}")
+                await self._drain()
+                continue
+            failures = 0
+            # backpressure: the band stays idle until the consumer catches up
+            await self._drain()
+            if state != FETCH_STATES.WINDOW_DONE or self.next_minute == before:
+                break
+
+    async def get(self):
+        return await self.fetch()
+
+    async def stream(self, start: datetime = None, end: datetime = None, maxsize=STREAM_QUEUE_SIZE):
+        """
+        async for batch in getter.stream(start, end)
+
+        At most maxsize batches plus one fetch window are buffered, the next
+        window is only requested once the consumer has caught up.
+        """
+        if self.pipeline is not None:
+            raise ValueError("stream() hands out decoded batches, it can't be offloaded")
+        self.queue = asyncio.Queue(maxsize)
+        self.overflow.clear()
+        self.keep_session = False
+
+        async def produce():
+            try:
+                await self.fetch(start, end)
+            finally:
+                if self.queue is not None:
+                    self._publish(None)
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            while True:
+                batch = await self.queue.get()
+                self._refill()
+                if batch is None:
+                    break
+                yield batch
+            await producer
+        finally:
+            if not producer.done():
+                producer.cancel()
+            self.queue = None
+            self.overflow.clear()
+            self.keep_session = True
 
 
 class ActivityChar(Characteristic):
@@ -128,151 +640,216 @@ class ActivityChar(Characteristic):
         self.activity_getter = activity_getter
         self.lock = asyncio.Lock()
 
-    async def _callback(self, _, data):
-        print(f"LOG [Activity]: {data}")
-        if len(data) % 4 == 1:
-            self.activity_getter.pkg += 1
-            i = 1
-            while i < len(data):
-                # index = int(self.activity_getter.pkg) * 4 + (i - 1) / 4
-                timestamp = (await self.activity_getter.get_next_timestamp()) + timedelta(minutes=1)
-                category = struct.unpack("<B", data[i:i + 1])[0]
-                intensity = struct.unpack("B", data[i + 1:i + 2])[0]
-                steps = struct.unpack("B", data[i + 2:i + 3])[0]
-                heart_rate = struct.unpack("B", data[i + 3:i + 4])[0]
-                print(timestamp, category, intensity, steps, heart_rate)
-                await self.activity_getter.set_next_timestamp(timestamp)
-                i += 4
-
-    async def init_handler(self):
-        await self.client.start_notify(self.char_specifier, self._callback)
+    def _callback(self, _, data):
+        t0 = time.perf_counter()
+        NOTIFICATIONS.inc()
+        NOTIFICATION_BYTES.inc(len(data))
+        if len(data) % ACTIVITY_SAMPLE_SIZE != 1:
+            logger.warning("unexpected activity packet %r", data)
+            return
+        getter = self.activity_getter
+        if getter.lost or data[0] != getter.pkg & 0xff:
+            # like Gadgetbridge, a gap in the packet counter voids the rest of
+            # the window, the next window is requested from the last good minute
+            getter.lost += 1
+            ACTIVITY_LOST.inc()
+            return
+        getter.pkg += 1
+        if getter.pipeline is not None:
+            getter.add_packet(data)
+            DECODE_SECONDS.observe(time.perf_counter() - t0)
+            return
+        batch = ActivityBatch.decode(getter.next_minute, data)
+        getter.add_batch(batch)
+        ACTIVITY_SAMPLES.inc(len(batch))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%d samples from %s", len(batch), from_minute(batch.start_minute))
+        DECODE_SECONDS.observe(time.perf_counter() - t0)
 
 
 class FetchChar(Characteristic):
+    """
+    + IDLE -> REQUESTED: write 0x01 0x01 <since> and await 0x10 0x01
+    + REQUESTED -> TRANSFERRING: write 0x02, ActivityChar receives the data
+    + TRANSFERRING -> WINDOW_DONE/NO_DATA: await 0x10 0x02
+    """
+
     def __init__(self, activity_getter: ActivityGetter, char_specifier: str, client: BleakClient):
         super().__init__(char_specifier, client)
         self.activity_getter = activity_getter
-
-    async def send_fetch_payload(self, utc_offset: bytearray):
-        ts = self._pack_timestamp(self.activity_getter.next_timestamp)
-        payload = b'\x01\x01' + ts + utc_offset
-        await self.write(payload)
-
-    def _pack_timestamp(self, timestamp: datetime):
-        year = struct.pack("<H", timestamp.year)
-        month = struct.pack("b", timestamp.month)
-        day = struct.pack("b", timestamp.day)
-        hour = struct.pack("b", timestamp.hour)
-        minute = struct.pack("b", timestamp.minute)
-        ts = year + month + day + hour + minute
-        return ts
-
-    async def _callback(self, _, data):
-        print(f"LOG [FETCH]: {data}")
-        if data[:3] == b'\x10\x01\x01':
-            year = struct.unpack("<H", data[7:9])[0]
-            month = struct.unpack("b", data[9:10])[0]
-            day = struct.unpack("b", data[10:11])[0]
-            hour = struct.unpack("b", data[11:12])[0]
-            minute = struct.unpack("b", data[12:13])[0]
-            self.activity_getter.next_timestamp = datetime(
-                year, month, day, hour, minute)
-            print(
-                f"actually fetching data from {self.activity_getter.next_timestamp}")
-            self.activity_getter.pkg = 0
-            await self.write(b'\x02')
-        elif data[:3] == b'\x10\x02\x01':
-            print(f"stopped at {self.activity_getter.next_timestamp}")
-            if self.activity_getter.next_timestamp > self.activity_getter.end - timedelta(minutes=1):
-                print("Finished fetching")
-                return
-            await asyncio.sleep(1)
-            t = self.activity_getter.next_timestamp + timedelta(minutes=1)
-            print(f"Trigger more communication {t}")
-            await self.send_fetch_payload(t)
-
-        elif data[:3] == b'\x10\x02\x04':
-            print("No more activity fetch possible")
-        else:
-            print(f"Unexpected data on handle {str(data)}")
-
-    async def init_handler(self):
-        await self.client.start_notify(self.char_specifier, self._callback)
+        self.state = FETCH_STATES.IDLE
+
+    async def fetch_window(self, timeout=DEFAULT_TIMEOUT * 4, idle_timeout=FETCH_IDLE_TIMEOUT):
+        getter = self.activity_getter
+        t0 = time.perf_counter()
+        self.state = FETCH_STATES.REQUESTED
+        data = await self.request(fetch_start(getter.next_timestamp, getter.utc_offset), 0x01, timeout)
+        if len(data) > 2 and data[2] != SUCCESS:
+            self.state = FETCH_STATES.NO_DATA
+            return self.state
+        try:
+            ack = FETCH_ACK.decode(data)
+        except ValueError as e:
+            # a short or garbled ack is retried like a stalled window
+            self.state = FETCH_STATES.IDLE
+            raise ProtocolError(f"bad fetch reply {bytes(data)!r}: {e}") from e
+        getter.next_timestamp = datetime(ack.year, ack.month, ack.day, ack.hour, ack.minute)
+        logger.info("actually fetching data from %s", getter.next_timestamp)
+        getter.pkg = 0
+        getter.lost = 0
+
+        self.state = FETCH_STATES.TRANSFERRING
+        done = self._expect(0x02)
+        await self.write(b'\x02')
+        data = await self._await_transfer(done, idle_timeout)
+        self.state = FETCH_STATES.WINDOW_DONE if data[2] == SUCCESS else FETCH_STATES.NO_DATA
+        FETCH_WINDOW_SECONDS.observe(time.perf_counter() - t0)
+        logger.info("stopped at %s", getter.next_timestamp)
+        return self.state
+
+    async def _await_transfer(self, done: asyncio.Future, idle_timeout):
+        # a window may take long, only give up once packets stop coming
+        while True:
+            progress = (self.activity_getter.pkg, self.activity_getter.lost)
+            try:
+                return await asyncio.wait_for(asyncio.shield(done), idle_timeout)
+            except asyncio.TimeoutError:
+                if (self.activity_getter.pkg, self.activity_getter.lost) == progress:
+                    self._pending.pop(0x02, None)
+                    self.state = FETCH_STATES.IDLE
+                    raise ProtocolError(f"fetch stalled at {self.activity_getter.next_timestamp}")
+
+    def _callback(self, _, data):
+        NOTIFICATIONS.inc()
+        NOTIFICATION_BYTES.inc(len(data))
+        logger.debug("fetch: %r", data)
+        if self._resolve(data):
+            return
+        logger.warning("unexpected data on fetch characteristic %r", data)
 
 
 class AuthenticateChar(Characteristic):
+    """
+    + REQUESTING_RN: write 0x02 0x00, await 0x10 0x02 0x01 <16 random bytes>
+    + SENDING_ENCRYPTED_KEY: write 0x03 0x00 <aes(random)>, await 0x10 0x03
+    + AUTH_OK or one of the failure states
+    """
+
     def __init__(self, wac: Wac, char_specifier: str, client: BleakClient):
         super().__init__(char_specifier, client)
         self.wac = wac
-        self.auth_key = bytes.fromhex(AUTH_KEY)
+        self.auth_key = bytes.fromhex(wac.auth_key or load_secret()[1])
+
+    @classmethod
+    def create(cls, wac: Wac, char_specifier):
+        return cls(wac, char_specifier, wac.client)
 
     def _encrypt_string_with_key(self, random_string):
-        aes = AES.new(self.auth_key, AES.MODE_ECB)
-        return aes.encrypt(random_string)
+        return cipher(self.auth_key).encrypt(random_string)
 
-    async def _send_encoded_key(self, data):
+    def _encoded_key(self, data):
         cmd = struct.pack('<2s', b'\x03\x00') + \
             self._encrypt_string_with_key(data)
-        send_cmd = struct.pack('<18s', cmd)
-        await self.write(send_cmd)
-        await asyncio.sleep(self.wac.timeout)
-
-    async def _callback(self, char_specifier, data):
-        print(f"LOG [AUTH]: {data}")
-        if data[:3] == b'\x10\x01\x01':
-            await self.write(RANDOM_BYTE)
-        elif data[:3] == b'\x10\x01\x04':
+        return struct.pack('<18s', cmd)
+
+    async def authenticate(self, retries=DEFAULT_RETRIES):
+        t0 = time.perf_counter()
+        self.wac.state = AUTH_STATES.REQUESTING_RN
+        data = await self.request(RANDOM_BYTE, 0x02, self.wac.timeout, retries)
+        if data[2] != SUCCESS:
+            self.wac.state = AUTH_STATES.REQUEST_RN_ERROR
+            raise ProtocolError(self.wac.state)
+        self.wac.state = AUTH_STATES.SENDING_ENCRYPTED_KEY
+        data = await self.request(self._encoded_key(data[3:19]), 0x03, self.wac.timeout, retries)
+        if data[2] != SUCCESS:
+            self.wac.state = AUTH_STATES.ENCRYPTION_KEY_FAILED
+            raise ProtocolError(self.wac.state)
+        self.wac.state = AUTH_STATES.AUTH_OK
+        AUTH_SECONDS.observe(time.perf_counter() - t0)
+        logger.info("authenticated in %.3fs", time.perf_counter() - t0)
+        return self.wac.state
+
+    def _callback(self, char_specifier, data):
+        NOTIFICATIONS.inc()
+        NOTIFICATION_BYTES.inc(len(data))
+        logger.debug("auth: %r", data)
+        if self._resolve(data):
+            return
+        if data[:3] == b'\x10\x01\x04':
             self.wac.state = AUTH_STATES.KEY_SENDING_FAILED
-        elif data[:3] == b'\x10\x02\x01':
-            random_string = data[3:]
-            await self._send_encoded_key(random_string)
         elif data[:3] == b'\x10\x02\x04':
             self.wac.state = AUTH_STATES.REQUEST_RN_ERROR
-        elif data[:3] == b'\x10\x03\x01':
-            self.wac.state = AUTH_STATES.AUTH_OK
         elif data[:3] == b'\x10\x03\x04':
-            self.wac.status = AUTH_STATES.ENCRYPTION_KEY_FAILED
-            # self.device._send_key()
-        else:
+            self.wac.state = AUTH_STATES.ENCRYPTION_KEY_FAILED
+        elif data[:3] != b'\x10\x01\x01':
             self.wac.state = AUTH_STATES.AUTH_FAILED
 
     async def connect(self):
-        await self.write(RANDOM_BYTE)
-        await asyncio.sleep(self.wac.timeout)
-
-    async def init_handler(self):
-        await self.client.start_notify(self.char_specifier, self._callback)
+        return await self.authenticate()
 
     async def stop_handler(self):
-        print("stopping handler")
+        logger.debug("stopping auth handler")
         await self.client.stop_notify(self.char_specifier)
+        self.notifying = False
 
 
 class Chunked(Characteristic):
-    def __init__(self, char_specifier: str, client: BleakClient) -> None:
+    """
+    + chunks are <flags> <count> header + a slice of a memoryview of the payload,
+      sized from the negotiated MTU (17 bytes at the default MTU of 23)
+    + written without response one after the other, at most `window`
+      chunks queued behind the write in flight
+    + bytes_per_second is updated after every transfer
+    """
+
+    def __init__(self, char_specifier: str, client: BleakClient, window=CHUNK_WINDOW) -> None:
         super().__init__(char_specifier, client)
+        self.window = window
+        self.bytes_per_second = None
+
+    def chunk_length(self):
+        # ATT write header is 3 bytes, the chunk header another 3
+        mtu = getattr(self.client, "mtu_size", None) or 23
+        return max(MAX_CHUNKLENGTH, mtu - 6)
 
     async def write(self, data_type, data):
-        remaining = len(data)
-        count = 0
-        while (remaining > 0):
-            copybytes = min(remaining, MAX_CHUNKLENGTH)
-            chunk = b''
-            flag = 0
-            if remaining <= MAX_CHUNKLENGTH:
-                flag |= 0x80
-                if count == 0:
-                    flag |= 0x40
-            elif count > 0:
-                flag |= 0x40
-
-            chunk += b'\x00'
-            chunk += bytes([flag | data_type])
-            chunk += bytes([count & 0xff])
-            chunk += data[(count * MAX_CHUNKLENGTH)                          :(count*MAX_CHUNKLENGTH)+copybytes]
-            count += 1
-            await self.client.write_gatt_char(self.char_specifier, chunk)
-            remaining -= copybytes
+        view = memoryview(data).cast("B")
+        length = self.chunk_length()
+        total = len(view)
+        in_flight = deque()
+        previous = None
+        t0 = time.perf_counter()
+        try:
+            for count, offset in enumerate(range(0, total, length)):
+                last = offset + length >= total
+                if last:
+                    flag = 0xc0 if count == 0 else 0x80
+                else:
+                    flag = 0x40 if count > 0 else 0x00
+                # bytes + memoryview copies the slice once, straight into the packet
+                chunk = bytes((0x00, flag | data_type, count & 0xff)) + view[offset:offset + length]
+                previous = asyncio.ensure_future(self._write_after(previous, chunk))
+                in_flight.append(previous)
+                if len(in_flight) >= self.window:
+                    await in_flight.popleft()
+            while in_flight:
+                await in_flight.popleft()
+        finally:
+            # a failed write leaves the rest of the window queued, none of it may go out
+            for write in in_flight:
+                write.cancel()
+            await asyncio.gather(*in_flight, return_exceptions=True)
+        elapsed = time.perf_counter() - t0
+        self.bytes_per_second = total / elapsed if elapsed > 0 else float("inf")
+        return self.bytes_per_second
+
+    async def _write_after(self, previous, chunk):
+        # the band needs chunks in order and backends don't promise to keep it
+        # for concurrent writes (BlueZ retries an InProgress write after a sleep),
+        # so each write waits for the one before; the window only queues ahead
+        if previous is not None:
+            await previous
+        await self.client.write_gatt_char(self.char_specifier, chunk, response=False)
 
 
 class MusicChar(Characteristic):
@@ -280,74 +857,216 @@ class MusicChar(Characteristic):
         super().__init__(char_specifier, client)
         self._callback = callback
 
-    async def init_handler(self):
-        await self.client.start_notify(self.char_specifier, self._callback)
+
+MUSIC_COMMANDS = {
+    0x00: "play",
+    0x01: "pause",
+    0x03: "next",
+    0x04: "previous",
+    0x05: "volume_up",
+    0x06: "volume_down",
+    0xe0: "open",
+    0xe1: "close",
+}
+MUSIC_FIELDS = ("state", "artist", "album", "track", "duration", "position", "volume")
+MUSIC_DEBOUNCE = 0.5
+MUSIC_MAX_DELAY = 2.0
+# the band advances the position itself while playing, only correct real jumps
+POSITION_SLACK = 3
 
 
 class Music:
-    def __init__(self, client: BleakClient) -> None:
+    """
+    + update() diffs against what the band last got and sends after things
+      settle for `debounce` seconds (at most `max_delay` after the first change)
+    + position only changes are sent when they drift from where the band
+      thinks playback is by more than POSITION_SLACK seconds
+    + 0xe0 (music screen opened) is answered from the cached encoded buffer
+    + band commands go to callbacks registered with on("play", callback)
+    + with a status.NotificationHub the music characteristic, which is also
+      the device event one, is shared with other listeners
+    + write(payload) sends the encoded state, by default straight to the
+      chunked characteristic; the daemon passes one that takes the band lock
+    + cancel() drops a pending debounced send, for when the link goes away
+    """
+
+    def __init__(self, client: BleakClient, artist="", album="", track="", registry: GattRegistry = None,
+                 state=MUSIC_STATE.PLAYED, duration=0, position=0, volume=50,
+                 debounce=MUSIC_DEBOUNCE, max_delay=MUSIC_MAX_DELAY, hub=None, write=None) -> None:
+        self.artist = artist
+        self.album = album
+        self.track = track
+        self.state = state
+        self.duration = duration
+        self.position = position
+        self.volume = volume
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.listeners = {}
+        self.hub = hub
+        self.sends = 0
+        self.skipped = 0
+        self._encoded = None
+        self._sent = None
+        self._sent_at = None
+        self._changed_at = None
+        self._timer = None
+        self._flushes = set()
+        self._lock = asyncio.Lock()
+        self.write = write or self._write_chunked
         self.chunked = Chunked(
-            UUIDS.CHARACTERISTIC_CHUNKED_TRANSFER, client)
+            resolve(registry, UUIDS.CHARACTERISTIC_CHUNKED_TRANSFER), client)
         self.music_char = MusicChar(
-            UUIDS.CHARACTERISTIC_MUSIC_NOTIFICATION, client, self._callback)
+            resolve(registry, UUIDS.CHARACTERISTIC_MUSIC_NOTIFICATION), client, self._callback)
 
     async def init_handler(self):
-        await self.music_char.init_handler()
+        if self.hub is not None:
+            await self.hub.subscribe(self.music_char.char_specifier, self._callback)
+        else:
+            await self.music_char.init_handler()
+
+    def on(self, command, callback):
+        """Call callback(command) when the band sends command (see MUSIC_COMMANDS)."""
+        self.listeners.setdefault(command, []).append(callback)
 
     async def _callback(self, _, data):
-        cmd = data[1:][0] if len(data[1:]) > 0 else None
-        if cmd == 0xe0:
-            await self.set_music()
-        elif cmd == 0xe1:
-            print("out")
-        elif cmd == 0x00:
-            print("play")
-        elif cmd == 0x01:
-            print("pause")
-
-    async def set_music(self):
-        flag = 0x00
-        flag |= 0x01
+        if len(data) < 2 or data[0] != MUSIC_STATE.CONTROL:
+            # the other device events share the characteristic, status.py has those
+            return
+        command = MUSIC_COMMANDS.get(data[1])
+        if command == "open":
+            await self._send_settled(force=True)
+        elif command is None:
+            logger.debug("music: unknown command %r", bytes(data))
+            return
+        logger.info("music: %s", command)
+        for callback in self.listeners.get(command, ()):
+            result = callback(command)
+            if asyncio.iscoroutine(result):
+                await result
+
+    def snapshot(self):
+        return {field: getattr(self, field) for field in MUSIC_FIELDS}
+
+    def encode(self):
         buf = b''
         null = b'\x00'
-        flag |= 0x02
-        buf += "self.artist".encode('utf-8') + null
-        flag |= 0x04
-        buf += "self.album".encode('utf-8') + null
-        flag |= 0x08
-        buf += "self.track".encode('utf-8') + null
-        flag |= 0x10
-        buf += struct.pack('<H', 69)
-        flag |= 0x40
-        buf += bytes([69]) + null
-        position = struct.pack('<H', 30)
-        buf = bytes([flag, 1, 0x00]) + position + buf
-        await self.chunked.write(3, buf)
+        flag = 0x01 | 0x02 | 0x04 | 0x08 | 0x10 | 0x40
+        buf += self.artist.encode('utf-8') + null
+        buf += self.album.encode('utf-8') + null
+        buf += self.track.encode('utf-8') + null
+        buf += struct.pack('<H', self.duration)
+        buf += bytes([self.volume]) + null
+        playing = 1 if self.state == MUSIC_STATE.PLAYED else 0
+        return bytes([flag, playing, 0x00]) + struct.pack('<H', self.position) + buf
+
+    def buffer(self):
+        """The encoded state, re-encoded only when a field changed."""
+        state = self.snapshot()
+        if self._encoded is None or self._encoded[0] != state:
+            self._encoded = (state, self.encode())
+        return self._encoded[1]
+
+    def _expected_position(self):
+        if self._sent is None:
+            return None
+        position = self._sent["position"]
+        if self._sent["state"] == MUSIC_STATE.PLAYED:
+            position += int(time.monotonic() - self._sent_at)
+        return position
+
+    def _needs_send(self):
+        if self._sent is None:
+            return True
+        current = self.snapshot()
+        if any(current[f] != self._sent[f] for f in MUSIC_FIELDS if f != "position"):
+            return True
+        return abs(current["position"] - self._expected_position()) > POSITION_SLACK
+
+    def update(self, **fields):
+        """Change some of MUSIC_FIELDS, the band hears about it once updates settle."""
+        for field, value in fields.items():
+            if field not in MUSIC_FIELDS:
+                raise TypeError(f"unknown music field {field!r}")
+            setattr(self, field, value)
+        if not self._needs_send():
+            self.skipped += 1
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if self._changed_at is None:
+            self._changed_at = now
+        if self._timer is not None:
+            self._timer.cancel()
+        delay = min(self.debounce, self._changed_at + self.max_delay - now)
+        self._timer = loop.call_later(max(0.0, delay), self._flush)
+
+    def _flush(self):
+        self._timer = None
+        self._changed_at = None
+        task = asyncio.ensure_future(self._send_settled())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _send_settled(self, force=False):
+        try:
+            await self.set_music(force)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # nobody awaits these sends, the next update or open tries again
+            logger.exception("music: sending the update failed")
+
+    def cancel(self):
+        """Drop the pending debounced send and any still in flight."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._changed_at = None
+        for task in self._flushes:
+            task.cancel()
+
+    async def _write_chunked(self, payload):
+        await self.chunked.write(3, payload)
+
+    async def set_music(self, force=False):
+        """Send the current state, unless nothing changed and not forced."""
+        async with self._lock:
+            if not force and not self._needs_send():
+                self.skipped += 1
+                return False
+            await self.write(self.buffer())
+            self._sent = self.snapshot()
+            self._sent_at = time.monotonic()
+            self.sends += 1
+            return True
+
+
+CHARACTERISTIC_TYPES = {
+    "AUTH": AuthenticateChar,
+    "STEP": StepChar,
+    "BATTERY": BatteryChar,
+}
+DEFAULT_TYPES = {
+    UUIDS.CHARACTERISTIC_AUTH: "AUTH",
+    UUIDS.CHARACTERISTIC_STEPS: "STEP",
+    UUIDS.CHARACTERISTIC_BATTERY: "BATTERY",
+}
 
 
 async def main():
-    b = None
-    while b is None:
-        try:
-            a = Wac(MAC_ADDRESS)
-            b = await a.connect()
-        except Exception:
-            print("retrying")
-    auth_char = await a.createChar(UUIDS.CHARACTERISTIC_AUTH, special_type="AUTH")
-    await auth_char.init_handler()
-    await auth_char.connect()
+    from supervisor import Supervisor
+    address, auth_key = load_secret()
+    supervisor = Supervisor(address, auth_key, gatt_cache_dir="gatt_cache")
+    await supervisor.connect()
     # auth_desc = Descriptor(97, a.client)
     # await auth_desc.write(b"\x01\x00")
     # try:
     # step = await a.createChar(UUIDS.CHARACTERISTIC_STEPS, "STEP")
     # print(await step.read())
 
-    current_time = await a.createChar(UUIDS.CHARACTERISTIC_CURRENT_TIME)
-    current_time = await current_time.read()
-    utc_offset = current_time[9:11]
-
-    activity_getter = ActivityGetter(utc_offset, a.client)
-    await activity_getter.get()
+    from store import ActivityStore
+    await supervisor.sync(ActivityStore())
 
     # custom_alert = await a.createChar(UUIDS.CHARACTERISTIC_CUSTOM_ALERT)
     # await custom_alert.write(bytes('\x05\x01' + "ur mom" + '\x0a\x0a\x0a' + "omega lul", 'utf-8'), True)
@@ -361,10 +1080,12 @@ async def main():
     # except Exception as e:
     #     print(e)
     # await auth.stop_handler()
+    await supervisor.close()
 
 
 if __name__ == "__main__":
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.create_task(main())
-    loop.run_forever()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)-15s %(name)-8s %(levelname)s: %(message)s",
+    )
+    asyncio.run(main())
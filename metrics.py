@@ -0,0 +1,146 @@
+"""
+Metrics
+-------
+
+A small process wide metrics registry: counters, gauges and fixed bucket
+histograms, exported as a Prometheus text file or a JSON snapshot. Updating a
+metric is an attribute add (plus a bisect for histograms), cheap enough for
+notification callbacks.
+
+    from metrics import REGISTRY
+    PACKETS = REGISTRY.counter("miband_activity_packets_total", "activity notifications")
+    PACKETS.inc()
+    REGISTRY.write("metrics.prom")
+
+"""
+
+import json
+import time
+
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help) -> None:
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield f'{self.name}_bucket{{le="{le}"}}', cumulative
+        yield f"{self.name}_sum", self.sum
+        yield f"{self.name}_count", self.count
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "buckets": dict(zip([repr(b) for b in self.buckets] + ["+Inf"], self.counts)),
+        }
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.t0)
+        return False
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics = {}
+        self.started = time.time()
+
+    def _register(self, metric):
+        # modules imported twice (e.g. main as __main__) share their metrics
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def gauge(self, name, help):
+        return self._register(Gauge(name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def to_prometheus(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {
+            "uptime": time.time() - self.started,
+            "metrics": {m.name: m.snapshot() for m in self.metrics.values()},
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def write(self, path):
+        """Write a .json snapshot or, for any other suffix, Prometheus text."""
+        with open(path, "w") as f:
+            f.write(self.to_json() if path.endswith(".json") else self.to_prometheus())
+
+
+REGISTRY = Registry()
@@ -0,0 +1,117 @@
+"""
+Now Playing
+-----------
+
+Feeds main.Music from a now-playing source. A source is anything with an
+async read() returning a dict of main.MUSIC_FIELDS (a subset is fine), or
+None when nothing changed since the last read:
+
++ FileSource polls a JSON file written by a player hook, re-reading it only
+  when its mtime changes
++ StaticSource is set() by hand, for tests and scripts
+
+    {"artist": "Boards of Canada", "track": "Roygbiv", "state": "playing",
+     "duration": 151, "position": 42}
+
+Music does the diffing and debouncing, so sources can report as often as they
+like.
+
+    sync = MusicSync(Music(wac.client, registry=wac.registry), FileSource("now_playing.json"))
+    await sync.start()
+
+"""
+
+import asyncio
+import json
+import logging
+import os
+
+from constants import MUSIC_STATE
+from main import MUSIC_FIELDS, Music
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 1.0
+STATES = {"playing": MUSIC_STATE.PLAYED, "paused": MUSIC_STATE.PAUSED}
+
+
+def normalize(fields):
+    """Keep the known fields, with "playing"/"paused" mapped to MUSIC_STATE."""
+    fields = {k: v for k, v in fields.items() if k in MUSIC_FIELDS}
+    if isinstance(fields.get("state"), str):
+        fields["state"] = STATES[fields["state"]]
+    for field in ("duration", "position", "volume"):
+        if field in fields:
+            fields[field] = int(fields[field])
+    return fields
+
+
+class StaticSource:
+    def __init__(self, **fields) -> None:
+        self.fields = normalize(fields)
+        self.changed = True
+
+    def set(self, **fields):
+        self.fields.update(normalize(fields))
+        self.changed = True
+
+    async def read(self):
+        if not self.changed:
+            return None
+        self.changed = False
+        return dict(self.fields)
+
+
+class FileSource:
+    def __init__(self, path) -> None:
+        self.path = path
+        self.mtime = None
+
+    async def read(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if mtime == self.mtime:
+            return None
+        self.mtime = mtime
+        try:
+            with open(self.path, "r") as f:
+                return normalize(json.load(f))
+        except (ValueError, KeyError) as e:
+            # a player halfway through writing the file, try again next poll
+            logger.debug("unreadable now playing file: %r", e)
+            self.mtime = None
+            return None
+
+
+class MusicSync:
+    def __init__(self, music: Music, source, poll_interval=POLL_INTERVAL) -> None:
+        self.music = music
+        self.source = source
+        self.poll_interval = poll_interval
+        self._task = None
+
+    async def poll(self):
+        fields = await self.source.read()
+        if fields:
+            self.music.update(**fields)
+        return fields
+
+    async def run(self):
+        while True:
+            await self.poll()
+            await asyncio.sleep(self.poll_interval)
+
+    async def start(self):
+        await self.music.init_handler()
+        self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,139 @@
+"""
+Activity Pipeline
+-----------------
+
+Moves the CPU heavy end of a sync off the event loop. With a Pipeline the
+activity notification callback only checks the packet counter and queues the
+raw packet; a worker thread decodes it into an ActivityBatch and, at the end
+of every fetch window, commits the window to the store, which also updates
+the day columns and rollups. SQLite gives up the GIL while it works, so the
+loop keeps answering notifications, other bands and alerts meanwhile.
+
++ packets are handed over `chunk` at a time, a thread woken per packet
+  would spend more on GIL handoffs than the decode it takes off the loop
++ the queue to the worker is bounded (`maxsize` chunks); what a callback
+  can't queue is parked and pushed by backpressure(), which the fetch loop
+  awaits before it asks for the next window, so the band waits, not memory
++ join() waits until everything queued is committed and re-raises the first
+  error the worker hit
++ batches holds the decoded session, like ActivityGetter.batches
+
+    getter = ActivityGetter(utc_offset, client, store=store, offload=True)
+    session = await getter.fetch()
+
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+
+from collections import deque
+
+from main import ACTIVITY_SAMPLES, ActivityBatch
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_QUEUE_SIZE = 64
+PIPELINE_CHUNK = 64
+_COMMIT = object()
+_STOP = object()
+
+
+class Pipeline:
+    def __init__(self, store=None, maxsize=PIPELINE_QUEUE_SIZE, chunk=PIPELINE_CHUNK, keep_session=True) -> None:
+        self.store = store
+        self.chunk = chunk
+        self.keep_session = keep_session
+        self.queue = queue.Queue(maxsize)
+        self.overflow = deque()
+        self.batches = []
+        self.committed = 0
+        self.errors = []
+        self._window = []
+        self._packets = []
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, name="activity-pipeline", daemon=True)
+            self._thread.start()
+        return self
+
+    def submit(self, start_minute, data):
+        """Queue a raw activity packet, never blocks: called from notification callbacks."""
+        self._packets.append((start_minute, bytes(data)))
+        if len(self._packets) >= self.chunk:
+            self._flush()
+
+    def commit(self):
+        """Commit everything submitted so far as one window."""
+        if self._thread is not None:
+            self._flush()
+            self._put(_COMMIT)
+
+    def _flush(self):
+        if self._packets:
+            self._put(self._packets)
+            self._packets = []
+
+    def _put(self, item):
+        if not self.overflow:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+        self.overflow.append(item)
+
+    async def backpressure(self):
+        """Push what callbacks parked, waiting for the worker to make room."""
+        loop = asyncio.get_running_loop()
+        while self.overflow:
+            # only popped once queued, callbacks keep parking behind it meanwhile
+            await loop.run_in_executor(None, self.queue.put, self.overflow[0])
+            self.overflow.popleft()
+
+    async def join(self):
+        await self.backpressure()
+        await asyncio.get_running_loop().run_in_executor(None, self.queue.join)
+        if self.errors:
+            raise self.errors[0]
+
+    async def close(self):
+        if self._thread is None:
+            return
+        try:
+            await self.join()
+        finally:
+            self._put(_STOP)
+            await self.backpressure()
+            await asyncio.get_running_loop().run_in_executor(None, self._thread.join)
+            self._thread = None
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _STOP:
+                    return
+                if item is _COMMIT:
+                    self._commit()
+                else:
+                    batches = [ActivityBatch.decode(start_minute, data) for start_minute, data in item]
+                    ACTIVITY_SAMPLES.inc(sum(len(batch) for batch in batches))
+                    self._window += batches
+                    if self.keep_session:
+                        self.batches += batches
+            except Exception as e:
+                logger.exception("activity pipeline failed")
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def _commit(self):
+        window, self._window = self._window, []
+        if self.store is not None and window:
+            added = self.store.commit(window)
+            self.committed += added
+            logger.info("committed %d new samples up to minute %d", added, window[-1].end_minute)
@@ -0,0 +1,316 @@
+"""
+GATT Recorder
+-------------
+
+Captures the GATT traffic of a session to a compact binary log and plays it
+back offline, so a slow or failed sync can be rerun against the decoders as
+often as needed:
+
++ Recorder wraps a BleakClient (or anything shaped like one) and appends
+  every write, read and notification, plus the GATT table at connect; the
+  file is closed on disconnect and appended to again on the next connect
++ Replayer memory-maps a log and yields its records as memoryviews into it
++ ReplayClient stands in for a BleakClient from a log: each write or read
+  releases the notifications recorded after it, at the original pace scaled
+  by `speed` or, with speed=None, as fast as the callbacks take them
+
+The log is MAGIC followed by records, each a RECORD header
+
+    <length u32> <kind u8> <time.monotonic() f64> <characteristic uuid, 16 bytes>
+
+and `length` payload bytes. Descriptors and the GATT table (with the MTU)
+record a zero uuid.
+
+    wac = Wac(address, auth_key=key, record="sync.mbr")
+    ...
+    wac = Wac("replay", auth_key=key, client=ReplayClient("sync.mbr"))
+
+"""
+
+import asyncio
+import json
+import mmap
+import struct
+import time
+import uuid as uuidlib
+
+from datetime import datetime, timedelta
+
+from constants import UUIDS
+from main import ProtocolError
+
+MAGIC = b"MBREC\x01"
+RECORD = struct.Struct("<IBd16s")
+WRITE = 0
+WRITE_RESPONSE = 1
+READ = 2
+NOTIFY = 3
+DESCRIPTOR_WRITE = 4
+SERVICES = 5
+KINDS = {WRITE: "write", WRITE_RESPONSE: "write_response", READ: "read", NOTIFY: "notify",
+         DESCRIPTOR_WRITE: "descriptor_write", SERVICES: "services"}
+NO_UUID = bytes(16)
+# writes and reads are what the client does, replay lines them up on these
+SYNC_POINTS = (WRITE, WRITE_RESPONSE, READ)
+FLUSH_BYTES = 64 * 1024
+
+
+def _uuid(char_specifier):
+    return str(getattr(char_specifier, "uuid", char_specifier)).lower()
+
+
+class Recorder:
+    def __init__(self, client, path) -> None:
+        self.client = client
+        self.path = path
+        self.records = 0
+        self._uuids = {}
+        self._buffer = bytearray()
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+
+    def __getattr__(self, name):
+        # everything not recorded goes straight to the client
+        return getattr(self.client, name)
+
+    def _uuid_bytes(self, char_specifier):
+        if isinstance(char_specifier, int):
+            # a handle, bleak resolves it against the discovered services
+            char_specifier = self.client.services.get_characteristic(char_specifier)
+        key = _uuid(char_specifier)
+        raw = self._uuids.get(key)
+        if raw is None:
+            raw = self._uuids[key] = uuidlib.UUID(key).bytes
+        return raw
+
+    def append(self, kind, raw_uuid, data):
+        self._buffer += RECORD.pack(len(data), kind, time.monotonic(), raw_uuid)
+        self._buffer += data
+        self.records += 1
+        if len(self._buffer) >= FLUSH_BYTES:
+            self.flush()
+
+    def flush(self):
+        if self._file.closed:
+            # disconnected, what is left goes out after the next connect
+            return
+        self._file.write(self._buffer)
+        self._file.flush()
+        self._buffer.clear()
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    async def connect(self, **kwargs):
+        if self._file.closed:
+            self._file = open(self.path, "ab")
+        result = await self.client.connect(**kwargs)
+        from gatt_cache import table_from_services
+        table = table_from_services(self.client.services)
+        # chunk sizes follow the MTU, a replay needs the same one
+        table["mtu_size"] = getattr(self.client, "mtu_size", None)
+        self.append(SERVICES, NO_UUID, json.dumps(table).encode())
+        return result
+
+    async def disconnect(self):
+        try:
+            return await self.client.disconnect()
+        finally:
+            self.close()
+
+    async def write_gatt_char(self, char_specifier, data, response=False):
+        self.append(WRITE_RESPONSE if response else WRITE, self._uuid_bytes(char_specifier), data)
+        return await self.client.write_gatt_char(char_specifier, data, response=response)
+
+    async def read_gatt_char(self, char_specifier, **kwargs):
+        data = await self.client.read_gatt_char(char_specifier, **kwargs)
+        self.append(READ, self._uuid_bytes(char_specifier), data)
+        return data
+
+    async def write_gatt_descriptor(self, handle, data):
+        self.append(DESCRIPTOR_WRITE, NO_UUID, data)
+        return await self.client.write_gatt_descriptor(handle, data)
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        raw_uuid = self._uuid_bytes(char_specifier)
+
+        def recorded(sender, data):
+            self.append(NOTIFY, raw_uuid, data)
+            return callback(sender, data)
+        return await self.client.start_notify(char_specifier, recorded, **kwargs)
+
+
+class Replayer:
+    """
+    + records() yields (kind, timestamp, uuid, payload), payload a memoryview
+      into the mapped log, valid until close()
+    + feed() pushes the notifications straight into callbacks by uuid, for
+      decoder benchmarks without any client in between
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a GATT recording")
+        self._view = memoryview(self._map)
+        self._uuids = {}
+
+    def _uuid(self, raw):
+        key = self._uuids.get(raw)
+        if key is None:
+            key = self._uuids[raw] = str(uuidlib.UUID(bytes=raw)) if raw != NO_UUID else None
+        return key
+
+    def records(self):
+        view, offset, end = self._view, len(MAGIC), len(self._view)
+        unpack_from, size = RECORD.unpack_from, RECORD.size
+        while offset + size <= end:
+            length, kind, timestamp, raw = unpack_from(view, offset)
+            offset += size
+            if offset + length > end:
+                # the capture was cut off mid record
+                break
+            yield kind, timestamp, self._uuid(raw), view[offset:offset + length]
+            offset += length
+
+    def services(self):
+        """The recorded GATT table, or None."""
+        for kind, _, _, payload in self.records():
+            if kind == SERVICES:
+                return json.loads(bytes(payload))
+        return None
+
+    def feed(self, callbacks, sender=None):
+        """Call callbacks[uuid](sender, payload) per notification, returns how many."""
+        count = 0
+        for kind, _, uuid, payload in self.records():
+            if kind != NOTIFY:
+                continue
+            callback = callbacks.get(uuid)
+            if callback is not None:
+                callback(sender, payload)
+                count += 1
+        return count
+
+    def close(self):
+        if getattr(self, "_view", None) is not None:
+            self._view.release()
+            self._view = None
+        self._map.close()
+        self._file.close()
+
+
+class ReplayClient:
+    def __init__(self, path, speed=None, strict=True) -> None:
+        from fake_band import load_specs, services_from_table
+        self.replayer = Replayer(path)
+        # payloads are copied out, callbacks may keep them past close()
+        self.records = [(kind, timestamp, uuid, bytes(payload))
+                        for kind, timestamp, uuid, payload in self.replayer.records()]
+        self.replayer.close()
+        table = next((json.loads(p) for kind, _, _, p in self.records if kind == SERVICES), None)
+        self.services = services_from_table(table) if table is not None else load_specs()[0]
+        self.speed = speed
+        self.strict = strict
+        self.address = path
+        self.mtu_size = (table or {}).get("mtu_size") or 23
+        self.is_connected = False
+        self.callbacks = {}
+        self.cursor = 0
+        self.delivered = 0
+        self._pump = None
+
+    def fetch_range(self):
+        """
+        (start, end) of the recorded sync: what it asked for first and where
+        the last window the band announced ends. Pass them to Wac.sync so the
+        replay asks for the same windows. (None, None) without a fetch.
+        """
+        from codec import FETCH_ACK, FETCH_START
+        start = end = None
+        for kind, _, uuid, payload in self.records:
+            if uuid != UUIDS.CHARACTERISTIC_FETCH:
+                continue
+            if start is None and kind in (WRITE, WRITE_RESPONSE) and payload[:2] == b"\x01\x01":
+                request = FETCH_START.decode(payload)
+                start = datetime(request.year, request.month, request.day, request.hour, request.minute)
+            elif kind == NOTIFY and payload[:3] == b"\x10\x01\x01":
+                ack = FETCH_ACK.decode(payload)
+                end = datetime(ack.year, ack.month, ack.day, ack.hour, ack.minute) + timedelta(minutes=ack.count)
+        return start, end
+
+    async def connect(self, **kwargs):
+        self.is_connected = True
+        return True
+
+    async def disconnect(self):
+        self.is_connected = False
+        if self._pump is not None:
+            self._pump.cancel()
+            self._pump = None
+        return True
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        self.callbacks[_uuid(char_specifier)] = callback
+
+    async def stop_notify(self, char_specifier):
+        self.callbacks.pop(_uuid(char_specifier), None)
+
+    async def write_gatt_descriptor(self, handle, data):
+        pass
+
+    async def read_gatt_descriptor(self, handle, **kwargs):
+        return bytearray()
+
+    async def write_gatt_char(self, char_specifier, data, response=False):
+        await self._sync(_uuid(char_specifier), (WRITE, WRITE_RESPONSE))
+
+    async def read_gatt_char(self, char_specifier, **kwargs):
+        return bytearray(await self._sync(_uuid(char_specifier), (READ,)))
+
+    async def _sync(self, uuid, kinds):
+        """Move to the next recorded write/read of uuid, release what followed it."""
+        if self._pump is not None:
+            # anything still owed from the previous request goes out first
+            await self._pump
+        for index in range(self.cursor, len(self.records)):
+            kind, timestamp, recorded_uuid, payload = self.records[index]
+            if kind in kinds and recorded_uuid == uuid:
+                break
+            if kind in SYNC_POINTS and self.strict:
+                raise ProtocolError(f"replay diverged: {KINDS[kind]} on {recorded_uuid} was recorded next, "
+                                    f"not {KINDS[kinds[0]]} on {uuid}")
+        else:
+            raise ProtocolError(f"replay exhausted: no {KINDS[kinds[0]]} on {uuid} left in the recording")
+        self.cursor = index + 1
+        self._pump = asyncio.ensure_future(self._release(timestamp))
+        return payload
+
+    async def _release(self, since):
+        # notifications recorded after the request, up to the next request
+        await asyncio.sleep(0)
+        start = time.monotonic()
+        while self.cursor < len(self.records):
+            kind, timestamp, uuid, payload = self.records[self.cursor]
+            if kind in SYNC_POINTS:
+                break
+            self.cursor += 1
+            if kind != NOTIFY:
+                continue
+            if self.speed:
+                delay = (timestamp - since) / self.speed - (time.monotonic() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            callback = self.callbacks.get(uuid)
+            if callback is not None:
+                self.delivered += 1
+                result = callback(uuid, bytearray(payload))
+                if asyncio.iscoroutine(result):
+                    # it may write, and writes wait for this pump
+                    asyncio.ensure_future(result)
+        self._pump = None
@@ -0,0 +1,230 @@
+"""
+Activity Rollups
+----------------
+
+Hourly, daily and weekly aggregates of the activity table, kept next to it in
+the same SQLite file and updated in the same transaction as every commit:
+
++ hour buckets touched by a fetch window are recomputed from its minutes
++ day buckets from those hours, week buckets (starting monday) from the days
++ per bucket: minutes, steps, intensity, heart rate count/sum/min/max and the
+  minutes spent in each activity category
+
+so a commit costs O(window) and a query over any range reads at most a
+handful of partial hours plus O(number of buckets) rollup rows. A heart rate
+of 0 or 255 means "not measured" and is left out of the heart rate figures.
+
+    query = ActivityQuery(store)
+    query.buckets("day", datetime(2024, 1, 1), datetime(2025, 1, 1))
+    query.summary(datetime(2024, 3, 1, 8, 30), datetime(2024, 3, 9, 17, 45))
+    query.resample(start, end, minutes=15)
+
+"""
+
+from datetime import datetime
+
+from main import from_minute, to_minute
+
+HOUR = 60
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+# epoch minute 0 is a thursday, weeks start on the monday 4 days later
+LEVELS = {"hour": (HOUR, 0), "day": (DAY, 0), "week": (WEEK, 4 * DAY)}
+FIELDS = ("minutes", "steps", "intensity", "hr_count", "hr_sum", "hr_min", "hr_max")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollup (
+    level INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    minutes INTEGER NOT NULL,
+    steps INTEGER NOT NULL,
+    intensity INTEGER NOT NULL,
+    hr_count INTEGER NOT NULL,
+    hr_sum INTEGER NOT NULL,
+    hr_min INTEGER,
+    hr_max INTEGER,
+    PRIMARY KEY (level, bucket)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_category (
+    level INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    category INTEGER NOT NULL,
+    minutes INTEGER NOT NULL,
+    PRIMARY KEY (level, bucket, category)
+) WITHOUT ROWID;
+"""
+
+# aggregates over activity minutes, with {bucket} the expression grouping them
+_FROM_MINUTES = """
+    SELECT {bucket}, COUNT(*), SUM(steps), SUM(intensity),
+           SUM(heart_rate > 0 AND heart_rate < 255),
+           TOTAL(CASE WHEN heart_rate > 0 AND heart_rate < 255 THEN heart_rate END),
+           MIN(CASE WHEN heart_rate > 0 AND heart_rate < 255 THEN heart_rate END),
+           MAX(CASE WHEN heart_rate > 0 AND heart_rate < 255 THEN heart_rate END)
+    FROM activity WHERE minute >= ? AND minute < ?
+"""
+_FROM_BUCKETS = """
+    SELECT {bucket}, SUM(minutes), SUM(steps), SUM(intensity), SUM(hr_count),
+           SUM(hr_sum), MIN(hr_min), MAX(hr_max)
+    FROM rollup WHERE level = ? AND bucket >= ? AND bucket < ?
+"""
+
+
+def bucket_start(minute, level):
+    size, offset = LEVELS[level]
+    return minute - (minute - offset) % size
+
+
+def bucket_end(minute, level):
+    """First bucket boundary at or after minute."""
+    start = bucket_start(minute, level)
+    return start if start == minute else start + LEVELS[level][0]
+
+
+def _bucket_sql(column, level):
+    size, offset = LEVELS[level]
+    return f"{column} - ({column} - {offset}) % {size}"
+
+
+def _replace(conn, level, start, end, select, params, category_select, category_params):
+    size = LEVELS[level][0]
+    conn.execute("DELETE FROM rollup WHERE level = ? AND bucket >= ? AND bucket < ?", (size, start, end))
+    conn.execute("DELETE FROM rollup_category WHERE level = ? AND bucket >= ? AND bucket < ?", (size, start, end))
+    conn.execute(f"INSERT INTO rollup SELECT {size}, * FROM ({select} GROUP BY 1)", params)
+    conn.execute(f"INSERT INTO rollup_category SELECT {size}, * FROM ({category_select} GROUP BY 1, 2)",
+                 category_params)
+
+
+def update(conn, start_minute, end_minute):
+    """Recompute every bucket overlapping [start_minute, end_minute), call inside the commit."""
+    start, end = bucket_start(start_minute, "hour"), bucket_end(end_minute, "hour")
+    _replace(conn, "hour", start, end,
+             _FROM_MINUTES.format(bucket=_bucket_sql("minute", "hour")), (start, end),
+             f"SELECT {_bucket_sql('minute', 'hour')}, category, COUNT(*) FROM activity "
+             "WHERE minute >= ? AND minute < ?", (start, end))
+    for finer, level in (("hour", "day"), ("day", "week")):
+        start, end = bucket_start(start, level), bucket_end(end, level)
+        fine = LEVELS[finer][0]
+        _replace(conn, level, start, end,
+                 _FROM_BUCKETS.format(bucket=_bucket_sql("bucket", level)), (fine, start, end),
+                 f"SELECT {_bucket_sql('bucket', level)}, category, SUM(minutes) FROM rollup_category "
+                 "WHERE level = ? AND bucket >= ? AND bucket < ?", (fine, start, end))
+
+
+def rebuild(conn):
+    """Recompute all rollups, for stores written before rollups existed."""
+    first, last = conn.execute("SELECT MIN(minute), MAX(minute) FROM activity").fetchone()
+    if first is not None:
+        update(conn, first, last + 1)
+
+
+def _summary(row):
+    summary = dict(zip(FIELDS, row))
+    summary["hr_mean"] = summary["hr_sum"] / summary["hr_count"] if summary["hr_count"] else None
+    return summary
+
+
+class ActivityQuery:
+    def __init__(self, store) -> None:
+        self.conn = store.conn
+        self.store = store
+
+    def buckets(self, level, start: datetime, end: datetime):
+        """[(bucket start, summary)] for every stored bucket of level in [start, end)."""
+        size = LEVELS[level][0]
+        cursor = self.conn.execute(
+            f"SELECT bucket, {', '.join(FIELDS)} FROM rollup "
+            "WHERE level = ? AND bucket >= ? AND bucket < ? ORDER BY bucket",
+            (size, bucket_start(to_minute(start), level), to_minute(end)))
+        return [(from_minute(bucket), _summary(row)) for bucket, *row in cursor]
+
+    def categories(self, level, start: datetime, end: datetime):
+        """{bucket start: {category: minutes}} for level in [start, end)."""
+        size = LEVELS[level][0]
+        result = {}
+        for bucket, category, minutes in self.conn.execute(
+                "SELECT bucket, category, minutes FROM rollup_category "
+                "WHERE level = ? AND bucket >= ? AND bucket < ? ORDER BY bucket",
+                (size, bucket_start(to_minute(start), level), to_minute(end))):
+            result.setdefault(from_minute(bucket), {})[category] = minutes
+        return result
+
+    def _segments(self, start, end):
+        """Cover [start, end) with the coarsest aligned buckets, raw minutes at the edges."""
+        segments = []
+        cursor = start
+        while cursor < end:
+            for level, coarser in (("week", None), ("day", "week"), ("hour", "day")):
+                size = LEVELS[level][0]
+                if bucket_start(cursor, level) == cursor and cursor + size <= end:
+                    # every whole bucket up to where the coarser level can take over
+                    stop = cursor + (end - cursor) // size * size
+                    if coarser is not None:
+                        stop = min(stop, _next_boundary(cursor, coarser))
+                    break
+            else:
+                level, stop = None, min(end, _next_boundary(cursor, "hour"))
+            if segments and segments[-1][0] == level and segments[-1][2] == cursor:
+                segments[-1] = (level, segments[-1][1], stop)
+            else:
+                segments.append((level, cursor, stop))
+            cursor = stop
+        return segments
+
+    def summary(self, start: datetime, end: datetime):
+        """Totals over any [start, end), from rollups wherever a whole bucket fits."""
+        start_minute, end_minute = to_minute(start), to_minute(end)
+        totals = dict.fromkeys(FIELDS, 0)
+        totals["hr_min"] = totals["hr_max"] = None
+        for level, lo, hi in self._segments(start_minute, end_minute):
+            if level is None:
+                row = self.conn.execute(_FROM_MINUTES.format(bucket="NULL"), (lo, hi)).fetchone()
+            else:
+                row = self.conn.execute(_FROM_BUCKETS.format(bucket="NULL"), (LEVELS[level][0], lo, hi)).fetchone()
+            for field, value in zip(FIELDS, row[1:]):
+                if value is None:
+                    continue
+                if field == "hr_min":
+                    totals[field] = value if totals[field] is None else min(totals[field], value)
+                elif field == "hr_max":
+                    totals[field] = value if totals[field] is None else max(totals[field], value)
+                else:
+                    totals[field] += value
+        return _summary([totals[field] for field in FIELDS])
+
+    def resample(self, start: datetime, end: datetime, minutes=15):
+        """
+        Ad-hoc aggregation into buckets of any size with numpy, for what the
+        rollups don't cover. Returns a dict of arrays indexed by bucket.
+        """
+        import numpy as np
+        start_minute, end_minute = to_minute(start), to_minute(end)
+        count = -(-(end_minute - start_minute) // minutes)
+        columns = {name: [] for name in ("minute", "category", "intensity", "steps", "heart_rate")}
+        for batch in self.store.batches(start_minute, end_minute):
+            for name, values in batch.as_numpy().items():
+                columns[name].append(values)
+        if not columns["minute"]:
+            columns = {name: np.zeros(0, dtype=np.int64) for name in columns}
+        else:
+            columns = {name: np.concatenate(values) for name, values in columns.items()}
+        index = (columns["minute"] - start_minute) // minutes
+        hr = columns["heart_rate"].astype(np.int64)
+        measured = (hr > 0) & (hr < 255)
+        hr_count = np.bincount(index[measured], minlength=count)
+        hr_sum = np.bincount(index[measured], weights=hr[measured], minlength=count)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            hr_mean = hr_sum / hr_count
+        return {
+            "start": np.arange(start_minute, start_minute + count * minutes, minutes, dtype=np.int64),
+            "minutes": np.bincount(index, minlength=count),
+            "steps": np.bincount(index, weights=columns["steps"], minlength=count).astype(np.int64),
+            "intensity": np.bincount(index, weights=columns["intensity"], minlength=count).astype(np.int64),
+            "hr_count": hr_count,
+            "hr_mean": hr_mean,
+        }
+
+
+def _next_boundary(minute, level):
+    """The first bucket boundary of level strictly after minute."""
+    return bucket_start(minute, level) + LEVELS[level][0]
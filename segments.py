@@ -0,0 +1,198 @@
+"""
+Activity Segments
+-----------------
+
+Finds sleep periods, walks, workouts and not worn/charging stretches in the
+stored minute columns. Everything is a numpy mask over whole arrays:
+
++ sleep: LIGHT_SLEEP/DEEP_SLEEP minutes, awake gaps up to SLEEP_GAP are
+  bridged, at least MIN_SLEEP long; light, deep and awake minutes are counted
++ walk: at least WALK_STEPS steps a minute, workout: WORKOUT_STEPS steps or a
+  measured heart rate of WORKOUT_HR, both bridging gaps up to ACTIVE_GAP and
+  at least MIN_ACTIVE long
++ not_worn/charging: runs of those categories
+
+A segment belongs to the day it starts on. Results are cached per day in the
+store's SQLite file together with the day column revisions they were computed
+from, those of every day its segments span plus REACH_DAYS on either side, so
+after a sync only the days around the new minutes and the days of segments
+running into them are recomputed.
+
+    index = SegmentIndex(store)
+    for segment in index.segments(datetime(2024, 3, 1), datetime(2024, 4, 1), kind="sleep"):
+        print(segment["start"], segment["minutes"], segment["deep"])
+
+"""
+
+from datetime import datetime
+
+import numpy as np
+
+from constants import ACTIVITY_CATEGORIES
+from main import from_minute, to_minute
+from store import DAY_MINUTES
+
+SLEEP_GAP = 20
+MIN_SLEEP = 30
+WALK_STEPS = 60
+WORKOUT_STEPS = 130
+WORKOUT_HR = 120
+ACTIVE_GAP = 2
+MIN_ACTIVE = 10
+# days before a segment's start and after its end a new minute can still change it
+REACH_DAYS = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segment (
+    kind TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    light INTEGER NOT NULL,
+    deep INTEGER NOT NULL,
+    awake INTEGER NOT NULL,
+    steps INTEGER NOT NULL,
+    hr_mean REAL,
+    PRIMARY KEY (kind, start)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS segment_day ON segment (day);
+CREATE TABLE IF NOT EXISTS segment_cache (
+    day INTEGER PRIMARY KEY,
+    revisions TEXT NOT NULL
+);
+"""
+
+
+def _runs(mask, gap=0, min_length=1):
+    """(starts, ends) of the True runs in mask, runs closer than gap are merged."""
+    edges = np.diff(np.concatenate(([0], mask.view(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    if gap and len(starts) > 1:
+        apart = starts[1:] - ends[:-1] > gap
+        starts = starts[np.concatenate(([True], apart))]
+        ends = ends[np.concatenate((apart, [True]))]
+    keep = ends - starts >= min_length
+    return starts[keep], ends[keep]
+
+
+def _sums(values, starts, ends):
+    total = np.concatenate(([0], np.cumsum(values, dtype=np.int64)))
+    return total[ends] - total[starts]
+
+
+def segment(columns, first_minute):
+    """
+    Segment day columns (see ActivityStore.day_columns) starting at
+    first_minute, returns {column: array} with one entry per segment.
+    """
+    present = np.frombuffer(columns["present"], dtype=np.uint8).astype(bool)
+    category = np.frombuffer(columns["category"], dtype=np.uint8)
+    steps = np.frombuffer(columns["steps"], dtype=np.uint8)
+    hr = np.frombuffer(columns["heart_rate"], dtype=np.uint8)
+    measured = present & (hr > 0) & (hr < 255)
+    light = present & (category == ACTIVITY_CATEGORIES.LIGHT_SLEEP)
+    deep = present & (category == ACTIVITY_CATEGORIES.DEEP_SLEEP)
+    workout = present & ((steps >= WORKOUT_STEPS) | (measured & (hr >= WORKOUT_HR)))
+
+    found = {
+        "sleep": _runs(light | deep, SLEEP_GAP, MIN_SLEEP),
+        "workout": _runs(workout, ACTIVE_GAP, MIN_ACTIVE),
+        "walk": _runs(present & (steps >= WALK_STEPS) & ~workout, ACTIVE_GAP, MIN_ACTIVE),
+        "not_worn": _runs(present & (category == ACTIVITY_CATEGORIES.NOT_WORN)),
+        "charging": _runs(present & (category == ACTIVITY_CATEGORIES.CHARGING)),
+    }
+    kinds = np.concatenate([np.full(len(s), kind, dtype=object) for kind, (s, _) in found.items()])
+    starts = np.concatenate([s for s, _ in found.values()])
+    ends = np.concatenate([e for _, e in found.values()])
+    hr_count = _sums(measured, starts, ends)
+    hr_sum = _sums(np.where(measured, hr, 0), starts, ends)
+    light_minutes = _sums(light, starts, ends)
+    deep_minutes = _sums(deep, starts, ends)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        hr_mean = hr_sum / hr_count
+    return {
+        "kind": kinds,
+        "start": starts + first_minute,
+        "end": ends + first_minute,
+        "light": light_minutes,
+        "deep": deep_minutes,
+        "awake": np.where(kinds == "sleep", ends - starts - light_minutes - deep_minutes, 0),
+        "steps": _sums(steps * present, starts, ends),
+        "hr_mean": hr_mean,
+    }
+
+
+class SegmentIndex:
+    def __init__(self, store) -> None:
+        self.store = store
+        self.conn = store.conn
+        self.conn.executescript(SCHEMA)
+
+    def _keys(self, days, revisions):
+        # segments starting on day can run for days, not_worn and charging especially
+        reach = dict(self.conn.execute("SELECT day, MAX(end) FROM segment GROUP BY day"))
+        keys = {}
+        for day in days:
+            last = max(day, (reach.get(day, 0) - 1) // DAY_MINUTES)
+            keys[day] = ",".join(str(revisions.get(d, 0)) for d in range(day - REACH_DAYS, last + REACH_DAYS + 1))
+        return keys
+
+    def _stale(self, revisions):
+        cached = dict(self.conn.execute("SELECT day, revisions FROM segment_cache"))
+        return [day for day, key in sorted(self._keys(revisions, revisions).items()) if cached.get(day) != key]
+
+    def refresh(self):
+        """Recompute the days whose minutes changed since they were cached, returns their count."""
+        revisions = self.store.day_revisions()
+        stale = self._stale(revisions)
+        spans = []
+        for day in stale:
+            if spans and spans[-1][1] == day:
+                spans[-1][1] = day + 1
+            else:
+                spans.append([day, day + 1])
+        with self.conn:
+            for first, last in spans:
+                # one day before so segments running over midnight keep their start
+                lo, hi = first - REACH_DAYS, last + REACH_DAYS
+                while True:
+                    found = segment(self.store.day_columns(lo, hi), lo * DAY_MINUTES)
+                    day = found["start"] // DAY_MINUTES
+                    keep = (day >= first) & (day < last)
+                    if not np.any(found["end"][keep] >= hi * DAY_MINUTES - SLEEP_GAP):
+                        break
+                    # a segment runs to the edge (or close enough to bridge it), see where it really ends
+                    hi += hi - lo
+                self.conn.execute("DELETE FROM segment WHERE day >= ? AND day < ?", (first, last))
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO segment VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    zip(found["kind"][keep].tolist(), found["start"][keep].tolist(), found["end"][keep].tolist(),
+                        day[keep].tolist(), found["light"][keep].tolist(), found["deep"][keep].tolist(),
+                        found["awake"][keep].tolist(), found["steps"][keep].tolist(),
+                        [None if h != h else h for h in found["hr_mean"][keep].tolist()]))
+            self.conn.executemany("INSERT OR REPLACE INTO segment_cache VALUES (?, ?)",
+                                  self._keys(stale, revisions).items())
+        return len(stale)
+
+    def segments(self, start: datetime, end: datetime, kind=None, refresh=True):
+        """Segments starting in [start, end), oldest first, optionally of one kind."""
+        if refresh:
+            self.refresh()
+        query = ("SELECT kind, start, end, light, deep, awake, steps, hr_mean FROM segment "
+                 "WHERE start >= ? AND start < ?")
+        params = [to_minute(start), to_minute(end)]
+        if kind is not None:
+            query += " AND kind = ?"
+            params.append(kind)
+        return [{
+            "kind": kind,
+            "start": from_minute(lo),
+            "end": from_minute(hi),
+            "minutes": hi - lo,
+            "light": light,
+            "deep": deep,
+            "awake": awake,
+            "steps": steps,
+            "hr_mean": hr_mean,
+        } for kind, lo, hi, light, deep, awake, steps, hr_mean in self.conn.execute(query + " ORDER BY start", params)]
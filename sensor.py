@@ -0,0 +1,160 @@
+"""
+Raw Sensor Capture
+------------------
+
+Raw accelerometer streaming. CHARACTERISTIC_SENSOR is told to stream
+(0x01 0x03 0x19, then 0x02), heart rate measurement is kept running with the
+same control point pings as heart_rate.py, and the band sends 20 byte packets
+on CHARACTERISTIC_HZ:
+
+    0x01 <seq> (x y z int16 little endian) * 3
+
+A packet is never decoded sample by sample: its 18 payload bytes are copied
+into a preallocated int16 (capacity, 3) numpy ring, which *is* the decoded
+form. Every `block` samples the finished part of the ring is appended to a
+spill file, which open_capture() maps back with numpy.memmap. An existing
+spill file is only replaced with overwrite=True, a new capture never mixes
+with an old one.
+
+    capture = AccelCapture(spill_path="accel.i16")
+    stream = SensorStream(wac.client, capture, registry=wac.registry)
+    await stream.start()
+
+"""
+
+import asyncio
+import logging
+
+import numpy as np
+
+from constants import QUEUE_TYPES, UUIDS
+from heart_rate import PING, PING_INTERVAL, START_CONTINUOUS, STOP_CONTINUOUS
+from main import resolve
+
+logger = logging.getLogger(__name__)
+
+ACCEL_DTYPE = np.dtype('<i2')
+SAMPLE_BYTES = 6
+PACKET_TYPES = {0x01: QUEUE_TYPES.RAW_ACCEL, 0x02: QUEUE_TYPES.RAW_HEART}
+ENABLE_RAW = b'\x01\x03\x19'
+START_RAW = b'\x02'
+STOP_RAW = b'\x03'
+
+
+class AccelCapture:
+    def __init__(self, capacity=3 * 4096, block=3 * 512, spill_path=None, overwrite=False) -> None:
+        if capacity % block or block % 3:
+            raise ValueError("block must be a multiple of 3 dividing capacity")
+        self.capacity = capacity
+        self.block = block
+        self.ring = np.zeros((capacity, 3), dtype=ACCEL_DTYPE)
+        self._raw = memoryview(self.ring).cast('B')
+        self.count = 0
+        self.packets = 0
+        self.lost = 0
+        self._seq = None
+        self._spilled = 0
+        self.spill = open(spill_path, "wb" if overwrite else "xb") if spill_path else None
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def write(self, data):
+        """Copy one raw accel packet into the ring, returns the samples taken."""
+        seq = data[1]
+        if self._seq is not None and seq != (self._seq + 1) & 0xff:
+            self.lost += (seq - self._seq - 1) & 0xff
+        self._seq = seq
+        payload = memoryview(data)[2:]
+        n = len(payload) // SAMPLE_BYTES
+        # packets are usually 3 samples but not always, one may straddle the wrap
+        offset = (self.count % self.capacity) * SAMPLE_BYTES
+        first = min(n * SAMPLE_BYTES, len(self._raw) - offset)
+        self._raw[offset:offset + first] = payload[:first]
+        self._raw[:n * SAMPLE_BYTES - first] = payload[first:n * SAMPLE_BYTES]
+        self.count += n
+        self.packets += 1
+        if self.spill is not None and self.count - self._spilled >= self.block:
+            self._flush(self.count - (self.count - self._spilled) % self.block)
+        return n
+
+    def _flush(self, upto):
+        while self._spilled < upto:
+            start = self._spilled % self.capacity
+            end = min(start + upto - self._spilled, self.capacity)
+            self.spill.write(self._raw[start * SAMPLE_BYTES:end * SAMPLE_BYTES])
+            self._spilled += end - start
+
+    def latest(self, n=None):
+        """The newest n samples as an (n, 3) array, oldest first."""
+        n = len(self) if n is None else min(n, len(self))
+        end = self.count % self.capacity
+        if n <= end:
+            return self.ring[end - n:end]
+        return np.concatenate((self.ring[self.capacity - (n - end):], self.ring[:end]))
+
+    def close(self):
+        if self.spill is not None:
+            self._flush(self.count)
+            self.spill.close()
+            self.spill = None
+
+
+def open_capture(path):
+    """Map a spill file back as a read only (samples, 3) int16 array."""
+    return np.memmap(path, dtype=ACCEL_DTYPE, mode="r").reshape(-1, 3)
+
+
+class SensorStream:
+    def __init__(self, client, capture: AccelCapture = None, ping_interval=PING_INTERVAL, registry=None) -> None:
+        self.client = client
+        self.capture = capture or AccelCapture()
+        self.ping_interval = ping_interval
+        self.sensor_char = resolve(registry, UUIDS.CHARACTERISTIC_SENSOR)
+        self.hz_char = resolve(registry, UUIDS.CHARACTERISTIC_HZ)
+        self.control_char = resolve(registry, UUIDS.CHARACTERISTIC_HEART_RATE_CONTROL)
+        self.raw_heart = []
+        self.error = None
+        self._ping_task = None
+
+    def _callback(self, _, data):
+        kind = PACKET_TYPES.get(data[0]) if data else None
+        if kind == QUEUE_TYPES.RAW_ACCEL:
+            self.capture.write(data)
+        elif kind == QUEUE_TYPES.RAW_HEART:
+            self.raw_heart.append(bytes(data))
+
+    async def start(self):
+        client = self.client
+        await client.write_gatt_char(self.sensor_char, ENABLE_RAW, response=False)
+        await client.start_notify(self.hz_char, self._callback)
+        await client.write_gatt_char(self.control_char, START_CONTINUOUS, response=True)
+        await client.write_gatt_char(self.sensor_char, START_RAW, response=False)
+        self._ping_task = asyncio.ensure_future(self._ping())
+
+    async def _ping(self):
+        try:
+            while True:
+                await asyncio.sleep(self.ping_interval)
+                await self.client.write_gatt_char(self.control_char, PING, response=True)
+        except Exception as e:
+            # without pings the band stops streaming, don't leave a capture that looks alive
+            logger.error("sensor stream ping failed, stopping: %r", e)
+            self.error = e
+            self._ping_task = None
+            try:
+                await self.stop()
+            except Exception as e:
+                logger.warning("sensor stream stop failed: %r", e)
+
+    async def stop(self):
+        if self._ping_task is not None:
+            self._ping_task.cancel()
+            self._ping_task = None
+        try:
+            await self.client.write_gatt_char(self.sensor_char, STOP_RAW, response=False)
+            await self.client.write_gatt_char(self.control_char, STOP_CONTINUOUS, response=True)
+            await self.client.stop_notify(self.hz_char)
+        finally:
+            # whatever reached the ring is kept, also when the link is gone
+            self.capture.close()
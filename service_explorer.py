@@ -13,61 +13,72 @@ import argparse
 import asyncio
 import logging
 
+import gatt_cache
 from bleak import BleakClient, BleakScanner
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_LIMIT = 8
 
-async def export_specs(client):
-    file = open("specs.txt", "w+")
+
+async def _read(semaphore, read, specifier):
+    async with semaphore:
+        try:
+            return True, await read(specifier)
+        except Exception as e:
+            return False, e
+
+
+async def export_specs(client, path="specs.txt", limit=DEFAULT_LIMIT):
+    """
+    Read every readable characteristic and every descriptor, at most `limit`
+    at a time, then write specs.txt in discovery order. Returns the GATT table
+    and the Software Revision string.
+    """
     logger.info("connected")
-    for service in client.services:
-        logger.info("[Service] %s", service)
-        file.write("[Service] %s\n" % service)
-
-        for char in service.characteristics:
-            if "read" in char.properties:
-                try:
-                    value = await client.read_gatt_char(char.uuid)
-                    logger.info(
-                        "  [Characteristic] %s (%s), Value: %r",
-                        char,
-                        ",".join(char.properties),
-                        value,
-                    )
-                    file.write("  [Characteristic] %s (%s), Value: %r\n" % (
-                        char, ",".join(char.properties), value))
-                except Exception as e:
-                    logger.error(
-                        "  [Characteristic] %s (%s), Error: %s",
-                        char,
-                        ",".join(char.properties),
-                        e,
-                    )
-                    file.write("  [Characteristic] %s (%s), Error: %r\n" % (
-                        char, ",".join(char.properties), value))
-
-            else:
-                logger.info(
-                    "  [Characteristic] %s (%s)", char, ",".join(
-                        char.properties)
-                )
-                file.write("  [Characteristic] %s (%s)\n" %
-                           (char, ",".join(char.properties)))
-
-            for descriptor in char.descriptors:
-                try:
-                    value = await client.read_gatt_descriptor(descriptor.handle)
-                    logger.info(
-                        "    [Descriptor] %s, Value: %r", descriptor, value)
-                    file.write("    [Descriptor] %s, Value: %r\n" %
-                               (descriptor, value))
-
-                except Exception as e:
-                    logger.error(
-                        "    [Descriptor] %s, Error: %s", descriptor, e)
-                    file.write("    [Descriptor] %s, Error: %r\n" %
-                               (descriptor, value))
+    semaphore = asyncio.Semaphore(limit)
+    chars = [char for service in client.services for char in service.characteristics]
+    descriptors = [d for char in chars for d in char.descriptors]
+    char_reads = await asyncio.gather(*(
+        _read(semaphore, client.read_gatt_char, char)
+        for char in chars if "read" in char.properties))
+    descriptor_reads = await asyncio.gather(*(
+        _read(semaphore, client.read_gatt_descriptor, d.handle) for d in descriptors))
+    char_values = dict(zip([c.handle for c in chars if "read" in c.properties], char_reads))
+    descriptor_values = dict(zip([d.handle for d in descriptors], descriptor_reads))
+
+    revision = None
+    with open(path, "w+") as file:
+        for service in client.services:
+            logger.info("[Service] %s", service)
+            file.write("[Service] %s\n" % service)
+
+            for char in service.characteristics:
+                properties = ",".join(char.properties)
+                if char.handle in char_values:
+                    ok, value = char_values[char.handle]
+                    if ok:
+                        logger.info("  [Characteristic] %s (%s), Value: %r", char, properties, value)
+                        file.write("  [Characteristic] %s (%s), Value: %r\n" % (char, properties, value))
+                        if char.uuid == gatt_cache.SOFTWARE_REVISION:
+                            revision = bytes(value).decode("utf-8", "replace")
+                    else:
+                        logger.error("  [Characteristic] %s (%s), Error: %s", char, properties, value)
+                        file.write("  [Characteristic] %s (%s), Error: %r\n" % (char, properties, value))
+                else:
+                    logger.info("  [Characteristic] %s (%s)", char, properties)
+                    file.write("  [Characteristic] %s (%s)\n" % (char, properties))
+
+                for descriptor in char.descriptors:
+                    ok, value = descriptor_values[descriptor.handle]
+                    if ok:
+                        logger.info("    [Descriptor] %s, Value: %r", descriptor, value)
+                        file.write("    [Descriptor] %s, Value: %r\n" % (descriptor, value))
+                    else:
+                        logger.error("    [Descriptor] %s, Error: %s", descriptor, value)
+                        file.write("    [Descriptor] %s, Error: %r\n" % (descriptor, value))
+
+    return gatt_cache.table_from_services(client.services), revision
 
 
 async def main(args: argparse.Namespace):
@@ -95,7 +106,12 @@ async def main(args: argparse.Namespace):
         device,
         services=args.services,
     ) as client:
-        export_specs(client)
+        table, revision = await export_specs(
+            client, getattr(args, "specs", "specs.txt"), getattr(args, "limit", DEFAULT_LIMIT))
+        if revision is not None:
+            gatt_cache.save(device.address, revision, table,
+                            getattr(args, "cache_dir", gatt_cache.CACHE_DIR))
+            logger.info("cached GATT table for %s firmware %s", device.address, revision)
 
         logger.info("disconnecting...")
 
@@ -131,6 +147,25 @@ if __name__ == "__main__":
         help="if provided, only enumerate matching service(s)",
     )
 
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=DEFAULT_LIMIT,
+        help="how many reads may be in flight at once",
+    )
+
+    parser.add_argument(
+        "--specs",
+        default="specs.txt",
+        help="where to write the human readable dump",
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        default=gatt_cache.CACHE_DIR,
+        help="where GATT tables are cached per device and firmware revision",
+    )
+
     parser.add_argument(
         "-d",
         "--debug",
@@ -0,0 +1,217 @@
+"""
+Device Status
+-------------
+
+A decoded, always current view of a band's steps, battery and device events,
+kept up to date by notifications instead of reads:
+
++ NotificationHub subscribes to a characteristic once and fans its
+  notifications out to any number of listeners. CHARACTERISTIC_DEVICE_EVENT
+  and CHARACTERISTIC_MUSIC_NOTIFICATION are the same characteristic, give
+  main.Music the hub to share it
++ DeviceStatus holds the latest steps and battery (as StepChar/BatteryChar
+  parse them) and the recent device events. A value that really changed bumps
+  `version` and calls the on(name) listeners with (name, old, new)
++ get() answers from the snapshot while the value is younger than `ttl`;
+  older or missing values are read once, concurrent callers share that read
+
+so a dashboard polling a band costs a GATT read per `ttl` at most, and none
+while the band keeps notifying.
+
+    status = DeviceStatus(wac)
+    await status.start()
+    status.on("steps", lambda name, old, new: print(new["steps"]))
+    await status.get("battery")
+
+"""
+
+import asyncio
+import logging
+import time
+
+from collections import deque
+
+from constants import MUSIC_STATE, UUIDS
+from main import BatteryChar, ProtocolError, StepChar, resolve
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+STATUS_HITS = REGISTRY.counter("miband_status_hits_total", "status reads answered from the snapshot")
+STATUS_READS = REGISTRY.counter("miband_status_reads_total", "status reads that went to the band")
+STATUS_CHANGES = REGISTRY.counter("miband_status_changes_total", "status values changed by notifications or reads")
+
+STATUS_TTL = 60.0
+EVENT_HISTORY = 64
+# device event 0xfe <command> is a music command, main.Music handles those
+MUSIC_CONTROL = MUSIC_STATE.CONTROL
+DEVICE_EVENTS = {
+    0x01: "fell_asleep",
+    0x02: "woke_up",
+    0x03: "goal_reached",
+    0x04: "button_pressed",
+    0x06: "not_worn",
+    0x07: "call_rejected",
+    0x09: "call_ignored",
+    0x0a: "alarm_toggled",
+    0x0b: "button_long_pressed",
+    0x0e: "tick_30min",
+    0x0f: "find_phone_start",
+    0x10: "alarm_changed",
+    0x11: "find_phone_stop",
+}
+# name: (characteristic, Wac.createChar type, payload parser)
+SOURCES = {
+    "steps": (UUIDS.CHARACTERISTIC_STEPS, "STEP", StepChar.parse),
+    "battery": (UUIDS.CHARACTERISTIC_BATTERY, "BATTERY", BatteryChar.parse),
+}
+
+
+def _key(char_specifier):
+    return str(getattr(char_specifier, "uuid", char_specifier)).lower()
+
+
+class NotificationHub:
+    def __init__(self, client, registry=None) -> None:
+        self.client = client
+        self.registry = registry
+        self.listeners = {}
+
+    async def subscribe(self, char_specifier, callback):
+        """Add callback(sender, data) for char_specifier, the first one starts notifications."""
+        char_specifier = resolve(self.registry, char_specifier)
+        key = _key(char_specifier)
+        listeners = self.listeners.get(key)
+        if listeners is None:
+            listeners = self.listeners[key] = []
+            try:
+                await self.client.start_notify(char_specifier, self._dispatcher(key))
+            except Exception:
+                del self.listeners[key]
+                raise
+        listeners.append(callback)
+
+    async def unsubscribe(self, char_specifier, callback):
+        char_specifier = resolve(self.registry, char_specifier)
+        key = _key(char_specifier)
+        listeners = self.listeners.get(key, [])
+        if callback in listeners:
+            listeners.remove(callback)
+        if not listeners and self.listeners.pop(key, None) is not None:
+            await self.client.stop_notify(char_specifier)
+
+    def _dispatcher(self, key):
+        def dispatch(sender, data):
+            for callback in tuple(self.listeners.get(key, ())):
+                try:
+                    result = callback(sender, data)
+                    if asyncio.iscoroutine(result):
+                        asyncio.ensure_future(result)
+                except Exception:
+                    # one broken listener must not starve the others
+                    logger.exception("notification listener %r failed", callback)
+        return dispatch
+
+
+class DeviceStatus:
+    def __init__(self, wac, ttl=STATUS_TTL, hub: NotificationHub = None) -> None:
+        self.wac = wac
+        self.ttl = ttl
+        self.hub = hub or NotificationHub(wac.client, wac.registry)
+        self.values = {}
+        self.updated = {}
+        self.version = 0
+        self.events = deque(maxlen=EVENT_HISTORY)
+        self.listeners = {}
+        self.subscribed = {}
+        self._reads = {}
+
+    async def start(self):
+        """Subscribe to everything the band notifies, a missing characteristic is skipped."""
+        for name, (uuid, _, parser) in SOURCES.items():
+            await self._subscribe(name, uuid, lambda _, data, name=name, parser=parser: self._notified(name, parser, data))
+        await self._subscribe("events", UUIDS.CHARACTERISTIC_DEVICE_EVENT, self._event)
+        return self
+
+    async def _subscribe(self, name, uuid, callback):
+        try:
+            await self.hub.subscribe(uuid, callback)
+            self.subscribed[name] = (uuid, callback)
+        except Exception as e:
+            logger.warning("no %s notifications: %r, falling back to reads", name, e)
+
+    async def stop(self):
+        for uuid, callback in self.subscribed.values():
+            await self.hub.unsubscribe(uuid, callback)
+        self.subscribed.clear()
+
+    def on(self, name, callback):
+        """callback(name, old, new) when steps, battery or events changes."""
+        self.listeners.setdefault(name, []).append(callback)
+
+    def _set(self, name, value):
+        self.updated[name] = time.monotonic()
+        old = self.values.get(name)
+        if old == value:
+            return False
+        self.values[name] = value
+        self.version += 1
+        STATUS_CHANGES.inc()
+        for callback in self.listeners.get(name, ()):
+            callback(name, old, value)
+        return True
+
+    def _notified(self, name, parser, data):
+        try:
+            self._set(name, parser(data))
+        except ValueError as e:
+            logger.warning("bad %s notification %r: %s", name, bytes(data), e)
+
+    def _event(self, _, data):
+        if not data or data[0] == MUSIC_CONTROL:
+            return
+        event = {"event": DEVICE_EVENTS.get(data[0], f"unknown_{data[0]:#04x}"), "at": time.time()}
+        self.events.append(event)
+        self._set("events", event)
+
+    def fresh(self, name):
+        updated = self.updated.get(name)
+        return updated is not None and time.monotonic() - updated < self.ttl
+
+    async def get(self, name):
+        """The latest value of steps or battery, read from the band only when stale."""
+        if self.fresh(name):
+            STATUS_HITS.inc()
+            return self.values[name]
+        return await self.refresh(name)
+
+    async def refresh(self, name):
+        """Read name from the band now, callers arriving meanwhile share the read."""
+        read = self._reads.get(name)
+        if read is None:
+            read = self._reads[name] = asyncio.ensure_future(self._read(name))
+            read.add_done_callback(lambda _: self._reads.pop(name, None))
+        return await asyncio.shield(read)
+
+    async def _read(self, name):
+        uuid, special_type, _ = SOURCES[name]
+        STATUS_READS.inc()
+        char = await self.wac.createChar(uuid, special_type)
+        try:
+            self._set(name, await char.read())
+        except ProtocolError as e:
+            if name not in self.values:
+                raise
+            # like a bad notification, keep the last good value
+            logger.warning("bad %s read: %s", name, e)
+        return self.values[name]
+
+    def snapshot(self):
+        now = time.monotonic()
+        return {
+            "version": self.version,
+            "subscribed": sorted(self.subscribed),
+            **{name: self.values.get(name) for name in SOURCES},
+            "age": {name: now - updated for name, updated in self.updated.items()},
+            "events": list(self.events),
+        }
@@ -0,0 +1,173 @@
+"""
+Activity Store
+--------------
+
+Append-only SQLite store of decoded minute samples, one row per epoch minute
+(band wall clock, see main.to_minute). A fetch window is committed in one
+transaction so a crash never leaves half a window behind, and minutes that are
+already stored are never overwritten. The hour/day/week rollups in rollups.py
+are brought up to date in that same transaction.
+
+Every day is also kept as packed columns, one byte per minute plus a
+`present` mask, so analyses like segments.py load a year as 365 blobs
+instead of half a million rows. A day's `revision` is bumped whenever one of
+its minutes is filled in.
+
+"""
+
+import sqlite3
+
+import rollups
+from main import ActivityBatch
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS activity (
+    minute INTEGER PRIMARY KEY,
+    category INTEGER NOT NULL,
+    intensity INTEGER NOT NULL,
+    steps INTEGER NOT NULL,
+    heart_rate INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS day_columns (
+    day INTEGER PRIMARY KEY,
+    revision INTEGER NOT NULL,
+    present BLOB NOT NULL,
+    category BLOB NOT NULL,
+    intensity BLOB NOT NULL,
+    steps BLOB NOT NULL,
+    heart_rate BLOB NOT NULL
+);
+"""
+DAY_MINUTES = 1440
+DAY_COLUMNS = ("present", "category", "intensity", "steps", "heart_rate")
+
+
+class ActivityStore:
+    def __init__(self, path="activity.db", rollup=True) -> None:
+        self.path = path
+        self.rollup = rollup
+        # a sync with offload commits from pipeline.py's worker thread, one at a time
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.revision = self.conn.execute("SELECT COALESCE(MAX(revision), 0) FROM day_columns").fetchone()[0]
+        if self.revision == 0 and self.last_minute() is not None:
+            # a store from before day columns
+            with self.conn:
+                self._pack(self.batches(0, self.last_minute() + 1, size=DAY_MINUTES))
+        if rollup:
+            self.conn.executescript(rollups.SCHEMA)
+            if self.conn.execute("SELECT 1 FROM rollup LIMIT 1").fetchone() is None:
+                # a store from before rollups, or one synced with rollup=False
+                with self.conn:
+                    rollups.rebuild(self.conn)
+
+    def close(self):
+        self.conn.close()
+
+    def last_minute(self):
+        return self.conn.execute("SELECT MAX(minute) FROM activity").fetchone()[0]
+
+    def commit(self, batches) -> int:
+        """Insert every sample of batches atomically, returns the number of new rows."""
+        with self.conn:
+            before = self.conn.total_changes
+            spans = []
+            for batch in batches:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO activity VALUES (?, ?, ?, ?, ?)",
+                    batch.rows())
+                if len(batch):
+                    if spans and spans[-1][1] == batch.start_minute:
+                        spans[-1][1] = batch.end_minute
+                    else:
+                        spans.append([batch.start_minute, batch.end_minute])
+            added = self.conn.total_changes - before
+            if added:
+                self._pack(batches)
+            if self.rollup and added:
+                for start, end in spans:
+                    rollups.update(self.conn, start, end)
+            return added
+
+    def _pack(self, batches):
+        """Splice batches into the day columns, minutes already present are kept."""
+        self.revision += 1
+        for batch in batches:
+            values = (batch.category, batch.intensity, batch.steps, batch.heart_rate)
+            minute = batch.start_minute
+            while minute < batch.end_minute:
+                day = minute // DAY_MINUTES
+                stop = min(batch.end_minute, (day + 1) * DAY_MINUTES)
+                row = self.conn.execute(
+                    "SELECT present, category, intensity, steps, heart_rate FROM day_columns WHERE day = ?",
+                    (day,)).fetchone()
+                present, *columns = map(bytearray, row) if row else (bytearray(DAY_MINUTES) for _ in DAY_COLUMNS)
+                lo, hi = minute - day * DAY_MINUTES, stop - day * DAY_MINUTES
+                offset = minute - batch.start_minute - lo
+                if present.find(1, lo, hi) == -1:
+                    for column, value in zip(columns, values):
+                        column[lo:hi] = value[lo + offset:hi + offset]
+                    present[lo:hi] = b'\x01' * (hi - lo)
+                else:
+                    for i in range(lo, hi):
+                        if not present[i]:
+                            present[i] = 1
+                            for column, value in zip(columns, values):
+                                column[i] = value[i + offset]
+                self.conn.execute("INSERT OR REPLACE INTO day_columns VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  (day, self.revision, bytes(present), *map(bytes, columns)))
+                minute = stop
+
+    def day_revisions(self):
+        """{day: revision} for every day with data, day = epoch minute // 1440."""
+        return dict(self.conn.execute("SELECT day, revision FROM day_columns"))
+
+    def day_columns(self, start_day: int, end_day: int):
+        """
+        {column: bytes} for days [start_day, end_day), one byte per minute
+        starting at start_day * 1440; missing minutes have present == 0.
+        """
+        empty = bytes(DAY_MINUTES)
+        days = {day: row for day, *row in self.conn.execute(
+            "SELECT day, present, category, intensity, steps, heart_rate FROM day_columns "
+            "WHERE day >= ? AND day < ?", (start_day, end_day))}
+        return {name: b"".join(days[day][i] if day in days else empty for day in range(start_day, end_day))
+                for i, name in enumerate(DAY_COLUMNS)}
+
+    def batches(self, start_minute: int, end_minute: int, size=None):
+        """
+        Yield the stored minutes in [start_minute, end_minute) as contiguous
+        batches, runs longer than size are split so a long range is streamed.
+        """
+        cursor = self.conn.execute(
+            "SELECT minute, category, intensity, steps, heart_rate FROM activity "
+            "WHERE minute >= ? AND minute < ? ORDER BY minute",
+            (start_minute, end_minute))
+        run_start = expected = None
+        columns = ([], [], [], [])
+        for minute, *values in cursor:
+            if run_start is not None and (minute != expected or len(columns[0]) == size):
+                yield ActivityBatch(run_start, *map(bytes, columns))
+                columns = ([], [], [], [])
+                run_start = None
+            if run_start is None:
+                run_start = minute
+            for column, value in zip(columns, values):
+                column.append(value)
+            expected = minute + 1
+        if run_start is not None:
+            yield ActivityBatch(run_start, *map(bytes, columns))
+
+    def gaps(self, start_minute: int, end_minute: int):
+        """Return the [start, end) minute ranges missing from the store, for backfills."""
+        gaps = []
+        cursor = start_minute
+        for batch in self.batches(start_minute, end_minute):
+            if batch.start_minute > cursor:
+                gaps.append((cursor, batch.start_minute))
+            cursor = batch.end_minute
+        if cursor < end_minute:
+            gaps.append((cursor, end_minute))
+        return gaps
@@ -0,0 +1,196 @@
+"""
+Connection Supervisor
+---------------------
+
+Keeps one band connected and authenticated across link drops:
+
++ connect attempts back off exponentially (1s, 2s, 4s ... capped at 60s) with
+  jitter, so an out of range band doesn't peg a core or flood the adapter
++ a drop is noticed through bleak's disconnected callback, which cancels the
+  operation that was running on the lost link
++ run() reconnects, re-authenticates and runs the operation again; sync()
+  resumes an interrupted fetch from the last fully decoded minute
++ the time from a drop to the next successful auth is kept in
+  miband_recovery_seconds and report()
+
+    supervisor = Supervisor(address, auth_key)
+    session = await supervisor.sync(ActivityStore())
+    print(supervisor.report())
+
+"""
+
+import asyncio
+import functools
+import logging
+import random
+import time
+
+from datetime import datetime
+
+from main import RECONNECTS, ActivityBatch, ActivityGetter, Wac
+from metrics import DURATION_BUCKETS, REGISTRY
+
+logger = logging.getLogger(__name__)
+
+LINK_DROPS = REGISTRY.counter("miband_link_drops_total", "connections lost while in use")
+RECOVERY_SECONDS = REGISTRY.histogram("miband_recovery_seconds", "link drop to re-authenticated", DURATION_BUCKETS)
+
+BACKOFF_INITIAL = 1.0
+BACKOFF_MAX = 60.0
+BACKOFF_FACTOR = 2.0
+BACKOFF_JITTER = 0.5
+
+
+class Backoff:
+    """Exponential delays, each shortened by up to `jitter` of itself at random."""
+
+    def __init__(self, initial=BACKOFF_INITIAL, maximum=BACKOFF_MAX, factor=BACKOFF_FACTOR,
+                 jitter=BACKOFF_JITTER, seed=None) -> None:
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.attempt = 0
+
+    def next(self):
+        delay = min(self.maximum, self.initial * self.factor ** self.attempt)
+        self.attempt += 1
+        return delay * (1.0 - self.jitter * self.random.random())
+
+    def reset(self):
+        self.attempt = 0
+
+
+class Supervisor:
+    def __init__(self, address, auth_key=None, wac_factory=Wac, backoff: Backoff = None,
+                 max_attempts=None, gatt_cache_dir=None) -> None:
+        if gatt_cache_dir is not None:
+            wac_factory = functools.partial(wac_factory, gatt_cache_dir=gatt_cache_dir)
+        self.address = address
+        self.auth_key = auth_key
+        self.wac_factory = wac_factory
+        self.backoff = backoff or Backoff()
+        self.max_attempts = max_attempts
+        self.wac = None
+        self.attempts = 0
+        self.drops = 0
+        self.recoveries = []
+        self.lost_at = None
+        self._task = None
+
+    @property
+    def connected(self):
+        return self.wac is not None and self.wac.client.is_connected
+
+    def _on_disconnect(self, client):
+        if self.wac is None or client is not self.wac.client:
+            # a failed attempt being torn down, not a link we were using
+            return
+        self._lost()
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    def _lost(self):
+        self.wac = None
+        self.drops += 1
+        LINK_DROPS.inc()
+        if self.lost_at is None:
+            self.lost_at = time.monotonic()
+        logger.warning("%s: link lost", self.address)
+
+    async def connect(self):
+        """Connect and authenticate, backing off between failed attempts."""
+        if self.connected:
+            return self.wac
+        failures = 0
+        while True:
+            self.attempts += 1
+            wac = self.wac_factory(self.address, auth_key=self.auth_key, disconnected_callback=self._on_disconnect)
+            try:
+                await wac.connect()
+                await wac.authenticate()
+            except Exception as e:
+                failures += 1
+                await self._disconnect(wac)
+                if self.max_attempts is not None and failures >= self.max_attempts:
+                    raise
+                delay = self.backoff.next()
+                logger.warning("%s: connect failed (%r), retrying in %.1fs", self.address, e, delay)
+                await asyncio.sleep(delay)
+                continue
+            self.backoff.reset()
+            self.wac = wac
+            if self.lost_at is not None:
+                recovery = time.monotonic() - self.lost_at
+                self.lost_at = None
+                self.recoveries.append(recovery)
+                RECOVERY_SECONDS.observe(recovery)
+                RECONNECTS.inc()
+                logger.info("%s: recovered in %.2fs", self.address, recovery)
+            return wac
+
+    async def _disconnect(self, wac):
+        client = getattr(wac, "client", None)
+        if client is not None and client.is_connected:
+            try:
+                await client.disconnect()
+            except Exception as e:
+                logger.debug("disconnect failed: %r", e)
+
+    async def run(self, operation):
+        """Await operation(wac), calling it again on a fresh connection after every drop."""
+        while True:
+            wac = await self.connect()
+            self._task = asyncio.ensure_future(operation(wac))
+            try:
+                return await self._task
+            except asyncio.CancelledError:
+                if self.wac is not None:
+                    # cancelled from outside, not by _on_disconnect
+                    raise
+            except Exception as e:
+                if wac.client.is_connected:
+                    raise
+                # the write failed before the disconnected callback came in
+                if self.wac is wac:
+                    self._lost()
+                logger.warning("%s: %r on a lost link", self.address, e)
+            finally:
+                self._task = None
+
+    async def sync(self, store=None, start: datetime = None, end: datetime = None, offload=False):
+        """Wac.sync that survives drops, each retry resumes from the last decoded minute."""
+        end = end or datetime.now()
+        batches = []
+        resume = start
+
+        async def fetch(wac):
+            nonlocal resume
+            getter = ActivityGetter(await wac.utc_offset(), wac.client, store=store, start=resume, end=end,
+                                    registry=wac.registry, offload=offload)
+            try:
+                return await getter.fetch()
+            finally:
+                # keep what was decoded before the drop, the window never finished
+                getter.commit_window()
+                batches.extend(getter.batches)
+                resume = getter.next_timestamp
+
+        await self.run(fetch)
+        return ActivityBatch.concat(batches)
+
+    def report(self):
+        recoveries = sorted(self.recoveries)
+        return {
+            "attempts": self.attempts,
+            "drops": self.drops,
+            "recoveries": len(recoveries),
+            "recovery_mean": sum(recoveries) / len(recoveries) if recoveries else 0.0,
+            "recovery_max": recoveries[-1] if recoveries else 0.0,
+        }
+
+    async def close(self):
+        wac, self.wac = self.wac, None
+        if wac is not None:
+            await self._disconnect(wac)